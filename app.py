@@ -11,6 +11,7 @@ from flask import Flask
 from utils import PERSONAJES_DIR, get_personaje_activo_id
 from memoria import cargar_personaje
 from utils import init_database_personaje
+from trabajos import iniciar_trabajos
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'hiro-chat-local-key-2024')
@@ -78,6 +79,7 @@ def _init_app():
     migrar_hiro_default()
     backup_datos()
     cargar_personaje(get_personaje_activo_id())
+    iniciar_trabajos()   # workers del post-proceso + trabajos que quedaron pendientes
     print("✅ Sistema listo")
 
 
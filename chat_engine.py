@@ -1,27 +1,37 @@
 # ═══════════════════════════════════════════════════════════════════════════
 # CHAT_ENGINE.PY — Motor del chat
-# _procesar_mensaje, _procesar_continuar, verificar_eventos_automaticos
+# _procesar_mensaje (y su variante en streaming), _procesar_continuar,
+# verificar_eventos_automaticos
 # El archivo que tocás cuando querés cambiar cómo responde el personaje.
 # ═══════════════════════════════════════════════════════════════════════════
 
 import json
+import time
+import random
 import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
 
 from utils import (
     now_argentina,
-    llamada_mistral_segura,
-    paths, get_personaje_activo_id,
+    llamada_mistral_segura, llamada_stream_segura,
+    paths, get_personaje_activo_id, personaje_del_hilo, cargar_config_apis,
     _get_conn,
     buscar_en_internet,
 )
+from trabajos import encolar, registrar_tipo
+from resiliencia import con_cancelacion
+from limitador import en_segundo_plano
+import clasificador_busqueda
+from turnos import pedir_turno, turno_exclusivo
 from memoria import (
     obtener_contexto, obtener_system_prompt, actualizar_fase,
     extraer_informacion_con_ia, guardar_memoria_permanente,
-    agregar_embedding, _enriquecer_episodio,
+    agregar_embedding, eliminar_embeddings, _enriquecer_episodio,
     _debe_regenerar_sintesis, _ejecutar_sintesis,
     get_faiss_ntotal,
     extraer_menciones_casuales, _detectar_y_cerrar_hilos,
     detectar_emocion,
+    analizar_turno, guardar_menciones_casuales, guardar_enriquecimiento, guardar_emocion,
     generar_backstory_automatico,
     generar_diario_automatico,
     actualizar_evolucion_automatica,
@@ -44,19 +54,25 @@ def _get_modelo(tarea):
         return 'mistral-small-latest'
 
 
-def _recortar_respuesta(respuesta, limite=None):
+def _limite_palabras():
     """
-    Corta la respuesta según el modo activo:
+    Límite de palabras por respuesta según el modo activo:
       - compañero: 120 palabras (conversación fluida)
       - roleplay:  220 palabras (escenas narrativas necesitan más espacio)
+    """
+    try:
+        return 220 if _get_modo_memoria() == 'roleplay' else 120
+    except Exception:
+        return 120
+
+
+def _recortar_respuesta(respuesta, limite=None):
+    """
+    Corta la respuesta en la última oración completa dentro de _limite_palabras().
     Si se pasa limite explícito, lo usa directamente.
     """
     if limite is None:
-        try:
-            modo = _get_modo_memoria()
-            limite = 220 if modo == 'roleplay' else 120
-        except Exception:
-            limite = 120
+        limite = _limite_palabras()
 
     palabras = respuesta.split()
     if len(palabras) <= limite:
@@ -90,31 +106,12 @@ def _get_escenario_id_actual():
         return None
 
 
-def _detectar_query_busqueda(mensaje):
+def _detectar_query_llm(mensaje):
     """
-    Mini-llamada rápida con mistral-small para decidir si el mensaje necesita
-    una búsqueda en internet. Solo activa en modo compañero y si hay al menos
-    una key de búsqueda configurada.
-    Devuelve la query a buscar (str) o None si no hace falta.
+    Mini-llamada con el modelo de extracción: ¿el mensaje necesita datos de
+    internet? Devuelve (necesita, query); (None, None) si la llamada falló.
     """
     try:
-        # Solo en modo compañero
-        if _get_modo_memoria() != 'compañero':
-            return None
-
-        # Solo si hay alguna key configurada y búsqueda habilitada
-        from utils import cargar_config_apis
-        cfg    = cargar_config_apis()
-        search = cfg.get('search', {})
-        if not search.get('enabled', False):
-            return None
-        if not any([
-            search.get('serpapi_key', '').strip(),
-            search.get('brave_key', '').strip(),
-            search.get('tavily_key', '').strip(),
-        ]):
-            return None
-
         # Usar el modelo de extracción configurado (respeta el proveedor activo)
         modelo_extraccion = _get_modelo('extraction')
         resp = llamada_mistral_segura(
@@ -134,23 +131,179 @@ def _detectar_query_busqueda(mensaje):
         )
         from memoria._helpers import _limpiar_json
         datos = _limpiar_json(resp.choices[0].message.content.strip(), esperar_array=False)
-        if datos and datos.get('necesita_busqueda') and datos.get('query', '').strip():
-            return datos['query'].strip()
+        if not isinstance(datos, dict):
+            return None, None
+        query = str(datos.get('query') or '').strip()
+        return bool(datos.get('necesita_busqueda')), query or None
+    except Exception as e:
+        print(f"⚠️ Error detector búsqueda: {e}")
+    return None, None
+
+
+def _auditar_busqueda(mensaje, decision):
+    """De fondo: el LLM revisa un atajo del clasificador local (precisión / recall) y le enseña."""
+    necesita, _ = _detectar_query_llm(mensaje)
+    if necesita is not None:
+        clasificador_busqueda.registrar_auditoria(decision, necesita)
+        clasificador_busqueda.aprender(mensaje, necesita)
+
+
+def _detectar_query_busqueda(mensaje):
+    """
+    Decide si el mensaje necesita una búsqueda en internet. Solo activa en
+    modo compañero y si hay al menos una key de búsqueda configurada.
+    Primero el clasificador local (clasificador_busqueda.py) resuelve los
+    casos claros sin latencia; solo lo dudoso va a la mini-llamada al LLM,
+    cuya respuesta entrena al clasificador.
+    Devuelve la query a buscar (str) o None si no hace falta.
+    """
+    try:
+        # Solo en modo compañero
+        if _get_modo_memoria() != 'compañero':
+            return None
+
+        # Solo si hay alguna key configurada y búsqueda habilitada
+        cfg    = cargar_config_apis()
+        search = cfg.get('search', {})
+        if not search.get('enabled', False):
+            return None
+        if not any([
+            search.get('serpapi_key', '').strip(),
+            search.get('brave_key', '').strip(),
+            search.get('tavily_key', '').strip(),
+        ]):
+            return None
+
+        clf = cfg.get('searchClassifier', {}) or {}
+        if clf.get('enabled', True):
+            decision, _ = clasificador_busqueda.clasificar(
+                mensaje, clf.get('lowThreshold', 0.15), clf.get('highThreshold', 0.9),
+                clf.get('minSamples', 30))
+            if decision != clasificador_busqueda.DUDOSO:
+                # Una muestra de los atajos la revisa el LLM de fondo, para medir el clasificador
+                if random.random() < clf.get('auditRate', 0.05):
+                    threading.Thread(target=en_segundo_plano, args=(_auditar_busqueda, mensaje, decision),
+                                     daemon=True).start()
+                if decision == clasificador_busqueda.NO:
+                    return None
+                return clasificador_busqueda.query_local(mensaje)
     except Exception as e:
         print(f"⚠️ Error detector búsqueda: {e}")
+        return None
+
+    necesita, query = _detectar_query_llm(mensaje)
+    if necesita is None:
+        return None
+    clasificador_busqueda.aprender(mensaje, necesita)
+    return query if necesita and query else None
+
+
+def _buscar_para_turno(mensaje):
+    """Detector + búsqueda web del turno. Devuelve el snippet encontrado o None."""
+    query_busqueda = _detectar_query_busqueda(mensaje)
+    if not query_busqueda:
+        return None
+    print(f"🔍 Buscando: '{query_busqueda}'")
+    return buscar_en_internet(query_busqueda)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# SECCIÓN 6: PRE-RESPUESTA EN PARALELO
+# Contexto de memoria, system prompt y búsqueda web no dependen entre sí:
+# corren a la vez y el turno espera lo que tarde la etapa más lenta, no la
+# suma. Cada etapa opcional tiene su plazo (preReply en api_config.json):
+# el contexto que no llega a tiempo se omite y la búsqueda que se pasa se
+# descarta; el system prompt se espera siempre.
+# ─────────────────────────────────────────────────────────────────────────────
+
+_pool_turno = ThreadPoolExecutor(max_workers=12, thread_name_prefix='turno')
+
+
+def _etapa(pid_turno, fn, *args, **kwargs):
+    # Cada etapa corre en otro hilo: fija ahí el personaje del turno
+    with personaje_del_hilo(pid_turno):
+        return fn(*args, **kwargs)
+
+
+def _config_pre_respuesta():
+    try:
+        return cargar_config_apis().get('preReply', {}) or {}
+    except Exception:
+        return {}
+
+
+def _esperar_etapa(futuro, nombre, limite, descartar=None):
+    """Resultado de la etapa si termina antes de `limite` (time.monotonic()); si no, None."""
+    try:
+        return futuro.result(timeout=None if limite is None else max(0.0, limite - time.monotonic()))
+    except FuturesTimeout:
+        if descartar is not None:
+            descartar.set()   # si la llamada de la etapa sigue en la cola, no se envía
+        print(f"⏱️ Pre-respuesta: '{nombre}' superó su plazo, se responde sin esa etapa")
+    except Exception as e:
+        print(f"⚠️ Pre-respuesta: error en '{nombre}': {e}")
     return None
 
 
+def _pre_respuesta(pid, mensaje, buscar=True):
+    """
+    Contexto de memoria, system prompt y snippet web del turno (buscar=False:
+    sin búsqueda, para continuar). Devuelve (contexto, system_prompt,
+    snippet_web); contexto y snippet pueden venir vacíos si su etapa falló
+    o se pasó de plazo.
+    """
+    cfg = _config_pre_respuesta()
+    if not cfg.get('parallel', True):
+        contexto      = obtener_contexto(mensaje, pid=pid)
+        system_prompt = obtener_system_prompt(mensaje)  # ← pasa el mensaje actual
+        return contexto, system_prompt, _buscar_para_turno(mensaje) if buscar else None
+
+    inicio = time.monotonic()
+    cancelar_busqueda = threading.Event()
+    f_contexto = _pool_turno.submit(_etapa, pid, obtener_contexto, mensaje, pid=pid)
+    f_prompt   = _pool_turno.submit(_etapa, pid, obtener_system_prompt, mensaje)
+    f_busqueda = _pool_turno.submit(_etapa, pid, con_cancelacion, cancelar_busqueda,
+                                    _buscar_para_turno, mensaje) if buscar else None
+
+    system_prompt = f_prompt.result()   # obligatorio: sin plazo (sus errores suben como antes)
+    contexto = _esperar_etapa(f_contexto, 'contexto',
+                              inicio + cfg.get('contextTimeoutMs', 15000) / 1000)
+    snippet_web = _esperar_etapa(f_busqueda, 'búsqueda',
+                                 inicio + cfg.get('searchTimeoutMs', 4000) / 1000,
+                                 descartar=cancelar_busqueda) if buscar else None
+    print(f"⏱️ Pre-respuesta en {time.monotonic() - inicio:.2f}s")
+    return contexto or '', system_prompt, snippet_web
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # SECCIÓN 7: PROCESAMIENTO DE MENSAJES
 # ─────────────────────────────────────────────────────────────────────────────
 
-def _procesar_mensaje(mensaje):
-    """Núcleo del chat: guarda, llama a Mistral, guarda respuesta, actualiza memoria."""
-    with _get_conn(paths()['db']) as conn:
+def _pedir_turno(clave):
+    """
+    Lugar en la fila de turnos del personaje activo (turnos.py). El pid
+    queda fijo para todo el turno: el cuerpo corre dentro de
+    personaje_del_hilo(turno.pid), así modo, límites, escenario y fase son
+    los de ese personaje aunque cambien de personaje mientras espera.
+    """
+    try:
+        duplicados = cargar_config_apis().get('turns', {}).get('duplicates', 'merge')
+    except Exception:
+        duplicados = 'merge'
+    return pedir_turno(get_personaje_activo_id(), clave, duplicados)
+
+
+def _preparar_turno(mensaje, pid):
+    """
+    Primera mitad de un turno: guarda el mensaje del usuario y arma los
+    messages para el LLM (historial, contexto de memoria, búsqueda web).
+    Devuelve (mensaje_ids, messages).
+    """
+    with _get_conn(paths(pid)['db']) as conn:
         cursor = conn.cursor()
         cursor.execute('INSERT INTO mensajes (rol, contenido, timestamp) VALUES (?, ?, ?)',
                        ('user', mensaje, now_argentina().isoformat()))
+        mensaje_ids = [cursor.lastrowid]
         cursor.execute('UPDATE relacion SET ultimo_mensaje = ? WHERE id = 1',
                        (now_argentina().isoformat(),))
         # Roleplay necesita más contexto de sesión para mantener coherencia narrativa.
@@ -159,22 +312,16 @@ def _procesar_mensaje(mensaje):
         cursor.execute('SELECT rol, contenido FROM mensajes ORDER BY id DESC LIMIT ?', (historial_limite,))
         historial = list(reversed(cursor.fetchall()))
 
-    contexto      = obtener_contexto(mensaje)
-    system_prompt = obtener_system_prompt(mensaje)  # ← pasa el mensaje actual
-
-    # ── Búsqueda en internet (modo compañero + búsqueda habilitada) ───────────
-    snippet_web = None
-    query_busqueda = _detectar_query_busqueda(mensaje)
-    if query_busqueda:
-        print(f"🔍 Buscando: '{query_busqueda}'")
-        snippet_web = buscar_en_internet(query_busqueda)
-        if snippet_web:
-            system_prompt += (
-                f"\n\n───────────────────────────────\n"
-                f"INFORMACIÓN ENCONTRADA EN INTERNET (usala naturalmente, como si ya lo supieras, sin mencionar que buscaste):\n"
-                f"{snippet_web}\n"
-                f"───────────────────────────────"
-            )
+    # Contexto, system prompt y búsqueda en internet (modo compañero +
+    # búsqueda habilitada) en paralelo, ver _pre_respuesta()
+    contexto, system_prompt, snippet_web = _pre_respuesta(pid, mensaje)
+    if snippet_web:
+        system_prompt += (
+            f"\n\n───────────────────────────────\n"
+            f"INFORMACIÓN ENCONTRADA EN INTERNET (usala naturalmente, como si ya lo supieras, sin mencionar que buscaste):\n"
+            f"{snippet_web}\n"
+            f"───────────────────────────────"
+        )
 
     messages = [
         {'role': 'system', 'content': system_prompt + (f"\n\n{contexto}" if contexto else "")},
@@ -182,158 +329,293 @@ def _procesar_mensaje(mensaje):
     for rol, contenido in historial[:-1]:
         messages.append({'role': 'assistant' if rol == 'assistant' else 'user', 'content': contenido})
     messages.append({'role': 'user', 'content': mensaje})
+    return mensaje_ids, messages
 
-    response  = llamada_mistral_segura(model=_get_modelo("chat"), messages=messages, max_tokens=600, temperature=0.88)
-    respuesta = _recortar_respuesta(response.choices[0].message.content.strip())
 
-    with _get_conn(paths()['db']) as conn:
+def _procesar_mensaje(mensaje, clave=None):
+    """
+    Núcleo del chat: guarda, llama a Mistral, guarda respuesta, actualiza memoria.
+    Corre como un turno de la fila del personaje; `clave` es la clave de
+    idempotencia del cliente (un reenvío del mismo mensaje no se procesa dos veces).
+    """
+    turno = _pedir_turno(clave)
+    if turno.original is not None:
+        print("🔁 Mensaje duplicado: se devuelve la respuesta del original")
+        return turno.original.valor()
+    try:
+        turno.esperar()
+        with personaje_del_hilo(turno.pid):
+            mensaje_ids, messages = _preparar_turno(mensaje, turno.pid)
+            response  = llamada_mistral_segura(model=_get_modelo("chat"), messages=messages, max_tokens=600,
+                                               temperature=0.88, tarea='chat')
+            respuesta = _recortar_respuesta(response.choices[0].message.content.strip())
+            respuesta = _finalizar_turno(turno.pid, mensaje, respuesta, mensaje_ids)
+    except BaseException as e:
+        turno.terminar(error=e)
+        raise
+    turno.terminar(respuesta)
+    return respuesta
+
+
+def _procesar_mensaje_stream(mensaje, clave=None):
+    """
+    Variante en streaming de _procesar_mensaje(): generador de eventos
+    ('cola', posición) cada segundo mientras espera su turno, ('delta',
+    fragmento) mientras el modelo escribe y ('fin', respuesta) al final.
+    El límite de palabras se aplica en vivo: apenas se pasa, se cierra el
+    stream (el proveedor deja de generar) y la respuesta final es la recortada
+    con _recortar_respuesta(), igual que en el camino sin streaming.
+    Si el consumidor abandona el generador antes del final (el usuario cortó),
+    no se guarda respuesta ni se corre el post-proceso.
+    Un duplicado (misma clave) no genera fragmentos: recibe el 'fin' del original.
+    """
+    turno = _pedir_turno(clave)
+    if turno.original is not None:
+        print("🔁 Mensaje duplicado: se devuelve la respuesta del original")
+        while not turno.original.listo(1.0):
+            yield 'cola', turno.original.posicion()
+        yield 'fin', turno.original.valor()
+        return
+
+    try:
+        if turno.posicion():
+            yield 'cola', turno.posicion()
+        while not turno.esperar(1.0):
+            yield 'cola', turno.posicion()
+        # El generador lo consume siempre el mismo hilo de la request
+        with personaje_del_hilo(turno.pid):
+            mensaje_ids, messages = _preparar_turno(mensaje, turno.pid)
+            limite = _limite_palabras()
+            texto  = ''
+            stream = llamada_stream_segura(model=_get_modelo("chat"), messages=messages, max_tokens=600,
+                                           temperature=0.88)
+            try:
+                for fragmento in stream:
+                    texto += fragmento
+                    yield 'delta', fragmento
+                    if len(texto.split()) > limite:
+                        print(f"✂️ Stream cortado en {limite} palabras")
+                        break
+            finally:
+                stream.close()
+            respuesta = _recortar_respuesta(texto.strip(), limite)
+            respuesta = _finalizar_turno(turno.pid, mensaje, respuesta, mensaje_ids)
+    except BaseException as e:
+        turno.terminar(error=e)
+        raise
+    turno.terminar(respuesta)
+    yield 'fin', respuesta
+
+
+def _finalizar_turno(pid, mensaje, respuesta, mensaje_ids):
+    """Segunda mitad de un turno: guarda la respuesta y encola el post-proceso."""
+    with _get_conn(paths(pid)['db']) as conn:
         cursor = conn.cursor()
         cursor.execute('INSERT INTO mensajes (rol, contenido, timestamp) VALUES (?, ?, ?)',
                        ('assistant', respuesta, now_argentina().isoformat()))
+        mensaje_ids.append(cursor.lastrowid)
 
-    # ── Todo el post-proceso en background — el usuario ya tiene su respuesta ──
-    def _post_proceso(mensaje, respuesta, escenario_id_actual):
-        try:
-            _detectar_y_cerrar_hilos(mensaje)
-        except Exception as e:
-            print(f"⚠️ Error cerrando hilos: {e}")
+    actualizar_fase()
+    # Todo el post-proceso va a la cola durable: el usuario ya tiene su respuesta
+    encolar(pid, 'memoria_turno', {
+        'mensaje': mensaje, 'respuesta': respuesta,
+        'escenario_id': _get_escenario_id_actual(), 'mensaje_ids': mensaje_ids,
+    }, clave=f"{mensaje_ids[0]}:memoria")
 
-        try:
-            datos = extraer_informacion_con_ia(mensaje, respuesta)
-            if datos:
-                guardar_memoria_permanente(datos)
-        except Exception as e:
-            print(f"⚠️ Error extracción: {e}")
+    return respuesta
 
-        try:
-            extraer_menciones_casuales(mensaje, respuesta)
-        except Exception as e:
-            print(f"⚠️ Error menciones casuales: {e}")
 
-        try:
-            embedding_id = agregar_embedding(f"Usuario: {mensaje}\nPersonaje: {respuesta}", 'episodio')
-            with _get_conn(paths()['db']) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """SELECT COUNT(*) FROM memoria_episodica
-                       WHERE contenido_usuario = ?
-                       AND datetime(fecha) >= datetime('now', '-60 seconds')""",
-                    (mensaje,)
-                )
-                if cursor.fetchone()[0] == 0:
-                    cursor.execute('''INSERT OR IGNORE INTO memoria_episodica
-                        (contenido_usuario, contenido_hiro, fecha, embedding_id, escenario_id)
-                        VALUES (?, ?, ?, ?, ?)''',
-                        (mensaje, respuesta, now_argentina().isoformat(),
-                         embedding_id, escenario_id_actual))
-                    episodio_id_nuevo = cursor.lastrowid
-                else:
-                    episodio_id_nuevo = None
-            if episodio_id_nuevo:
-                try:
-                    _enriquecer_episodio(episodio_id_nuevo, mensaje, respuesta)
-                except Exception as e:
-                    print(f"⚠️ Error enriquecimiento episódico: {e}")
-        except Exception as e:
-            print(f"⚠️ Error episodio: {e}")
+# ─────────────────────────────────────────────────────────────────────────────
+# SECCIÓN 7a: POST-PROCESO DEL TURNO (trabajos en segundo plano)
+# Corren en los workers de trabajos.py con el personaje del turno fijado en
+# el hilo. Cada t.paso() se ejecuta una sola vez aunque el trabajo se
+# reintente o se retome al arrancar. Los pasos usan las variantes que
+# propagan el error (lanzar=True): un fallo transitorio no queda guardado
+# como paso completado, se reintenta.
+# ─────────────────────────────────────────────────────────────────────────────
 
-        try:
-            detectar_emocion(mensaje)
-        except Exception as e:
-            print(f"⚠️ Error emoción: {e}")
+def _guardar_hechos_turno(pid, mensaje, respuesta, hechos):
+    datos = hechos
+    if datos is None:
+        datos = extraer_informacion_con_ia(mensaje, respuesta, lanzar=True)
+    if datos:
+        guardar_memoria_permanente(datos, pid=pid, lanzar=True)
 
-        # ── Conteo de mensajes del usuario (base para todos los triggers) ──
-        try:
-            with _get_conn(paths()['db']) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM mensajes WHERE rol='user'")
-                msg_count = cursor.fetchone()[0]
-        except Exception as e:
-            print(f"⚠️ Error contando mensajes: {e}")
-            msg_count = 0
 
-        # ── Backstory cada 50 mensajes ─────────────────────────────────────
-        try:
-            if msg_count > 0 and msg_count % 50 == 0:
-                generar_backstory_automatico()
-        except Exception as e:
-            print(f"⚠️ Error backstory: {e}")
+def _guardar_menciones_turno(mensaje, respuesta, menciones):
+    if menciones is None:
+        extraer_menciones_casuales(mensaje, respuesta, lanzar=True)
+    elif menciones:
+        guardar_menciones_casuales(menciones)
 
-        # ── Diario automático: nueva sesión (gap > 3hs) o cada 25 mensajes ─
-        try:
-            _disparar_diario = False
 
-            # Trigger 1: nueva sesión (gap > 3hs desde el penúltimo mensaje)
-            with _get_conn(paths()['db']) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT timestamp FROM mensajes WHERE rol='user' ORDER BY id DESC LIMIT 2"
-                )
-                rows = cursor.fetchall()
-            if len(rows) >= 2:
-                from datetime import datetime as _dt
-                prev_ts = str(rows[1][0]).replace(' ', 'T').split('.')[0]
-                dt_prev = _dt.fromisoformat(prev_ts)
-                if dt_prev.tzinfo is None:
-                    dt_prev = dt_prev.replace(tzinfo=now_argentina().tzinfo)
-                horas_gap = (now_argentina() - dt_prev).total_seconds() / 3600
-                if horas_gap >= 3:
-                    _disparar_diario = True
-
-            # Trigger 2: cada 25 mensajes del usuario
-            if msg_count > 0 and msg_count % 25 == 0:
-                _disparar_diario = True
-
-            if _disparar_diario:
-                generar_diario_automatico()
-        except Exception as e:
-            print(f"⚠️ Error diario automático: {e}")
+def _guardar_episodio_turno(pid, mensaje, respuesta, escenario_id, mensaje_ids):
+    """Guarda el episodio del turno con su vector. Devuelve su id, o None si ya existía."""
+    embedding_id = agregar_embedding(f"Usuario: {mensaje}\nPersonaje: {respuesta}", 'episodio', pid=pid)
+    if embedding_id is None:
+        raise RuntimeError("no se pudo generar el embedding del episodio")
+    with _get_conn(paths(pid)['db']) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT COUNT(*) FROM memoria_episodica
+               WHERE contenido_usuario = ?
+               AND datetime(fecha) >= datetime('now', '-60 seconds')""",
+            (mensaje,)
+        )
+        if cursor.fetchone()[0] == 0:
+            cursor.execute('''INSERT OR IGNORE INTO memoria_episodica
+                (contenido_usuario, contenido_hiro, fecha, embedding_id, escenario_id)
+                VALUES (?, ?, ?, ?, ?)''',
+                (mensaje, respuesta, now_argentina().isoformat(),
+                 embedding_id, escenario_id))
+            episodio_id_nuevo = cursor.lastrowid
+            # Los dos mensajes del turno apuntan al vector del episodio
+            cursor.execute('UPDATE mensajes SET embedding_id = ? WHERE id IN (?, ?)',
+                           (embedding_id, *mensaje_ids))
+        else:
+            episodio_id_nuevo = None
+    if episodio_id_nuevo is None:
+        eliminar_embeddings([embedding_id], pid=pid)   # episodio duplicado: vector huérfano
+    return episodio_id_nuevo
+
+
+def _enriquecer_episodio_turno(episodio_id, mensaje, respuesta, episodio):
+    if episodio is None:
+        _enriquecer_episodio(episodio_id, mensaje, respuesta, lanzar=True)
+    else:
+        guardar_enriquecimiento(episodio_id, episodio)
+
+
+def _guardar_emocion_turno(mensaje, emocion):
+    if emocion is None:
+        detectar_emocion(mensaje, lanzar=True)
+    else:
+        guardar_emocion(emocion)
+
+
+def _trabajo_memoria_turno(t):
+    """Hilos, hechos, menciones, episodio y emoción del turno; al final encola los periódicos."""
+    p = t.payload
+    mensaje, respuesta = p['mensaje'], p['respuesta']
+
+    t.paso('hilos', _detectar_y_cerrar_hilos, mensaje, lanzar=True)
+
+    # Una sola llamada para hechos, menciones, episodio y emoción; la sección
+    # que vuelva inválida (None) se pide con su llamada dedicada de siempre.
+    # Si la llamada misma falló (rate limit, timeout) no se cae a las cuatro
+    # dedicadas: el trabajo se reintenta y vuelve a probar la unificada.
+    analisis = t.paso('analisis', analizar_turno, mensaje, respuesta, lanzar=True)
+    if analisis is None:
+        return
+
+    t.paso('hechos', _guardar_hechos_turno, t.pid, mensaje, respuesta, analisis['hechos'])
+    t.paso('menciones', _guardar_menciones_turno, mensaje, respuesta, analisis['menciones'])
+    episodio_id = t.paso('episodio', _guardar_episodio_turno,
+                         t.pid, mensaje, respuesta, p['escenario_id'], p['mensaje_ids'])
+    if episodio_id:
+        t.paso('enriquecimiento', _enriquecer_episodio_turno,
+               episodio_id, mensaje, respuesta, analisis['episodio'])
+    t.paso('emocion', _guardar_emocion_turno, mensaje, analisis['emocion'])
+
+    # Los periódicos (backstory, diario, evolución, síntesis) después de la
+    # memoria del turno, como antes: su propio trabajo, con su propia clave.
+    # Si algo falló en este intento, recién cuando el reintento lo complete
+    if t.hubo_errores:
+        return
+    t.paso('encolar_periodicos', encolar, t.pid, 'periodicos_turno',
+           {'mensaje_id': p['mensaje_ids'][0]}, clave=f"{p['mensaje_ids'][0]}:periodicos")
+
+
+def _conteo_y_gap(mensaje_id):
+    """
+    Mensajes del usuario hasta este turno (inclusive) y horas desde el
+    anterior. Se cuentan respecto del id del mensaje, no de "ahora": un
+    trabajo reintentado o retomado más tarde dispara lo mismo que en su turno.
+    """
+    from datetime import datetime as _dt
+    with _get_conn(paths()['db']) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM mensajes WHERE rol='user' AND id <= ?", (mensaje_id,))
+        msg_count = cursor.fetchone()[0]
+        cursor.execute(
+            "SELECT timestamp FROM mensajes WHERE rol='user' AND id <= ? ORDER BY id DESC LIMIT 2",
+            (mensaje_id,)
+        )
+        rows = cursor.fetchall()
+    horas_gap = 0.0
+    if len(rows) >= 2:
+        fechas = []
+        for (ts,) in rows:
+            dt = _dt.fromisoformat(str(ts).replace(' ', 'T').split('.')[0])
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=now_argentina().tzinfo)
+            fechas.append(dt)
+        horas_gap = (fechas[0] - fechas[1]).total_seconds() / 3600
+    return msg_count, horas_gap
 
-        # ── Evolución de fase: al subir de fase o cada 40 mensajes ────────
-        try:
-            fase_actual = actualizar_fase()   # ya se llama abajo, pero necesitamos el valor
 
-            _disparar_evolucion = False
+def _diario_si_corresponde(msg_count, horas_gap):
+    # Trigger 1: nueva sesión (gap > 3hs desde el mensaje anterior)
+    # Trigger 2: cada 25 mensajes del usuario
+    if horas_gap >= 3 or (msg_count > 0 and msg_count % 25 == 0):
+        generar_diario_automatico()
 
-            # Trigger 1: la fase subió respecto a la última evolución guardada
-            with _get_conn(paths()['db']) as conn:
-                cursor = conn.cursor()
-                try:
-                    cursor.execute(
-                        'SELECT fase FROM evolucion_fases ORDER BY fase DESC LIMIT 1'
-                    )
-                    row = cursor.fetchone()
-                    fase_guardada = row[0] if row else 0
-                    if fase_actual > fase_guardada:
-                        _disparar_evolucion = True
-                except Exception:
-                    _disparar_evolucion = True   # tabla vacía → generar
-
-            # Trigger 2: cada 40 mensajes
-            if msg_count > 0 and msg_count % 40 == 0:
-                _disparar_evolucion = True
 
-            if _disparar_evolucion:
-                actualizar_evolucion_automatica(fase_actual)
-        except Exception as e:
-            print(f"⚠️ Error evolución automática: {e}")
+def _evolucion_si_corresponde(msg_count):
+    fase_actual = actualizar_fase()
 
+    _disparar_evolucion = False
+
+    # Trigger 1: la fase subió respecto a la última evolución guardada
+    with _get_conn(paths()['db']) as conn:
+        cursor = conn.cursor()
         try:
-            debe, motivo = _debe_regenerar_sintesis()
-            if debe:
-                _ejecutar_sintesis(motivo)
-        except Exception as e:
-            print(f"⚠️ Error síntesis: {e}")
+            cursor.execute(
+                'SELECT fase FROM evolucion_fases ORDER BY fase DESC LIMIT 1'
+            )
+            row = cursor.fetchone()
+            fase_guardada = row[0] if row else 0
+            if fase_actual > fase_guardada:
+                _disparar_evolucion = True
+        except Exception:
+            _disparar_evolucion = True   # tabla vacía → generar
 
-    escenario_id_actual = _get_escenario_id_actual()
-    actualizar_fase()
-    threading.Thread(
-        target=_post_proceso,
-        args=(mensaje, respuesta, escenario_id_actual),
-        daemon=True
-    ).start()
+    # Trigger 2: cada 40 mensajes
+    if msg_count > 0 and msg_count % 40 == 0:
+        _disparar_evolucion = True
 
-    return respuesta
+    if _disparar_evolucion:
+        actualizar_evolucion_automatica(fase_actual)
+
+
+def _sintesis_si_corresponde():
+    debe, motivo = _debe_regenerar_sintesis()
+    if debe:
+        _ejecutar_sintesis(motivo)
+
+
+def _trabajo_periodicos_turno(t):
+    """Backstory, diario, evolución de fase y síntesis, cada uno con su trigger."""
+    conteo = t.paso('conteo', _conteo_y_gap, t.payload['mensaje_id'])
+    if conteo is None:
+        return   # sin conteo no hay triggers: el trabajo se reintenta
+    msg_count, horas_gap = conteo
+
+    # ── Backstory cada 50 mensajes ─────────────────────────────────────
+    if msg_count > 0 and msg_count % 50 == 0:
+        t.paso('backstory', generar_backstory_automatico)
+
+    # ── Diario automático: nueva sesión (gap > 3hs) o cada 25 mensajes ─
+    t.paso('diario', _diario_si_corresponde, msg_count, horas_gap)
+
+    # ── Evolución de fase: al subir de fase o cada 40 mensajes ────────
+    t.paso('evolucion', _evolucion_si_corresponde, msg_count)
+
+    t.paso('sintesis', _sintesis_si_corresponde)
+
+
+registrar_tipo('memoria_turno', _trabajo_memoria_turno)
+registrar_tipo('periodicos_turno', _trabajo_periodicos_turno)
 
 
 
@@ -341,20 +623,16 @@ def _procesar_mensaje(mensaje):
 # SECCIÓN 7b: CONTINUAR — el personaje sigue sin input del usuario
 # ─────────────────────────────────────────────────────────────────────────────
 
-def _procesar_continuar():
-    """
-    El personaje continúa sin que el usuario haya escrito nada.
-    - NO guarda ningún mensaje del usuario.
-    - Extrae hechos de la respuesta, pero SIN apariencia física.
-    """
-    with _get_conn(paths()['db']) as conn:
+def _continuar_en_turno(pid):
+    """Historial, llamada al LLM y guardado de la respuesta de continuar. Devuelve (respuesta, id)."""
+    with _get_conn(paths(pid)['db']) as conn:
         cursor = conn.cursor()
         historial_limite = 20 if _get_modo_memoria() == 'roleplay' else 10
         cursor.execute('SELECT rol, contenido FROM mensajes ORDER BY id DESC LIMIT ?', (historial_limite,))
         historial = list(reversed(cursor.fetchall()))
 
-    system_prompt = obtener_system_prompt()  # sin mensaje — calibración neutral
-    contexto      = obtener_contexto('')
+    # Sin mensaje — calibración neutral; sin búsqueda
+    contexto, system_prompt, _ = _pre_respuesta(pid, '', buscar=False)
 
     instruccion = (
         "El usuario no ha escrito nada nuevo. Continuá naturalmente desde tu último mensaje "
@@ -368,50 +646,70 @@ def _procesar_continuar():
     if messages[-1]['role'] == 'assistant':
         messages.append({'role': 'user', 'content': '[continuar]'})
 
-    response  = llamada_mistral_segura(model=_get_modelo("chat"), messages=messages, max_tokens=600, temperature=0.88)
+    response  = llamada_mistral_segura(model=_get_modelo("chat"), messages=messages, max_tokens=600, temperature=0.88,
+                                       tarea='chat')
     respuesta = _recortar_respuesta(response.choices[0].message.content.strip())
 
-    with _get_conn(paths()['db']) as conn:
+    with _get_conn(paths(pid)['db']) as conn:
         cursor = conn.cursor()
         cursor.execute('INSERT INTO mensajes (rol, contenido, timestamp) VALUES (?, ?, ?)',
                        ('assistant', respuesta, now_argentina().isoformat()))
+        respuesta_id = cursor.lastrowid
+    return respuesta, respuesta_id
 
-    # En modo roleplay no tiene sentido extraer con mensaje vacío — genera falsos positivos.
-    # En modo compañero sí puede haber info útil en la respuesta del personaje.
-    modo_actual = _get_modo_memoria()
-    if modo_actual != 'roleplay':
-        try:
-            datos = extraer_informacion_con_ia('', respuesta)
-            categorias_excluidas = {'apariencia', 'estado_actual', 'momentos'}
-            datos_filtrados = [d for d in datos if d.get('categoria') not in categorias_excluidas]
-            if datos_filtrados:
-                guardar_memoria_permanente(datos_filtrados)
-        except Exception as e:
-            print(f"⚠️ Error extracción continuar: {e}")
 
-    try:
-        embedding_id = agregar_embedding(f"Personaje continúa: {respuesta}", 'episodio_continuar')
-        escenario_id_actual = _get_escenario_id_actual()
-
-        with _get_conn(paths()['db']) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''INSERT OR IGNORE INTO memoria_episodica
-                (contenido_usuario, contenido_hiro, fecha, embedding_id, escenario_id)
-                VALUES (?, ?, ?, ?, ?)''',
-                ('[continuar]', respuesta, now_argentina().isoformat(),
-                 embedding_id, escenario_id_actual))
-            episodio_id_cont = cursor.lastrowid
-
-        if episodio_id_cont:
+def _procesar_continuar():
+    """
+    El personaje continúa sin que el usuario haya escrito nada.
+    - NO guarda ningún mensaje del usuario.
+    - Extrae hechos de la respuesta, pero SIN apariencia física.
+    """
+    pid = get_personaje_activo_id()
+    # Todo el continuar con el personaje fijado: si cambian de personaje mientras
+    # espera su turno, modo, escenario y fase siguen siendo los de este
+    with personaje_del_hilo(pid):
+        # Historial → respuesta → INSERT como un turno más de la fila del personaje
+        with turno_exclusivo(pid):
+            respuesta, respuesta_id = _continuar_en_turno(pid)
+
+        # En modo roleplay no tiene sentido extraer con mensaje vacío — genera falsos positivos.
+        # En modo compañero sí puede haber info útil en la respuesta del personaje.
+        modo_actual = _get_modo_memoria()
+        if modo_actual != 'roleplay':
             try:
-                _enriquecer_episodio(episodio_id_cont, '[continuar]', respuesta)
+                datos = extraer_informacion_con_ia('', respuesta)
+                categorias_excluidas = {'apariencia', 'estado_actual', 'momentos'}
+                datos_filtrados = [d for d in datos if d.get('categoria') not in categorias_excluidas]
+                if datos_filtrados:
+                    guardar_memoria_permanente(datos_filtrados, pid=pid)
             except Exception as e:
-                print(f"⚠️ Error enriquecimiento episódico (continuar): {e}")
-    except Exception as e:
-        print(f"⚠️ Error episodio continuar: {e}")
+                print(f"⚠️ Error extracción continuar: {e}")
 
-    actualizar_fase()
-    return respuesta
+        try:
+            embedding_id = agregar_embedding(f"Personaje continúa: {respuesta}", 'episodio_continuar', pid=pid)
+            escenario_id_actual = _get_escenario_id_actual()
+
+            with _get_conn(paths(pid)['db']) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''INSERT OR IGNORE INTO memoria_episodica
+                    (contenido_usuario, contenido_hiro, fecha, embedding_id, escenario_id)
+                    VALUES (?, ?, ?, ?, ?)''',
+                    ('[continuar]', respuesta, now_argentina().isoformat(),
+                     embedding_id, escenario_id_actual))
+                episodio_id_cont = cursor.lastrowid
+                cursor.execute('UPDATE mensajes SET embedding_id = ? WHERE id = ?',
+                               (embedding_id, respuesta_id))
+
+            if episodio_id_cont:
+                try:
+                    _enriquecer_episodio(episodio_id_cont, '[continuar]', respuesta)
+                except Exception as e:
+                    print(f"⚠️ Error enriquecimiento episódico (continuar): {e}")
+        except Exception as e:
+            print(f"⚠️ Error episodio continuar: {e}")
+
+        actualizar_fase()
+        return respuesta
 
 
 # ─────────────────────────────────────────────────────────────────────────────
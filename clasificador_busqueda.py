@@ -0,0 +1,265 @@
+# ═══════════════════════════════════════════════════════════════════════════
+# CLASIFICADOR_BUSQUEDA.PY — ¿Este mensaje necesita buscar en internet?
+# Filtro local, sin latencia, delante de chat_engine._detectar_query_busqueda:
+# la mayoría de los mensajes son charla y no hace falta una llamada al LLM
+# para saberlo.
+#
+#   1. Heurística: solo charla evidente (una acción de roleplay *...* o un
+#      mensaje que es puro saludo) → no se busca. Que un mensaje no tenga
+#      señales (tema de medios, pregunta, año, nombre propio, comillas) no
+#      alcanza: "me encanta dune" no tiene ninguna y puede necesitar búsqueda.
+#   2. Modelo: Naive Bayes sobre palabras, bigramas y las señales anteriores,
+#      entrenado con las decisiones del LLM (aprender()) y guardado en
+#      data/clasificador_busqueda.json (uno por instalación). Con suficientes
+#      muestras decide solo los casos claros: prob ≤ umbral bajo → no,
+#      prob ≥ umbral alto → sí (query armada localmente con query_local()).
+#   3. Lo dudoso sigue yendo al LLM, que además le enseña al modelo.
+#
+# Métricas (stats_clasificador, GET /api/busqueda/clasificador): tasa de
+# mensajes resueltos sin LLM, precisión / recall del atajo medidos con una
+# muestra auditada por el LLM, y calibración del modelo por tramo de
+# probabilidad para ajustar los umbrales.
+#
+# Independiente: solo stdlib. La config la pasa chat_engine.py.
+# ═══════════════════════════════════════════════════════════════════════════
+
+import os
+import re
+import json
+import math
+import threading
+import unicodedata
+
+RUTA = './data/clasificador_busqueda.json'
+
+NO, SI, DUDOSO = 'no', 'si', 'dudoso'
+
+_LOG_CADA = 25   # decisiones entre cada línea de métricas en el log
+
+# ── Señales ──────────────────────────────────────────────────────────────────
+# Temas de "dato concreto" (los BUSCAR SÍ del prompt del detector), sin tildes
+_MEDIOS = {
+    'serie', 'series', 'pelicula', 'peliculas', 'peli', 'pelis', 'temporada', 'temporadas',
+    'capitulo', 'capitulos', 'episodio', 'episodios', 'elenco', 'actor', 'actriz', 'director',
+    'estreno', 'estrena', 'estrenan', 'lanzamiento', 'sale', 'salio', 'saldra',
+    'cancion', 'canciones', 'letra', 'album', 'disco', 'artista', 'banda', 'cantante', 'gira',
+    'concierto', 'recital', 'libro', 'libros', 'novela', 'autor', 'saga', 'manga', 'anime',
+    'videojuego', 'videojuegos', 'juego', 'consola', 'netflix', 'spotify', 'youtube',
+    'noticia', 'noticias', 'evento', 'partido', 'mundial', 'torneo', 'campeonato', 'elecciones',
+    'resultado', 'precio', 'clima', 'pronostico', 'viendo', 'escuchando', 'leyendo', 'jugando',
+}
+_PREGUNTAS = {'que', 'quien', 'quienes', 'cuando', 'donde', 'cuanto', 'cuantos', 'cuantas', 'cual', 'cuales'}
+_SALUDOS = {'hola', 'holi', 'buenas', 'hey', 'chau', 'adios', 'gracias', 'jaja', 'jajaja', 'ok', 'dale', 'si', 'no'}
+_VACIAS = {
+    'el', 'la', 'los', 'las', 'un', 'una', 'unos', 'unas', 'de', 'del', 'al', 'a', 'en', 'y', 'o',
+    'que', 'es', 'me', 'te', 'se', 'lo', 'le', 'mi', 'tu', 'vos', 'yo', 'por', 'para', 'con',
+    'sabes', 'sabias', 'conoces', 'contame', 'decime', 'viste', 'che', 'hey', 'oye', 'porfa',
+}
+_PALABRA = re.compile(r"[a-z0-9ñ]+")
+_NOMBRE_PROPIO = re.compile(r"(?<![.!?¡¿]\s)(?<!^)\b[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+")
+_ANIO = re.compile(r"\b(19[5-9]\d|20\d\d)\b")
+
+
+def _normalizar(texto):
+    texto = unicodedata.normalize('NFD', texto.lower())
+    return ''.join(c for c in texto if unicodedata.category(c) != 'Mn')
+
+
+def _senales(mensaje):
+    """Señales de 'dato concreto' del mensaje (pseudo-palabras que también ve el modelo)."""
+    plano = _normalizar(mensaje)
+    palabras = _PALABRA.findall(plano)
+    senales = set()
+    if any(p in _MEDIOS for p in palabras):
+        senales.add('__medios__')
+    if '?' in mensaje or (palabras and palabras[0] in _PREGUNTAS):
+        senales.add('__pregunta__')
+    if _ANIO.search(mensaje):
+        senales.add('__anio__')
+    if _NOMBRE_PROPIO.search(mensaje.strip()):
+        senales.add('__nombre_propio__')
+    if '"' in mensaje or '“' in mensaje or '«' in mensaje:   # el apóstrofo no: aparece en cualquier contracción
+        senales.add('__comillas__')
+    return palabras, senales
+
+
+def _rasgos(mensaje):
+    palabras, senales = _senales(mensaje)
+    rasgos = set(palabras) | {f'{a}_{b}' for a, b in zip(palabras, palabras[1:])} | senales
+    return rasgos, palabras, senales
+
+
+def _obvio_conversacional(mensaje, palabras):
+    """Charla evidente: mensaje vacío, acción de roleplay (*...*) o puro saludo."""
+    texto = mensaje.strip()
+    if not palabras or (texto.startswith('*') and texto.endswith('*')):
+        return True
+    return all(p in _SALUDOS for p in palabras)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# MODELO (Naive Bayes binario, persistido en JSON)
+# ─────────────────────────────────────────────────────────────────────────────
+
+_lock = threading.Lock()
+_modelo = None   # {'docs': [no, si], 'rasgos': {rasgo: [no, si]}}
+_metricas = {
+    'decisiones': 0, 'no_heuristica': 0, 'no_modelo': 0, 'si_modelo': 0, 'escaladas': 0,
+    'auditoria': {'vp': 0, 'fp': 0, 'vn': 0, 'fn': 0},   # atajo local vs LLM
+    'calibracion': [[0, 0] for _ in range(10)],          # por décima de prob: [muestras, sí del LLM]
+}
+
+
+def _cargar():
+    global _modelo
+    if _modelo is not None:
+        return _modelo
+    _modelo = {'docs': [0, 0], 'rasgos': {}}
+    if os.path.exists(RUTA):
+        try:
+            with open(RUTA, 'r', encoding='utf-8') as f:
+                datos = json.load(f)
+            if isinstance(datos.get('docs'), list) and isinstance(datos.get('rasgos'), dict):
+                _modelo = datos
+        except Exception as e:
+            print(f"⚠️ Clasificador de búsqueda ilegible, se reentrena desde cero: {e}")
+    return _modelo
+
+
+def _guardar(modelo):
+    try:
+        os.makedirs(os.path.dirname(RUTA), exist_ok=True)
+        tmp = RUTA + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(modelo, f, ensure_ascii=False)
+        os.replace(tmp, RUTA)
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar el clasificador de búsqueda: {e}")
+
+
+def _probabilidad(modelo, rasgos):
+    """P(necesita búsqueda | rasgos) con suavizado de Laplace. None sin muestras de ambas clases."""
+    no, si = modelo['docs']
+    if not no or not si:
+        return None
+    log_odds = math.log(si / no)
+    for r in rasgos:
+        c_no, c_si = modelo['rasgos'].get(r, (0, 0))
+        log_odds += math.log((c_si + 1) / (si + 2)) - math.log((c_no + 1) / (no + 2))
+    return 1 / (1 + math.exp(-max(-30.0, min(30.0, log_odds))))
+
+
+def muestras():
+    """Decisiones del LLM con las que se entrenó el modelo."""
+    with _lock:
+        return sum(_cargar()['docs'])
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# API
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _log_periodico():
+    if _metricas['decisiones'] % _LOG_CADA == 0:
+        s = _resumen()
+        print(f"🔎 Clasificador de búsqueda: {s['tasa_sin_llm']:.0%} sin LLM en {s['decisiones']} mensajes"
+              + (f", precisión {s['precision']}, recall {s['recall']} ({s['auditadas']} auditadas)"
+                 if s['auditadas'] else ""))
+
+
+def clasificar(mensaje, umbral_bajo=0.15, umbral_alto=0.9, min_muestras=30):
+    """
+    Devuelve (decision, prob): NO / SI si el caso es claro, DUDOSO si hay que
+    preguntarle al LLM. prob es la del modelo (None si todavía no decide).
+    """
+    rasgos, palabras, _ = _rasgos(mensaje or '')
+    with _lock:
+        modelo = _cargar()
+        prob = _probabilidad(modelo, rasgos) if sum(modelo['docs']) >= min_muestras else None
+        _metricas['decisiones'] += 1
+        if _obvio_conversacional(mensaje or '', palabras):
+            decision = NO
+            _metricas['no_heuristica'] += 1
+        elif prob is not None and prob <= umbral_bajo:
+            decision = NO
+            _metricas['no_modelo'] += 1
+        elif prob is not None and prob >= umbral_alto:
+            decision = SI
+            _metricas['si_modelo'] += 1
+        else:
+            decision = DUDOSO
+            _metricas['escaladas'] += 1
+        _log_periodico()
+    return decision, prob
+
+
+def query_local(mensaje, max_palabras=8):
+    """Query de búsqueda armada sin LLM: el mensaje sin muletillas ni palabras vacías."""
+    palabras = re.findall(r"[\wÁÉÍÓÚÑáéíóúñ'’-]+", mensaje)
+    utiles = [p for p in palabras if _normalizar(p) not in _VACIAS]
+    return ' '.join((utiles or palabras)[:max_palabras]) or None
+
+
+def aprender(mensaje, necesita):
+    """
+    Suma una decisión del LLM al modelo y a la calibración (la probabilidad
+    se mide ANTES de aprender el ejemplo: es una evaluación honesta).
+    """
+    rasgos, _, _ = _rasgos(mensaje or '')
+    clase = 1 if necesita else 0
+    with _lock:
+        modelo = _cargar()
+        prob = _probabilidad(modelo, rasgos)
+        if prob is not None:
+            tramo = _metricas['calibracion'][min(9, int(prob * 10))]
+            tramo[0] += 1
+            tramo[1] += clase
+        modelo['docs'][clase] += 1
+        for r in rasgos:
+            modelo['rasgos'].setdefault(r, [0, 0])[clase] += 1
+        copia = json.loads(json.dumps(modelo))
+    _guardar(copia)
+
+
+def registrar_auditoria(decision, necesita):
+    """Un atajo local (NO / SI) que el LLM revisó de fondo: suma a precisión / recall."""
+    with _lock:
+        a = _metricas['auditoria']
+        if decision == SI:
+            a['vp' if necesita else 'fp'] += 1
+        else:
+            a['fn' if necesita else 'vn'] += 1
+
+
+def _resumen():
+    m = _metricas
+    a = m['auditoria']
+    sin_llm = m['no_heuristica'] + m['no_modelo'] + m['si_modelo']
+    return {
+        'decisiones': m['decisiones'],
+        'tasa_sin_llm': round(sin_llm / m['decisiones'], 3) if m['decisiones'] else 0.0,
+        'auditadas': sum(a.values()),
+        # Precisión: de los "sí" locales, cuántos confirmó el LLM.
+        # Recall: de lo que el LLM hubiera buscado, cuánto buscó el atajo.
+        'precision': round(a['vp'] / (a['vp'] + a['fp']), 3) if a['vp'] + a['fp'] else None,
+        'recall': round(a['vp'] / (a['vp'] + a['fn']), 3) if a['vp'] + a['fn'] else None,
+    }
+
+
+def stats_clasificador():
+    """Decisiones por camino, precisión / recall auditados y calibración del modelo por tramo."""
+    with _lock:
+        resumen = _resumen()
+        m = json.loads(json.dumps(_metricas))
+        docs = list(_cargar()['docs'])
+    resumen.update({
+        'por_camino': {k: m[k] for k in ('no_heuristica', 'no_modelo', 'si_modelo', 'escaladas')},
+        'auditoria': m['auditoria'],
+        'muestras_modelo': {'no': docs[0], 'si': docs[1]},
+        'calibracion': [
+            {'prob': f'{i / 10:.1f}-{(i + 1) / 10:.1f}', 'muestras': n,
+             'tasa_si_llm': round(s / n, 3) if n else None}
+            for i, (n, s) in enumerate(m['calibracion'])
+        ],
+    })
+    return resumen
@@ -0,0 +1,340 @@
+# ═══════════════════════════════════════════════════════════════════════════
+# LIMITADOR.PY — Límite de requests por minuto y cola de llamadas LLM
+# Una cubeta por proveedor (rpmLimit de api_config.json) y, si se configura,
+# una por modelo (modelRpm). Compartidas por todo el proceso: chat, post-proceso,
+# embeddings y reindexado pasan por las mismas.
+#
+# Con queueEnabled, además, las llamadas a un LLM piden un cupo de concurrencia
+# del proveedor (maxConcurrent) con turno(): nunca hay más de N en vuelo, y
+# una llamada de fondo que esperó más que su plazo se descarta sin enviarse.
+#
+# Quien no consigue ficha o cupo espera en una cola ordenada por (prioridad,
+# llegada): FIFO dentro de cada clase, y el trabajo de fondo cede el paso a
+# la llamada que el usuario está esperando.
+#
+# Independiente: solo stdlib. utils.py lee la config y llama a adquirir() / turno().
+# ═══════════════════════════════════════════════════════════════════════════
+
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+
+# ── Clases de prioridad (menor = antes) ──────────────────────────────────────
+INTERACTIVA   = 0   # chat, continuar: la respuesta que el usuario está esperando
+EXTRACCION    = 1   # extracción de hechos, menciones, emoción del turno
+ANALISIS      = 2   # enriquecimiento, síntesis, diario, backstory, evolución
+SEGUNDO_PLANO = 3   # el resto del post-proceso, reindexado
+CLASES = ('interactiva', 'extraccion', 'analisis', 'segundo_plano')   # nombre por clase
+
+
+class LlamadaDescartada(Exception):
+    """Una llamada de fondo superó su plazo esperando en la cola y no se envió."""
+
+_RAFAGA_SEGUNDOS = 10   # capacidad de la cubeta: lo que se junta en 10 s de tasa
+
+_local   = threading.local()
+_cubetas = {}                    # clave → _Cubeta
+_cubetas_lock = threading.Lock()
+_llegadas = itertools.count()    # desempate FIFO dentro de una misma prioridad
+
+
+class _Cubeta:
+    """Token bucket con cola de espera por prioridad."""
+
+    def __init__(self, rpm):
+        self.cond    = threading.Condition()
+        self.cola    = []       # heap de (prioridad, llegada)
+        self.esperas = 0        # llamadas que tuvieron que esperar
+        self.esperado = 0.0     # segundos esperados en total
+        self.ajustar(rpm)
+        self.fichas  = self.capacidad
+        self.t       = time.monotonic()
+
+    def ajustar(self, rpm):
+        self.rpm       = rpm
+        self.tasa      = rpm / 60.0
+        self.capacidad = max(1.0, self.tasa * _RAFAGA_SEGUNDOS)
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        self.fichas = min(self.capacidad, self.fichas + (ahora - self.t) * self.tasa)
+        self.t = ahora
+
+    def adquirir(self, prioridad, plazo=None):
+        """
+        Bloquea hasta conseguir una ficha. Devuelve los segundos esperados,
+        o None si antes se llegó a `plazo` (time.monotonic()) sin conseguirla.
+        """
+        inicio = time.monotonic()
+        with self.cond:
+            turno = (prioridad, next(_llegadas))
+            heapq.heappush(self.cola, turno)
+            if self.cola[0] == turno:
+                self.cond.notify_all()   # el que era primero ya no lo es
+            try:
+                while True:
+                    self._recargar()
+                    if self.cola[0] == turno and self.fichas >= 1:
+                        self.fichas -= 1
+                        break
+                    if not _esperar(self.cond, plazo,
+                                    (1 - self.fichas) / self.tasa if self.cola[0] == turno else None):
+                        return None
+            finally:
+                # Salir de la cola (también si la espera se interrumpe) y despertar al siguiente
+                self.cola.remove(turno)
+                heapq.heapify(self.cola)
+                self.cond.notify_all()
+            esperado = time.monotonic() - inicio
+            if esperado > 0.001:
+                self.esperas  += 1
+                self.esperado += esperado
+            return esperado
+
+    def espera_estimada(self):
+        """Segundos que esperaría una llamada nueva detrás de la cola actual."""
+        with self.cond:
+            self._recargar()
+            faltan = len(self.cola) + 1 - self.fichas
+            return max(0.0, faltan / self.tasa)
+
+
+def _esperar(cond, plazo, espera=None):
+    """
+    cond.wait() hasta `espera` segundos (None = hasta que avisen) sin pasar de
+    `plazo`. Devuelve False si el plazo ya venció.
+    Solo el primero de una cola duerme con tiempo; el resto espera aviso.
+    """
+    if plazo is not None:
+        restante = plazo - time.monotonic()
+        if restante <= 0:
+            return False
+        espera = restante if espera is None else min(espera, restante)
+    cond.wait(espera)
+    return True
+
+
+def _cubeta(clave, rpm):
+    with _cubetas_lock:
+        cubeta = _cubetas.get(clave)
+        if cubeta is None:
+            cubeta = _cubetas[clave] = _Cubeta(rpm)
+        elif cubeta.rpm != rpm:
+            with cubeta.cond:
+                cubeta.ajustar(rpm)   # cambió rpmLimit en la config
+        return cubeta
+
+
+def adquirir(limites, prioridad=None, plazo=None):
+    """
+    Consume una ficha de cada cubeta de `limites` (lista de (clave, rpm); las
+    de rpm falsy se ignoran), esperando en cola lo que haga falta.
+    prioridad: una de las clases (None = la del hilo, ver con_prioridad()).
+    plazo: time.monotonic() límite; si se llega antes de tener todas las
+    fichas devuelve None. Si no, los segundos esperados en total.
+    """
+    if prioridad is None:
+        prioridad = prioridad_actual()
+    esperado = 0.0
+    for clave, rpm in limites:
+        if rpm and rpm > 0:
+            espera = _cubeta(clave, float(rpm)).adquirir(prioridad, plazo)
+            if espera is None:
+                return None
+            esperado += espera
+    return esperado
+
+
+def espera_estimada(clave):
+    """Segundos que esperaría hoy una llamada nueva en la cubeta `clave` (0 si no existe)."""
+    with _cubetas_lock:
+        cubeta = _cubetas.get(clave)
+    return cubeta.espera_estimada() if cubeta else 0.0
+
+
+def stats_limitador():
+    """Estado de cada cubeta: rpm, fichas, cola, espera estimada y esperas acumuladas."""
+    with _cubetas_lock:
+        cubetas = dict(_cubetas)
+    resultado = {}
+    for clave, c in sorted(cubetas.items()):
+        espera = c.espera_estimada()
+        with c.cond:
+            resultado[clave] = {
+                'rpm': c.rpm,
+                'fichas': round(c.fichas, 2),
+                'en_cola': len(c.cola),
+                'en_cola_interactiva': sum(1 for p, _ in c.cola if p == INTERACTIVA),
+                'espera_s': round(espera, 2),
+                'esperas': c.esperas,
+                'esperado_total_s': round(c.esperado, 2),
+            }
+    return resultado
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# COLA DE LLAMADAS LLM (queueEnabled)
+# Cupos de concurrencia por proveedor, repartidos por prioridad, con plazo
+# para las clases de fondo. Métricas por (proveedor, clase).
+# ─────────────────────────────────────────────────────────────────────────────
+
+class _Cupos:
+    """Semáforo de N cupos que se entregan por (prioridad, llegada)."""
+
+    def __init__(self, n):
+        self.cond     = threading.Condition()
+        self.cola     = []     # heap de (prioridad, llegada)
+        self.en_curso = [0] * len(CLASES)
+        self.n        = n
+
+    def adquirir(self, prioridad, plazo=None):
+        """
+        Bloquea hasta tener cupo. False si antes se llegó a `plazo`.
+        Con más de un cupo, uno queda reservado para la clase INTERACTIVA:
+        una ráfaga de trabajo de fondo no hace esperar a la próxima respuesta.
+        """
+        with self.cond:
+            turno = (prioridad, next(_llegadas))
+            heapq.heappush(self.cola, turno)
+            try:
+                while True:
+                    limite = self.n if prioridad == INTERACTIVA or self.n == 1 else self.n - 1
+                    if self.cola[0] == turno and sum(self.en_curso) < limite:
+                        break
+                    if not _esperar(self.cond, plazo):
+                        return False
+                self.en_curso[prioridad] += 1
+                return True
+            finally:
+                self.cola.remove(turno)
+                heapq.heapify(self.cola)
+                self.cond.notify_all()
+
+    def liberar(self, prioridad):
+        with self.cond:
+            self.en_curso[prioridad] -= 1
+            self.cond.notify_all()
+
+
+_cupos      = {}    # proveedor → _Cupos
+_cupos_lock = threading.Lock()
+_metricas   = {}    # (proveedor, clase) → contadores
+
+
+def _cupos_de(proveedor, n):
+    with _cupos_lock:
+        cupos = _cupos.get(proveedor)
+        if cupos is None:
+            cupos = _cupos[proveedor] = _Cupos(n)
+        elif cupos.n != n:
+            with cupos.cond:
+                cupos.n = n   # cambió maxConcurrent en la config
+                cupos.cond.notify_all()
+        return cupos
+
+
+def _contar(proveedor, prioridad, campo, valor=1):
+    with _cupos_lock:
+        m = _metricas.setdefault((proveedor, prioridad),
+                                 {'atendidas': 0, 'descartadas': 0, 'esperado_total_s': 0.0})
+        m[campo] += valor
+
+
+@contextmanager
+def turno(proveedor, limites, max_concurrentes=None, plazos=None, prioridad=None):
+    """
+    Envuelve UNA llamada a un LLM: toma un cupo de concurrencia del proveedor
+    (si max_concurrentes) y las fichas de `limites` (ver adquirir()), y
+    devuelve el cupo al salir.
+    plazos: {clase: segundos} de espera máxima en la cola para las clases de
+    fondo; si se vence, la llamada no se envía y se lanza LlamadaDescartada.
+    La clase INTERACTIVA nunca se descarta.
+    """
+    if prioridad is None:
+        prioridad = prioridad_actual()
+    inicio = time.monotonic()
+    segundos = (plazos or {}).get(CLASES[prioridad]) if prioridad > INTERACTIVA else None
+    plazo = inicio + segundos if segundos else None
+    cupos = _cupos_de(proveedor, int(max_concurrentes)) if max_concurrentes else None
+    if cupos and not cupos.adquirir(prioridad, plazo):
+        _descartar(proveedor, prioridad, inicio)
+    try:
+        if adquirir(limites, prioridad, plazo) is None:
+            _descartar(proveedor, prioridad, inicio)
+        _contar(proveedor, prioridad, 'atendidas')
+        _contar(proveedor, prioridad, 'esperado_total_s', time.monotonic() - inicio)
+        yield
+    finally:
+        if cupos:
+            cupos.liberar(prioridad)
+
+
+def _descartar(proveedor, prioridad, inicio):
+    _contar(proveedor, prioridad, 'descartadas')
+    espera = time.monotonic() - inicio
+    print(f"🗑️ [{proveedor}] llamada '{CLASES[prioridad]}' descartada tras {espera:.0f}s en cola")
+    raise LlamadaDescartada(f"{CLASES[prioridad]}: {espera:.0f}s en cola de {proveedor}")
+
+
+def stats_cola():
+    """
+    Por proveedor: cupos, en curso y, por clase, en cola / en curso /
+    atendidas / descartadas / espera media.
+    """
+    with _cupos_lock:
+        cupos    = dict(_cupos)
+        metricas = {k: dict(v) for k, v in _metricas.items()}
+    resultado = {}
+    for proveedor in sorted({p for p, _ in metricas} | set(cupos)):
+        c = cupos.get(proveedor)
+        clases = {}
+        if c:
+            with c.cond:
+                en_cola  = [sum(1 for p, _ in c.cola if p == i) for i in range(len(CLASES))]
+                en_curso = list(c.en_curso)
+        else:
+            en_cola = en_curso = [0] * len(CLASES)
+        for i, nombre in enumerate(CLASES):
+            m = metricas.get((proveedor, i), {'atendidas': 0, 'descartadas': 0, 'esperado_total_s': 0.0})
+            clases[nombre] = {
+                'en_cola': en_cola[i],
+                'en_curso': en_curso[i],
+                'atendidas': m['atendidas'],
+                'descartadas': m['descartadas'],
+                'espera_media_s': round(m['esperado_total_s'] / m['atendidas'], 2) if m['atendidas'] else 0.0,
+            }
+        resultado[proveedor] = {
+            'cupos': c.n if c else None,
+            'en_curso': sum(en_curso),
+            'clases': clases,
+        }
+    return resultado
+
+
+# ── Prioridad del hilo actual ────────────────────────────────────────────────
+
+def prioridad_actual():
+    return getattr(_local, 'prioridad', INTERACTIVA)
+
+
+@contextmanager
+def con_prioridad(prioridad):
+    """
+    Todo lo que se llame adentro (LLM, embeddings) espera con esta prioridad,
+    salvo que el hilo ya tenga una más urgente: una síntesis pedida desde la UI
+    sigue siendo interactiva aunque la función se declare de análisis.
+    """
+    anterior = prioridad_actual()
+    _local.prioridad = min(anterior, prioridad)
+    try:
+        yield
+    finally:
+        _local.prioridad = anterior
+
+
+def en_segundo_plano(fn, *args, **kwargs):
+    """Ejecuta fn con prioridad SEGUNDO_PLANO (para usar como target de un Thread)."""
+    _local.prioridad = SEGUNDO_PLANO
+    return fn(*args, **kwargs)
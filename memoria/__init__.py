@@ -11,15 +11,31 @@
 # ── FAISS y embeddings ────────────────────────────────────────────────────────
 from .faiss_store import (
     faiss_index,
-    embeddings_metadata,
     init_faiss_personaje,
     guardar_faiss,
     get_faiss_ntotal,
     limpiar_faiss_episodios,
+    vaciar_faiss,
+    eliminar_embeddings,
     cargar_personaje,
     obtener_embedding,
+    obtener_embeddings_batch,
     agregar_embedding,
+    agregar_embeddings_batch,
     buscar_contexto_relevante,
+    evaluar_recall_faiss,
+    convertir_almacenamiento_faiss,
+)
+
+# ── Caché persistente de embeddings ───────────────────────────────────────────
+from .cache_embeddings import (
+    stats_cache_embeddings,
+)
+
+# ── Re-embebido al cambiar de modelo ──────────────────────────────────────────
+from .reindexado import (
+    iniciar_reindexado,
+    estado_reindexado,
 )
 
 # ── Extracción de información ─────────────────────────────────────────────────
@@ -27,6 +43,7 @@ from .extraccion import (
     _get_modo_memoria,
     extraer_informacion_con_ia,
     extraer_menciones_casuales,
+    guardar_menciones_casuales,
     _detectar_y_cerrar_hilos,
     guardar_memoria_permanente,
 )
@@ -34,6 +51,12 @@ from .extraccion import (
 # ── Enriquecimiento episódico ─────────────────────────────────────────────────
 from .enriquecimiento import (
     _enriquecer_episodio,
+    guardar_enriquecimiento,
+)
+
+# ── Análisis unificado del turno (hechos + menciones + episodio + emoción) ───
+from .analisis_turno import (
+    analizar_turno,
 )
 
 # ── Síntesis de conocimiento ──────────────────────────────────────────────────
@@ -48,6 +71,7 @@ from .sintesis import (
 # ── Sistema emocional y conciencia temporal ───────────────────────────────────
 from .emocional import (
     detectar_emocion,
+    guardar_emocion,
     generar_backstory_automatico,
     _get_gap_sesion,
     _get_tendencia_emocional,
@@ -71,10 +95,16 @@ from .contexto import (
 
 __all__ = [
     # faiss_store
-    'faiss_index', 'embeddings_metadata',
+    'faiss_index',
     'init_faiss_personaje', 'guardar_faiss', 'get_faiss_ntotal',
-    'limpiar_faiss_episodios', 'cargar_personaje',
-    'obtener_embedding', 'agregar_embedding', 'buscar_contexto_relevante',
+    'limpiar_faiss_episodios', 'vaciar_faiss', 'eliminar_embeddings', 'cargar_personaje',
+    'obtener_embedding', 'obtener_embeddings_batch',
+    'agregar_embedding', 'agregar_embeddings_batch', 'buscar_contexto_relevante',
+    'evaluar_recall_faiss', 'convertir_almacenamiento_faiss',
+    # cache_embeddings
+    'stats_cache_embeddings',
+    # reindexado
+    'iniciar_reindexado', 'estado_reindexado',
     # extraccion
     '_get_modo_memoria', 'extraer_informacion_con_ia',
     'extraer_menciones_casuales', '_detectar_y_cerrar_hilos',
@@ -0,0 +1,175 @@
+# ═══════════════════════════════════════════════════════════════════════════
+# MEMORIA/ANALISIS_TURNO.PY — Análisis unificado del turno
+# analizar_turno: UNA llamada con JSON estructurado que devuelve, para el
+# par usuario/personaje recién guardado, lo que antes pedían cuatro llamadas
+# separadas del post-proceso:
+#
+#   hechos     → extraer_informacion_con_ia()  (extraccion.py)
+#   menciones  → extraer_menciones_casuales()  (extraccion.py)
+#   episodio   → _enriquecer_episodio()        (enriquecimiento.py)
+#   emocion    → detectar_emocion()            (emocional.py)
+#
+# Cada sección se valida por separado: la que falte o venga mal queda en
+# None y chat_engine.py llama a la función dedicada SOLO para esa sección.
+# Los datos válidos se escriben con los mismos writers de siempre
+# (guardar_memoria_permanente, guardar_menciones_casuales,
+# guardar_enriquecimiento, guardar_emocion).
+#
+# Se desactiva con "consolidatedAnalysis": false en api_config.json.
+#
+# Modificar acá si querés:
+#   - Cambiar el prompt unificado (_prompt_unificado)
+#   - Cambiar qué se considera válido en cada sección (_validar_*)
+# ═══════════════════════════════════════════════════════════════════════════
+
+from utils import llamada_mistral_segura, cargar_config_apis
+from limitador import EXTRACCION
+from ._helpers import _limpiar_json
+from .extraccion import _get_modelo, _get_modo_memoria, _filtrar_hechos, _menciones_posibles
+
+
+_SECCIONES = ('hechos', 'menciones', 'episodio', 'emocion')
+
+_CATEGORIAS = {
+    'compañero': 'identidad | apariencia | vida | trabajo_estudio | familia | rutina | salud | '
+                 'relaciones | personalidad | intereses | objetivos | sueños | estado_actual | '
+                 'momentos | intimidad | historial_intimo',
+    'roleplay':  'identidad | apariencia | vida | relaciones | personalidad | intereses | '
+                 'objetivos | estado_actual | momentos | intimidad | historial_intimo',
+}
+
+
+def _prompt_unificado(mensaje_usuario, respuesta_personaje, modo):
+    categorias = _CATEGORIAS.get(modo, _CATEGORIAS['roleplay'])
+    return f"""Sos el sistema de memoria de un chat de {'compañero virtual' if modo == 'compañero' else 'roleplay'}. Analizás UN intercambio y devolvés todo el análisis de una vez.
+Respondé SIEMPRE en español. Devolvé SOLO un objeto JSON, sin markdown ni texto adicional.
+
+MENSAJE DEL USUARIO:
+\"\"\"{mensaje_usuario}\"\"\"
+
+RESPUESTA DEL PERSONAJE:
+\"\"\"{respuesta_personaje}\"\"\"
+
+━━━ 1. "hechos" — array de datos para la memoria permanente ━━━
+a) Datos REALES del usuario: SOLO lo que el USUARIO escribió explícitamente sobre sí mismo.
+   Nunca inferencias u observaciones del personaje ("parecés tenso" NO es un dato).
+   Si un dato aparece solo en la respuesta del personaje, NO lo extraigas.
+   Acciones de roleplay puras (*sonríe*) y saludos no aportan datos.
+b) Momentos relacionales: solo si ocurrió algo con peso emocional real dicho o hecho
+   externamente (confesión, declaración de afecto, primer contacto significativo).
+   Los pensamientos entre ((...)) no cuentan.
+Categorías permitidas: {categorias}
+Cada elemento: {{"categoria": "...", "clave": "palabra clave estable y canónica (nombre, edad, ciudad...)", "valor": "texto corto", "contexto": "opcional", "confianza": 0-100}}
+Si no estás 100% seguro de que un dato es real y explícito, NO LO INCLUYAS. Si no hay nada: []
+
+━━━ 2. "menciones" — temas que el usuario mencionó DE PASADA ━━━
+Actividades ("fui al gym"), estado ("no dormí bien"), contenido consumido ("estaba viendo una serie"), planes ("mañana tengo que...").
+No: saludos, respuestas sin contenido propio, acciones de roleplay, lo que ya es el tema principal.
+Cada elemento: {{"tema": "tema corto", "mencion": "frase exacta del usuario", "confianza": 50}}. Máximo 3. Si no hay: []
+
+━━━ 3. "episodio" — análisis del intercambio ━━━
+{{"resumen": "una oración de máximo 20 palabras", "temas": ["tema1", "tema2"], "emocion": "curiosidad|alegría|tristeza|nerviosismo|intimidad|indiferencia|sorpresa|neutro", "importancia": 1-10}}
+Importancia, sé estricto: 1-2 saludo o acción sin contenido · 3-4 pregunta simple · 5-6 contenido real ·
+7-8 momento significativo (confesión, dato personal importante) · 9-10 momento clave (declaración de afecto, vulnerabilidad profunda).
+
+━━━ 4. "emocion" — emoción del MENSAJE DEL USUARIO ━━━
+{{"emocion": "alegria|tristeza|miedo|enojo|neutral|confusion|sorpresa", "intensidad": 1-5}}
+
+FORMATO EXACTO:
+{{"hechos": [...], "menciones": [...], "episodio": {{...}}, "emocion": {{...}}}}"""
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# VALIDACIÓN POR SECCIÓN (None = inválida → fallback a la llamada dedicada)
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _validar_hechos(valor):
+    if not isinstance(valor, list):
+        return None
+    return _filtrar_hechos(valor)
+
+
+def _validar_menciones(valor, mensaje_usuario):
+    if not isinstance(valor, list):
+        return None
+    if not _menciones_posibles(mensaje_usuario):
+        return []   # mismo filtro que extraer_menciones_casuales(): no se guarda nada
+    return [m for m in valor if isinstance(m, dict) and m.get('tema') and m.get('mencion')]
+
+
+def _validar_episodio(valor):
+    if not isinstance(valor, dict) or not isinstance(valor.get('resumen'), str):
+        return None
+    try:
+        int(valor.get('importancia', 5))
+    except (TypeError, ValueError):
+        return None
+    return valor
+
+
+def _validar_emocion(valor):
+    if not isinstance(valor, dict) or not isinstance(valor.get('emocion'), str):
+        return None
+    try:
+        int(valor.get('intensidad', 3))
+    except (TypeError, ValueError):
+        return None
+    return valor
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# ANÁLISIS
+# ─────────────────────────────────────────────────────────────────────────────
+
+def analizar_turno(mensaje_usuario, respuesta_personaje, lanzar=False):
+    """
+    Analiza el turno con una sola llamada al LLM (modelo de extracción).
+    Devuelve {'hechos', 'menciones', 'episodio', 'emocion'}: cada sección ya
+    validada, o None si falta o no se pudo interpretar (el llamador usa
+    entonces la función dedicada de esa sección). Con consolidatedAnalysis
+    desactivado o si la llamada falla, todas quedan en None.
+    lanzar=True: un error de la llamada (rate limit, timeout, llamada
+    descartada) se propaga en vez de caer a las cuatro llamadas dedicadas,
+    así el trabajo de trabajos.py reintenta la unificada. El None por
+    sección queda solo para una respuesta ilegible o inválida.
+    """
+    vacio = dict.fromkeys(_SECCIONES)
+    if not mensaje_usuario or not mensaje_usuario.strip():
+        return vacio
+    try:
+        if not cargar_config_apis().get('consolidatedAnalysis', True):
+            return vacio
+    except Exception:
+        pass
+
+    try:
+        resp = llamada_mistral_segura(
+            model=_get_modelo("extraction"),
+            messages=[{'role': 'user', 'content': _prompt_unificado(
+                mensaje_usuario, respuesta_personaje, _get_modo_memoria())}],
+            max_tokens=1200,
+            prioridad=EXTRACCION
+        )
+        datos = _limpiar_json(resp.choices[0].message.content.strip(), esperar_array=False)
+    except Exception as e:
+        if lanzar:
+            raise
+        print(f"⚠️ Error análisis unificado: {e}")
+        return vacio
+
+    if not isinstance(datos, dict):
+        print("⚠️ Análisis unificado sin JSON válido: se usan las llamadas separadas")
+        return vacio
+
+    resultado = {
+        'hechos'   : _validar_hechos(datos.get('hechos')),
+        'menciones': _validar_menciones(datos.get('menciones'), mensaje_usuario),
+        'episodio' : _validar_episodio(datos.get('episodio')),
+        'emocion'  : _validar_emocion(datos.get('emocion')),
+    }
+    invalidas = [s for s in _SECCIONES if resultado[s] is None]
+    if invalidas:
+        print(f"⚠️ Análisis unificado: secciones inválidas {invalidas} (se piden por separado)")
+    else:
+        print("🧩 Análisis unificado del turno: 1 llamada")
+    return resultado
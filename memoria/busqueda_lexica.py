@@ -0,0 +1,108 @@
+# ═══════════════════════════════════════════════════════════════════════════
+# MEMORIA/BUSQUEDA_LEXICA.PY — Búsqueda léxica local (SQLite FTS5 / BM25)
+# Recupera episodios y hechos por palabras, sin ninguna llamada de red.
+#
+# Los índices (episodios_fts, hechos_fts) los crea init_database_personaje()
+# en utils.py y los mantienen triggers de SQLite: acá solo se consultan.
+# buscar_contexto_relevante() (faiss_store.py) fusiona estos resultados con
+# los vectoriales por reciprocal-rank fusion, o los usa solos si no hay
+# embeddings o la query tarda más que faiss.embedTimeoutMs.
+#
+# Modificar acá si querés:
+#   - Cambiar qué palabras se ignoran en la consulta (_VACIAS)
+#   - Cambiar cómo se arma el texto de un resultado (_texto_episodio / _texto_hecho)
+# ═══════════════════════════════════════════════════════════════════════════
+
+import re
+import sqlite3
+
+from utils import paths, _get_conn, reparar_valor_db
+
+
+_RRF_K = 60              # constante de reciprocal-rank fusion (la del paper original)
+_MAX_TERMINOS = 16       # palabras de la consulta que se mandan a FTS5
+
+# Palabras demasiado comunes para aportar algo a BM25
+_VACIAS = frozenset('''
+    que los las del por con una uno unos unas para como pero mas más muy sus
+    les esta este esto estos estas eso esa ese esos esas era eres soy son fue
+    sido ser hay hoy tan tambien también porque cuando donde dónde qué cómo
+    cuál cual quien quién sin sobre entre hasta desde ya yo vos tu tú mi mis
+    me te se nos lo le al el la en de y o a si sí no
+'''.split())
+
+
+def _consulta_fts(texto):
+    """
+    Convierte un mensaje libre en una consulta FTS5: cada palabra significativa
+    entre comillas (así no se interpreta la sintaxis de FTS) unidas por OR.
+    Devuelve None si no queda ninguna palabra.
+    """
+    vistas = []
+    for palabra in re.findall(r'\w+', (texto or '').lower()):
+        if len(palabra) < 3 or palabra in _VACIAS or palabra.isdigit() or palabra in vistas:
+            continue
+        vistas.append(palabra)
+        if len(vistas) >= _MAX_TERMINOS:
+            break
+    return ' OR '.join(f'"{p}"' for p in vistas) or None
+
+
+def _texto_episodio(usuario, personaje):
+    """Mismo formato que el texto del vector del episodio (chat_engine.py)."""
+    return f"Usuario: {reparar_valor_db(usuario)}\nPersonaje: {reparar_valor_db(personaje or '')}"
+
+
+def _texto_hecho(categoria, clave, valor):
+    """Mismo formato que el texto del vector del hecho (extraccion.py)."""
+    return f"{categoria}: {reparar_valor_db(clave)} - {reparar_valor_db(valor)}"
+
+
+def buscar_lexico(query, k=8, pid=None):
+    """
+    Búsqueda BM25 sobre memoria_episodica y memoria_permanente.
+    Devuelve dos listas ordenadas por relevancia (episodios, hechos) de dicts
+    {'texto', 'tipo', 'embedding_id'}; tipo es el mismo que usa el vector
+    del registro ('episodio' / 'memoria_permanente') y embedding_id permite
+    cruzarlo con los resultados de FAISS (None si no tiene vector).
+    Si FTS5 no está disponible devuelve listas vacías.
+    """
+    consulta = _consulta_fts(query)
+    if not consulta:
+        return [], []
+    try:
+        with _get_conn(paths(pid)['db']) as conn:
+            episodios = conn.execute('''
+                SELECT e.contenido_usuario, e.contenido_hiro, e.embedding_id
+                FROM episodios_fts JOIN memoria_episodica e ON e.id = episodios_fts.rowid
+                WHERE episodios_fts MATCH ? ORDER BY bm25(episodios_fts) LIMIT ?''',
+                (consulta, k)).fetchall()
+            hechos = conn.execute('''
+                SELECT h.categoria, h.clave, h.valor, h.embedding_id
+                FROM hechos_fts JOIN memoria_permanente h ON h.id = hechos_fts.rowid
+                WHERE hechos_fts MATCH ? ORDER BY bm25(hechos_fts) LIMIT ?''',
+                (consulta, k)).fetchall()
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ Búsqueda léxica no disponible: {e}")
+        return [], []
+    return (
+        [{'texto': _texto_episodio(u, p), 'tipo': 'episodio', 'embedding_id': emb}
+         for u, p, emb in episodios],
+        [{'texto': _texto_hecho(c, cl, v), 'tipo': 'memoria_permanente', 'embedding_id': emb}
+         for c, cl, v, emb in hechos],
+    )
+
+
+def fusionar_rrf(listas, k=_RRF_K):
+    """
+    Reciprocal-rank fusion: puntaje(d) = Σ 1 / (k + posición de d en cada lista).
+    listas: listas de (clave, item) ordenadas por relevancia. Un mismo documento
+    en varias listas suma; se conserva el item de la primera lista en que aparece.
+    Devuelve los items ordenados por puntaje descendente.
+    """
+    puntajes, items = {}, {}
+    for lista in listas:
+        for pos, (clave, item) in enumerate(lista, start=1):
+            puntajes[clave] = puntajes.get(clave, 0.0) + 1.0 / (k + pos)
+            items.setdefault(clave, item)
+    return [items[c] for c in sorted(puntajes, key=puntajes.get, reverse=True)]
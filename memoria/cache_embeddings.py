@@ -0,0 +1,169 @@
+# ═══════════════════════════════════════════════════════════════════════════
+# MEMORIA/CACHE_EMBEDDINGS.PY — Caché persistente de embeddings
+# Evita pagar dos veces el mismo texto: consultas repetidas, hechos que se
+# re-guardan con el mismo valor, episodios re-importados.
+#
+# Una base SQLite por personaje (data/personajes/<pid>/embeddings_cache.db),
+# direccionada por contenido: clave = (modelo, sha256(texto)).
+#
+# Modificar acá si querés:
+#   - Cambiar el tamaño máximo de la caché (embeddingCache.maxEntries)
+#   - Cambiar la política de expulsión (hoy: LRU por ultimo_uso)
+#
+# Puede haber vectores de varios modelos a la vez (el del índice y el nuevo
+# mientras corre un reindexado): los del modelo viejo se descartan al terminar
+# el reindexado con cache_descartar_modelo(), o se van solos por LRU.
+# ═══════════════════════════════════════════════════════════════════════════
+
+import os
+import time
+import hashlib
+import threading
+import numpy as np
+
+from utils import paths, _get_conn
+
+
+_MAX_ENTRADAS_DEFAULT = 20000
+
+_stats      = {'hits': 0, 'misses': 0, 'expulsados': 0, 'invalidaciones': 0}
+_stats_lock = threading.Lock()
+_iniciadas  = set()   # rutas de caché ya inicializadas en este proceso
+
+
+def _get_config_cache():
+    """Lee embeddingCache desde api_config.json → (habilitada, max_entradas)."""
+    try:
+        from utils import cargar_config_apis
+        cfg = cargar_config_apis().get('embeddingCache', {})
+        return bool(cfg.get('enabled', True)), int(cfg.get('maxEntries') or _MAX_ENTRADAS_DEFAULT)
+    except Exception:
+        return True, _MAX_ENTRADAS_DEFAULT
+
+
+def _hash_texto(texto):
+    return hashlib.sha256(texto.encode('utf-8')).hexdigest()
+
+
+def _conn_cache(pid):
+    """Abre la caché del personaje. La primera vez en el proceso crea las tablas."""
+    ruta   = paths(pid)['emb_cache']
+    existe = os.path.exists(ruta)
+    conn   = _get_conn(ruta)
+    conn.execute('PRAGMA journal_mode = WAL')
+    if existe and ruta in _iniciadas:
+        return conn
+
+    cursor = conn.cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS embeddings_cache (
+        modelo TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        vector BLOB NOT NULL,
+        ultimo_uso REAL NOT NULL,
+        PRIMARY KEY (modelo, hash))''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cache_uso ON embeddings_cache(ultimo_uso)')
+    conn.commit()
+    _iniciadas.add(ruta)
+    return conn
+
+
+def cache_descartar_modelo(pid, modelo):
+    """Borra los vectores de un modelo que ya no se usa (al terminar un reindexado)."""
+    try:
+        with _conn_cache(pid) as conn:
+            borrados = conn.execute('DELETE FROM embeddings_cache WHERE modelo=?', (modelo,)).rowcount
+        if borrados:
+            with _stats_lock:
+                _stats['invalidaciones'] += 1
+            print(f"🧹 Caché de embeddings: {borrados} vectores de {modelo} descartados")
+    except Exception as e:
+        print(f"⚠️ Error limpiando caché de embeddings: {e}")
+
+
+def cache_buscar(pid, modelo, textos):
+    """
+    Busca los textos en la caché. Devuelve {posición: vector float32} con los
+    aciertos; las posiciones ausentes son fallos que hay que pedir al proveedor.
+    """
+    habilitada, _ = _get_config_cache()
+    if not habilitada or not textos:
+        return {}
+    encontrados = {}
+    try:
+        hashes = [_hash_texto(t) for t in textos]
+        with _conn_cache(pid) as conn:
+            cursor = conn.cursor()
+            por_hash = {}
+            unicos = list(set(hashes))
+            for i in range(0, len(unicos), 500):
+                lote = unicos[i:i + 500]
+                ph = ','.join('?' * len(lote))
+                cursor.execute(
+                    f'SELECT hash, vector FROM embeddings_cache WHERE modelo=? AND hash IN ({ph})',
+                    [modelo] + lote
+                )
+                for h, blob in cursor.fetchall():
+                    por_hash[h] = np.frombuffer(blob, dtype=np.float32)
+            if por_hash:
+                ahora = time.time()
+                cursor.executemany(
+                    'UPDATE embeddings_cache SET ultimo_uso=? WHERE modelo=? AND hash=?',
+                    [(ahora, modelo, h) for h in por_hash]
+                )
+        for i, h in enumerate(hashes):
+            if h in por_hash:
+                encontrados[i] = por_hash[h]
+    except Exception as e:
+        print(f"⚠️ Error leyendo caché de embeddings: {e}")
+        encontrados = {}
+    with _stats_lock:
+        _stats['hits']   += len(encontrados)
+        _stats['misses'] += len(textos) - len(encontrados)
+    return encontrados
+
+
+def cache_guardar(pid, modelo, textos, matriz):
+    """Guarda los vectores recién calculados y expulsa los menos usados si se pasa del máximo."""
+    habilitada, max_entradas = _get_config_cache()
+    if not habilitada or not textos:
+        return
+    try:
+        ahora = time.time()
+        filas = [
+            (modelo, _hash_texto(t), np.asarray(v, dtype=np.float32).tobytes(), ahora)
+            for t, v in zip(textos, matriz)
+        ]
+        with _conn_cache(pid) as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                'INSERT OR REPLACE INTO embeddings_cache (modelo, hash, vector, ultimo_uso) VALUES (?,?,?,?)',
+                filas
+            )
+            cursor.execute('SELECT COUNT(*) FROM embeddings_cache')
+            sobrantes = cursor.fetchone()[0] - max_entradas
+            if sobrantes > 0:
+                cursor.execute('''DELETE FROM embeddings_cache WHERE rowid IN (
+                    SELECT rowid FROM embeddings_cache ORDER BY ultimo_uso ASC LIMIT ?)''',
+                    (sobrantes,))
+                with _stats_lock:
+                    _stats['expulsados'] += sobrantes
+    except Exception as e:
+        print(f"⚠️ Error guardando caché de embeddings: {e}")
+
+
+def stats_cache_embeddings(pid=None):
+    """Contadores del proceso (hits/misses/expulsados) + tamaño actual de la caché del personaje."""
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / total, 3) if total else 0.0
+    stats['habilitada'], stats['max_entradas'] = _get_config_cache()
+    stats['entradas'] = 0
+    try:
+        ruta = paths(pid)['emb_cache']
+        if os.path.exists(ruta):
+            with _get_conn(ruta) as conn:
+                stats['entradas'] = conn.execute('SELECT COUNT(*) FROM embeddings_cache').fetchone()[0]
+    except Exception:
+        pass
+    return stats
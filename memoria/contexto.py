@@ -52,14 +52,15 @@ def invalidar_cache():
         _cache.clear()
 
 
-def obtener_contexto(mensaje_usuario, limite_tokens=4000):
+def obtener_contexto(mensaje_usuario, limite_tokens=4000, pid=None):
     """
     Arma el bloque de memoria para cada respuesta en 4 bloques:
       1. Hilo de la última sesión (si hay gap notable)
       2. Quién es el usuario (perfil narrativo)
       3. Datos de referencia (hechos permanentes)
       4. Historia entre ustedes (momentos + resumen relacional)
-      5. Contexto relevante (búsqueda semántica FAISS)
+      5. Contexto relevante (búsqueda híbrida: léxica FTS5 + semántica FAISS)
+    pid: personaje del turno (None = activo).
     """
     CATS_DATOS    = {'identidad','apariencia','personalidad','vida','relaciones','intereses',
                      'objetivos','intimidad','historial_intimo','usuario',
@@ -75,7 +76,7 @@ def obtener_contexto(mensaje_usuario, limite_tokens=4000):
     es_funcional = any(w in msg_lower for w in ['funciona', 'chequear', 'probar', 'hora', 'test', 'verificar', 'configurar'])
     modo_liviano = es_saludo or es_despedida or es_funcional
 
-    with _get_conn(paths()['db']) as conn:
+    with _get_conn(paths(pid)['db']) as conn:
         cursor = conn.cursor()
         ph_d = ','.join('?'*len(CATS_DATOS))
         cursor.execute(
@@ -94,7 +95,8 @@ def obtener_contexto(mensaje_usuario, limite_tokens=4000):
         cursor.execute('SELECT categoria,titulo,contenido FROM sintesis_conocimiento')
         sintesis = [(c, t, reparar_valor_db(cont)) for c, t, cont in cursor.fetchall()]
 
-    contexto_relevante = [] if modo_liviano else buscar_contexto_relevante(mensaje_usuario, k=8)
+    # En modo liviano no se paga el embedding de la query: solo búsqueda léxica local
+    contexto_relevante = buscar_contexto_relevante(mensaje_usuario, k=8, pid=pid, solo_lexico=modo_liviano)
     partes = []
 
     # ── Bloque 0: Estado emocional de esta sesión ────────────────────────────
@@ -20,6 +20,7 @@ from utils import (
     paths,
     _get_conn,
 )
+from limitador import ANALISIS, EXTRACCION
 from ._helpers import _limpiar_json
 
 
@@ -198,10 +199,11 @@ def _get_horario_habitual():
 # DETECCIÓN EMOCIONAL
 # ─────────────────────────────────────────────────────────────────────────────
 
-def detectar_emocion(mensaje):
+def detectar_emocion(mensaje, lanzar=False):
     """
     Detecta la emoción en el mensaje del usuario y la guarda en estado_emocional.
     Se llama después de cada mensaje del usuario.
+    lanzar=True: un error o una respuesta sin JSON se propaga en vez de devolver None.
     """
     if not mensaje or len(mensaje) < 3:
         return None
@@ -222,33 +224,42 @@ Ejemplos:
         response = llamada_mistral_segura(
             model=_get_modelo("extraction"),
             messages=[{'role': 'user', 'content': prompt}],
-            max_tokens=80
+            max_tokens=80,
+            prioridad=EXTRACCION
         )
         texto = response.choices[0].message.content.strip()
         datos = _limpiar_json(texto, esperar_array=False)
         if not datos:
+            if lanzar:
+                raise ValueError("respuesta sin JSON")
             return None
-
-        with _get_conn(paths()['db']) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO estado_emocional (emocion_primaria, intensidad, fecha)
-                VALUES (?, ?, ?)
-            ''', (
-                str(datos.get('emocion', 'neutral')).lower(),
-                min(5, max(1, int(datos.get('intensidad', 3)))),
-                now_argentina().isoformat()
-            ))
-            conn.commit()
-
-        print(f"😊 {datos.get('emocion')} ({datos.get('intensidad')}/5)")
-        return datos
+        return guardar_emocion(datos)
 
     except Exception as e:
+        if lanzar:
+            raise
         print(f"⚠️ Error emoción: {e}")
         return None
 
 
+def guardar_emocion(datos):
+    """Registra {emocion, intensidad} en estado_emocional (de detectar_emocion() o del análisis unificado)."""
+    with _get_conn(paths()['db']) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO estado_emocional (emocion_primaria, intensidad, fecha)
+            VALUES (?, ?, ?)
+        ''', (
+            str(datos.get('emocion', 'neutral')).lower(),
+            min(5, max(1, int(datos.get('intensidad', 3)))),
+            now_argentina().isoformat()
+        ))
+        conn.commit()
+
+    print(f"😊 {datos.get('emocion')} ({datos.get('intensidad')}/5)")
+    return datos
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # BACKSTORY / DIARIO DEL PERSONAJE
 # ─────────────────────────────────────────────────────────────────────────────
@@ -325,7 +336,8 @@ REGLAS:
         response = llamada_mistral_segura(
             model=_get_modelo("generation"),
             messages=[{'role': 'user', 'content': prompt}],
-            max_tokens=300
+            max_tokens=300,
+            prioridad=ANALISIS
         )
         contenido = response.choices[0].message.content.strip()
 
@@ -346,13 +358,13 @@ REGLAS:
         
 # ─────────────────────────────────────────────────────────────────────────────
 # GENERACIÓN AUTOMÁTICA DE DIARIOS Y EVOLUCIÓN
-# Llamadas desde chat_engine._post_proceso — nunca bloquean al usuario
+# Llamadas desde el post-proceso de chat_engine (trabajo periodicos_turno) — nunca bloquean al usuario
 # ─────────────────────────────────────────────────────────────────────────────
 
 def generar_diario_automatico():
     """
     Genera una entrada de diario del personaje basada en todo lo aprendido.
-    Se llama automáticamente desde _post_proceso cuando:
+    Se llama automáticamente desde el trabajo periodicos_turno cuando:
       - Es la primera sesión del día (gap > 3hs desde último mensaje)
       - O cada 25 mensajes del usuario
     Evita generar más de 1 por sesión usando la fecha del último diario.
@@ -457,7 +469,8 @@ REGLAS ESTRICTAS:
         response = llamada_mistral_segura(
             model=_get_modelo("generation"),
             messages=[{'role': 'user', 'content': prompt}],
-            max_tokens=400
+            max_tokens=400,
+            prioridad=ANALISIS
         )
         contenido = response.choices[0].message.content.strip()
         titulo    = f"Diario — {fecha_str.capitalize()}"
@@ -481,7 +494,7 @@ REGLAS ESTRICTAS:
 def actualizar_evolucion_automatica(fase_actual):
     """
     Genera/actualiza la descripción de evolución del personaje para la fase actual.
-    Se llama automáticamente desde _post_proceso cuando:
+    Se llama automáticamente desde el trabajo periodicos_turno cuando:
       - La fase sube (fase_actual != fase_anterior)
       - O cada 40 mensajes del usuario
     """
@@ -536,7 +549,8 @@ Respondé SOLO en JSON sin markdown:
         response = llamada_mistral_segura(
             model=_get_modelo("generation"),
             messages=[{'role': 'user', 'content': prompt}],
-            max_tokens=450
+            max_tokens=450,
+            prioridad=ANALISIS
         )
         texto = response.choices[0].message.content.strip()
 
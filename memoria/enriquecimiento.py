@@ -1,7 +1,8 @@
 # ═══════════════════════════════════════════════════════════════════════════
 # MEMORIA/ENRIQUECIMIENTO.PY — Enriquecimiento episódico
 # _enriquecer_episodio: después de guardar un episodio, llama a IA para
-# rellenar resumen, temas, emoción e importancia.
+# rellenar resumen, temas, emoción e importancia (guardar_enriquecimiento
+# escribe el resultado; también lo usa el análisis unificado del turno).
 #
 # Modificar acá si querés:
 #   - Cambiar la escala de importancia
@@ -18,6 +19,7 @@ from utils import (
     paths,
     _get_conn,
 )
+from limitador import ANALISIS
 from ._helpers import _limpiar_json
 
 
@@ -33,10 +35,11 @@ def _get_modelo(tarea):
         return 'mistral-small-latest'
 
 
-def _enriquecer_episodio(episodio_id, contenido_usuario, contenido_personaje):
+def _enriquecer_episodio(episodio_id, contenido_usuario, contenido_personaje, lanzar=False):
     """
     Rellena resumen, temas, emocion_detectada e importancia de un episodio recién guardado.
     También actualiza los temas_frecuentes en la tabla relacion.
+    lanzar=True: un error o una respuesta sin JSON se propaga en vez de imprimirse.
     """
     if not contenido_usuario or contenido_usuario == '[continuar]':
         texto_analizar = f"Personaje: {contenido_personaje}"
@@ -71,44 +74,58 @@ EJEMPLOS:
         resp = llamada_mistral_segura(
             model=_get_modelo("enrichment"),
             messages=[{'role': 'user', 'content': prompt}],
-            max_tokens=200
+            max_tokens=200,
+            prioridad=ANALISIS
         )
         contenido = resp.choices[0].message.content.strip()
         datos = _limpiar_json(contenido, esperar_array=False)
         if not datos:
+            if lanzar:
+                raise ValueError("respuesta sin JSON")
             return
 
-        resumen     = str(datos.get('resumen', ''))[:500]
-        temas       = datos.get('temas', [])
-        if not isinstance(temas, list): temas = []
-        temas_json  = json.dumps(temas, ensure_ascii=False)
-        emocion     = str(datos.get('emocion', ''))[:50]
-        importancia = max(1, min(10, int(datos.get('importancia', 5))))
-
-        with _get_conn(paths()['db']) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE memoria_episodica
-                SET resumen=?, temas=?, emocion_detectada=?, importancia=?
-                WHERE id=?
-            ''', (resumen, temas_json, emocion, importancia, episodio_id))
-        print(f"✅ Episodio {episodio_id} enriquecido — importancia:{importancia} emoción:{emocion}")
-
-        # Actualizar temas frecuentes en la relación
-        try:
-            with _get_conn(paths()['db']) as conn2:
-                c2 = conn2.cursor()
-                c2.execute("SELECT temas FROM memoria_episodica WHERE temas IS NOT NULL ORDER BY id DESC LIMIT 30")
-                todos_temas = []
-                for (t_json,) in c2.fetchall():
-                    try: todos_temas.extend(json.loads(t_json))
-                    except Exception: pass
-                if todos_temas:
-                    top_temas = [t for t, _ in Counter(todos_temas).most_common(8)]
-                    c2.execute("UPDATE relacion SET temas_frecuentes=? WHERE id=1",
-                               (json.dumps(top_temas, ensure_ascii=False),))
-        except Exception as e_tf:
-            print(f"⚠️ Error actualizando temas_frecuentes: {e_tf}")
+        guardar_enriquecimiento(episodio_id, datos)
 
     except Exception as e:
+        if lanzar:
+            raise
         print(f"⚠️ Error enriqueciendo episodio {episodio_id}: {e}")
+
+
+def guardar_enriquecimiento(episodio_id, datos):
+    """
+    Escribe en el episodio el análisis {resumen, temas, emocion, importancia}
+    (de _enriquecer_episodio() o del análisis unificado del turno) y actualiza
+    los temas_frecuentes de la relación.
+    """
+    resumen     = str(datos.get('resumen', ''))[:500]
+    temas       = datos.get('temas', [])
+    if not isinstance(temas, list): temas = []
+    temas_json  = json.dumps(temas, ensure_ascii=False)
+    emocion     = str(datos.get('emocion', ''))[:50]
+    importancia = max(1, min(10, int(datos.get('importancia', 5))))
+
+    with _get_conn(paths()['db']) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE memoria_episodica
+            SET resumen=?, temas=?, emocion_detectada=?, importancia=?
+            WHERE id=?
+        ''', (resumen, temas_json, emocion, importancia, episodio_id))
+    print(f"✅ Episodio {episodio_id} enriquecido — importancia:{importancia} emoción:{emocion}")
+
+    # Actualizar temas frecuentes en la relación
+    try:
+        with _get_conn(paths()['db']) as conn2:
+            c2 = conn2.cursor()
+            c2.execute("SELECT temas FROM memoria_episodica WHERE temas IS NOT NULL ORDER BY id DESC LIMIT 30")
+            todos_temas = []
+            for (t_json,) in c2.fetchall():
+                try: todos_temas.extend(json.loads(t_json))
+                except Exception: pass
+            if todos_temas:
+                top_temas = [t for t, _ in Counter(todos_temas).most_common(8)]
+                c2.execute("UPDATE relacion SET temas_frecuentes=? WHERE id=1",
+                           (json.dumps(top_temas, ensure_ascii=False),))
+    except Exception as e_tf:
+        print(f"⚠️ Error actualizando temas_frecuentes: {e_tf}")
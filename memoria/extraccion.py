@@ -2,6 +2,8 @@
 # MEMORIA/EXTRACCION.PY — Extracción de información con IA
 # extraer_informacion_con_ia, guardar_memoria_permanente,
 # extraer_menciones_casuales, _detectar_y_cerrar_hilos
+# (_filtrar_hechos y guardar_menciones_casuales también los usa el análisis
+# unificado del turno, analisis_turno.py)
 #
 # Modificar acá si querés:
 #   - Agregar o quitar categorías de memoria
@@ -18,8 +20,9 @@ from utils import (
     _get_conn,
     reparar_valor_db,
 )
+from limitador import EXTRACCION
 from ._helpers import _limpiar_json
-from .faiss_store import agregar_embedding
+from .faiss_store import agregar_embeddings_batch, eliminar_embeddings
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -51,11 +54,69 @@ def _get_modo_memoria():
 # EXTRACCIÓN PRINCIPAL
 # ─────────────────────────────────────────────────────────────────────────────
 
-def extraer_informacion_con_ia(mensaje_usuario, respuesta_personaje):
+# Mapeo de categorías mal escritas a las canónicas
+_MAPA_CATS = {
+    'moments'         : 'momentos',
+    'momentes'        : 'momentos',
+    'momento'         : 'momentos',
+    'moments_rel'     : 'momentos',
+    'relacion'        : 'momentos',
+    'vinculo'         : 'momentos',
+    'identity'        : 'identidad',
+    'usuario'         : 'identidad',
+    'fisico'          : 'apariencia',
+    'fisica'          : 'apariencia',
+    'appearance'      : 'apariencia',
+    'aspecto'         : 'apariencia',
+    'caracter'        : 'personalidad',
+    'character'       : 'personalidad',
+    'personality'     : 'personalidad',
+    'estado_animo'    : 'estado_actual',
+    'estado'          : 'estado_actual',
+    'emocion'         : 'estado_actual',
+    'emotion'         : 'estado_actual',
+    'sentimientos'    : 'estado_actual',
+    'mood'            : 'estado_actual',
+    'preferencias'    : 'intereses',
+    'gustos'          : 'intereses',
+    'hobbies'         : 'intereses',
+    'interests'       : 'intereses',
+    'intimate'        : 'intimidad',
+    'intimo'          : 'intimidad',
+    'historial_intim' : 'historial_intimo',
+}
+
+
+def _filtrar_hechos(datos):
+    """
+    Valida los hechos que devolvió el LLM: descarta ítems incompletos o con
+    confianza < 70 y normaliza categorías mal escritas (_MAPA_CATS).
+    Lo usan extraer_informacion_con_ia() y el análisis unificado del turno.
+    """
+    datos_filtrados = []
+    for item in datos:
+        if not isinstance(item, dict) or not all(k in item for k in ('categoria', 'clave', 'valor')):
+            continue
+        try:
+            confianza = float(item.get('confianza', 100))
+        except (TypeError, ValueError):
+            continue
+        if confianza < 70:
+            continue
+        cat = item.get('categoria', '')
+        item['categoria'] = _MAPA_CATS.get(cat, cat)
+        datos_filtrados.append(item)
+
+    return datos_filtrados
+
+
+def extraer_informacion_con_ia(mensaje_usuario, respuesta_personaje, lanzar=False):
     """
     Analiza un turno de conversación y extrae hechos sobre el usuario.
     Usa prompts diferentes según el modo_memoria del personaje (compañero vs roleplay).
     Devuelve lista de dicts con {categoria, clave, valor, contexto, confianza}.
+    lanzar=True: un error o una respuesta sin JSON se propaga en vez de
+    devolver [] (el post-proceso de trabajos.py lo reintenta).
     """
     if not mensaje_usuario or not mensaje_usuario.strip():
         return []
@@ -195,59 +256,21 @@ Respondé SOLO con JSON array. Si no hay nada: []"""
         response = llamada_mistral_segura(
             model=_get_modelo("extraction"),
             messages=[{'role': 'user', 'content': prompt}],
-            max_tokens=800
+            max_tokens=800,
+            prioridad=EXTRACCION
         )
         contenido = response.choices[0].message.content.strip()
         datos = _limpiar_json(contenido, esperar_array=True)
+        if datos is None and lanzar:
+            raise ValueError("respuesta sin JSON")
         if not datos or not isinstance(datos, list):
             return []
 
-        # Mapeo de categorías mal escritas a las canónicas
-        MAPA_CATS = {
-            'moments'         : 'momentos',
-            'momentes'        : 'momentos',
-            'momento'         : 'momentos',
-            'moments_rel'     : 'momentos',
-            'relacion'        : 'momentos',
-            'vinculo'         : 'momentos',
-            'identity'        : 'identidad',
-            'usuario'         : 'identidad',
-            'fisico'          : 'apariencia',
-            'fisica'          : 'apariencia',
-            'appearance'      : 'apariencia',
-            'aspecto'         : 'apariencia',
-            'caracter'        : 'personalidad',
-            'character'       : 'personalidad',
-            'personality'     : 'personalidad',
-            'estado_animo'    : 'estado_actual',
-            'estado'          : 'estado_actual',
-            'emocion'         : 'estado_actual',
-            'emotion'         : 'estado_actual',
-            'sentimientos'    : 'estado_actual',
-            'mood'            : 'estado_actual',
-            'preferencias'    : 'intereses',
-            'gustos'          : 'intereses',
-            'hobbies'         : 'intereses',
-            'interests'       : 'intereses',
-            'intimate'        : 'intimidad',
-            'intimo'          : 'intimidad',
-            'historial_intim' : 'historial_intimo',
-        }
-
-        datos_filtrados = []
-        for item in datos:
-            if not all(k in item for k in ('categoria', 'clave', 'valor')):
-                continue
-            confianza = item.get('confianza', 100)
-            if confianza < 70:
-                continue
-            cat = item.get('categoria', '')
-            item['categoria'] = MAPA_CATS.get(cat, cat)
-            datos_filtrados.append(item)
-
-        return datos_filtrados
+        return _filtrar_hechos(datos)
 
     except Exception as e:
+        if lanzar:
+            raise
         print(f"❌ Error extracción IA: {e}")
         return []
 
@@ -256,19 +279,15 @@ Respondé SOLO con JSON array. Si no hay nada: []"""
 # MENCIONES CASUALES
 # ─────────────────────────────────────────────────────────────────────────────
 
-def extraer_menciones_casuales(mensaje_usuario, ultimo_mensaje_personaje=""):
+def extraer_menciones_casuales(mensaje_usuario, ultimo_mensaje_personaje="", lanzar=False):
     """
     Captura temas mencionados de pasada por el usuario — sin confirmar, confianza baja.
     Los guarda como hilos pendientes para que el personaje los retome después.
+    lanzar=True: los errores se propagan en vez de imprimirse.
     """
-    if not mensaje_usuario or len(mensaje_usuario.split()) < 3:
+    if not _menciones_posibles(mensaje_usuario):
         return
 
-    msg_lower = mensaje_usuario.lower()
-    if any(w in msg_lower for w in ['hola', 'chau', 'sisi', 'dale', 'okey', 'ok', 'jaja', 'jeje']):
-        if len(mensaje_usuario.split()) < 5:
-            return
-
     prompt = f"""Del siguiente mensaje de un usuario en un chat, extraé SOLO temas concretos mencionados de pasada que podrían ser interesantes para retomar después en la conversación.
 
 Mensaje: "{mensaje_usuario}"
@@ -292,33 +311,59 @@ Respondé SOLO con JSON array o [] si no hay nada relevante:
         resp = llamada_mistral_segura(
             model=_get_modelo("extraction"),
             messages=[{'role': 'user', 'content': prompt}],
-            max_tokens=150
+            max_tokens=150,
+            prioridad=EXTRACCION
         )
         contenido = resp.choices[0].message.content.strip()
         menciones = _limpiar_json(contenido, esperar_array=True)
+        if menciones is None and lanzar:
+            raise ValueError("respuesta sin JSON")
         if not menciones or not isinstance(menciones, list):
             return
-
-        with _get_conn(paths()['db']) as conn:
-            cursor = conn.cursor()
-            for m in menciones[:3]:
-                tema    = str(m.get('tema', ''))[:100]
-                mencion = str(m.get('mencion', ''))[:200]
-                if tema and mencion:
-                    cursor.execute('''
-                        INSERT INTO hilos_pendientes (pregunta, tema, resuelto)
-                        VALUES (?, ?, 0)
-                    ''', (f"Mencionaste: '{mencion}'", tema))
-        print(f"💬 Menciones casuales guardadas: {len(menciones)}")
+        guardar_menciones_casuales(menciones)
 
     except Exception as e:
+        if lanzar:
+            raise
         print(f"⚠️ Error menciones casuales: {e}")
 
 
-def _detectar_y_cerrar_hilos(contenido_usuario):
+def _menciones_posibles(mensaje_usuario):
+    """False para mensajes demasiado cortos o de puro saludo: no vale la pena buscar menciones."""
+    if not mensaje_usuario or len(mensaje_usuario.split()) < 3:
+        return False
+    msg_lower = mensaje_usuario.lower()
+    if any(w in msg_lower for w in ['hola', 'chau', 'sisi', 'dale', 'okey', 'ok', 'jaja', 'jeje']):
+        if len(mensaje_usuario.split()) < 5:
+            return False
+    return True
+
+
+def guardar_menciones_casuales(menciones):
+    """Guarda hasta 3 menciones {tema, mencion} como hilos pendientes."""
+    guardadas = 0
+    with _get_conn(paths()['db']) as conn:
+        cursor = conn.cursor()
+        for m in menciones[:3]:
+            if not isinstance(m, dict):
+                continue
+            tema    = str(m.get('tema', ''))[:100]
+            mencion = str(m.get('mencion', ''))[:200]
+            if tema and mencion:
+                cursor.execute('''
+                    INSERT INTO hilos_pendientes (pregunta, tema, resuelto)
+                    VALUES (?, ?, 0)
+                ''', (f"Mencionaste: '{mencion}'", tema))
+                guardadas += 1
+    if guardadas:
+        print(f"💬 Menciones casuales guardadas: {guardadas}")
+
+
+def _detectar_y_cerrar_hilos(contenido_usuario, lanzar=False):
     """
     Después de que el usuario responde, marca como resueltos los hilos que coincidan.
     Requiere que el tema aparezca como respuesta positiva, no negada.
+    lanzar=True: los errores se propagan en vez de imprimirse.
     """
     if not contenido_usuario or len(contenido_usuario.split()) < 2:
         return
@@ -351,6 +396,8 @@ def _detectar_y_cerrar_hilos(contenido_usuario):
                     print(f"✅ Hilo cerrado: '{tema}'")
                     break
     except Exception as e:
+        if lanzar:
+            raise
         print(f"⚠️ Error cerrando hilos: {e}")
 
 
@@ -365,14 +412,26 @@ def _str(v):
     return str(v) if v is not None else ''
 
 
-def guardar_memoria_permanente(datos):
+def guardar_memoria_permanente(datos, pid=None, lanzar=False):
     """
     Upsert de hechos en SQLite + genera embedding SOLO si el hecho es nuevo o cambió.
     Los datos de estado_actual se descartan (son efímeros).
+    Los embeddings de todos los hechos del turno se piden en un solo lote.
+    Cada fila guarda el embedding_id de su vector; si el valor cambió, el
+    vector del valor viejo se borra del índice.
+    pid: personaje del turno (None = activo).
+    Un hecho sin vector (embedding_id NULL, p. ej. porque falló el embedding)
+    se vuelve a embeber aunque el valor no cambie.
+    lanzar=True: un error de escritura o de embedding se propaga al final
+    (los hechos que sí se pudieron escribir quedan escritos).
     """
     if not datos:
         return
-    with _get_conn(paths()['db']) as conn:
+    errores    = []
+    pendientes = []   # (texto, tipo, metadata_extra) para embeber en lote
+    claves     = []   # (categoria, clave) de cada pendiente, mismo orden
+    viejos     = []   # embedding_id de valores reemplazados
+    with _get_conn(paths(pid)['db']) as conn:
         cursor = conn.cursor()
         for item in datos:
             try:
@@ -385,12 +444,13 @@ def guardar_memoria_permanente(datos):
 
                 # Verificar si el hecho ya existe con el mismo valor
                 cursor.execute(
-                    'SELECT valor FROM memoria_permanente WHERE categoria=? AND clave=?',
+                    'SELECT valor, embedding_id FROM memoria_permanente WHERE categoria=? AND clave=?',
                     (cat, clave)
                 )
                 fila_existente = cursor.fetchone()
                 es_nuevo     = fila_existente is None
                 valor_cambio = es_nuevo or (fila_existente[0] != valor)
+                sin_vector   = not es_nuevo and fila_existente[1] is None
 
                 cursor.execute('''
                     INSERT INTO memoria_permanente
@@ -405,11 +465,32 @@ def guardar_memoria_permanente(datos):
                       now_argentina().isoformat(),
                       now_argentina().isoformat()))
 
-                # Solo agregar embedding si el hecho es nuevo o cambió
-                if valor_cambio:
+                # Solo agregar embedding si el hecho es nuevo, cambió o quedó sin vector
+                if valor_cambio or sin_vector:
                     texto = f"{cat}: {clave} - {valor}"
-                    agregar_embedding(texto, 'memoria_permanente', cat)
+                    pendientes.append((texto, 'memoria_permanente', cat))
+                    claves.append((cat, clave))
+                    if not es_nuevo and fila_existente[1] is not None:
+                        viejos.append(fila_existente[1])
                     print(f"📌 {'Nuevo' if es_nuevo else 'Actualizado'}: [{cat}] {clave} = {valor[:60]}")
 
             except Exception as e:
                 print(f"⚠️ Error guardando memoria: {e}")
+                errores.append(e)
+
+    if pendientes:
+        try:
+            ids = agregar_embeddings_batch(pendientes, pid=pid)
+            if not ids:
+                raise RuntimeError("no se pudieron generar los embeddings")
+            with _get_conn(paths(pid)['db']) as conn:
+                conn.executemany(
+                    'UPDATE memoria_permanente SET embedding_id=? WHERE categoria=? AND clave=?',
+                    [(emb_id, cat, clave) for emb_id, (cat, clave) in zip(ids, claves)]
+                )
+            eliminar_embeddings(viejos, pid=pid)
+        except Exception as e:
+            print(f"⚠️ Error generando embeddings de hechos: {e}")
+            errores.append(e)
+    if errores and lanzar:
+        raise errores[0]
@@ -6,7 +6,11 @@
 
 import os
 import json
+import time
 import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from collections import namedtuple, OrderedDict
 import numpy as np
 import faiss
 import msgpack
@@ -14,19 +18,104 @@ import msgpack
 from utils import (
     now_argentina,
     paths, get_personaje_activo_id, set_personaje_activo_id,
-    init_database_personaje,
-    _get_conn,
+    init_database_personaje, listar_personajes,
+    _get_conn, http_cliente, esperar_turno,
 )
+from .cache_embeddings import cache_buscar, cache_guardar
+from .busqueda_lexica import buscar_lexico, fusionar_rrf
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-# ÍNDICE FAISS GLOBAL (un único índice activo por proceso)
+# REGISTRO DE ÍNDICES POR PERSONAJE
+# Un _Almacen por pid, residentes en memoria con expulsión LRU según
+# faiss.maxResident / faiss.memoryBudgetMB. Volver a un personaje reciente
+# no relee nada de disco, y se pueden atender dos personajes a la vez.
 # ─────────────────────────────────────────────────────────────────────────────
 
-faiss_index         = faiss.IndexFlatL2(1024)
-embeddings_metadata = []
-_faiss_lock         = threading.Lock()   # protege index + metadata en multithread
+# Lecturas sin lock (estilo RCU): el índice publicado en alm.snapshot es
+# INMUTABLE. Los escritores arman una copia nueva, le aplican
+# el cambio y la publican con una sola asignación (atómica en CPython).
+# Un lector que ya tomó la referencia sigue buscando sobre la versión vieja.
+# `gen` cambia cada vez que el índice se reconstruye entero (limpieza, promoción):
+# un trabajo en segundo plano que arrancó sobre otra generación se descarta.
+# `cabecera` viaja con el snapshot: describe con qué modelo se hicieron ESOS vectores.
+# `prox_id` es el próximo id libre (ver IDS ESTABLES más abajo) y `vivos` la
+# cantidad de vectores con metadata. La metadata NO está en memoria: vive en la
+# tabla `vectores` de memoria.db (ver METADATA EN SQLITE).
+# `delta` es None salvo en modo mmap (ver MAPEO A MEMORIA más abajo).
+_Snapshot = namedtuple('_Snapshot', 'index seq gen cabecera prox_id vivos delta')
 
+_generaciones = itertools.count(1)   # monótona en todo el proceso (ver _escribir_snapshot)
+
+
+class _Almacen:
+    """Índice vectorial de UN personaje: snapshot publicado + lock de sus escritores."""
+
+    def __init__(self, pid, snapshot):
+        self.pid         = pid
+        self.snapshot    = snapshot
+        self.lock        = threading.Lock()   # serializa ESCRITORES (los lectores no lo toman)
+        self.vigente     = True               # False al salir del registro: los escritores reintentan
+        self.desalineado = None               # motivo si la config ya no coincide con la cabecera
+
+
+_almacenes     = OrderedDict()        # pid → _Almacen, del menos al más recientemente usado
+_registro_lock = threading.Lock()
+_carga_locks   = {}                   # pid → Lock: una sola carga de disco por personaje a la vez
+_pid_activo    = None                 # personaje de cargar_personaje() (solo para los alias legacy)
+
+# Alias legacy del índice del personaje activo, para quien todavía lea la global
+faiss_index         = faiss.IndexIDMap2(faiss.IndexFlatIP(1024))
+
+# ── Persistencia: snapshot + log de escritura anticipada (WAL) ───────────────
+# embeddings.index es el último snapshot completo y embeddings_metadata.msgpack
+# su registro de commit (seq, prox_id, cabecera).
+# Cada alta se agrega al final de embeddings.wal (con fsync) en vez de reescribir
+# todo el índice. Al cargar se reproduce el WAL sobre el snapshot; cuando el WAL
+# supera _WAL_MAX_BYTES se compacta en segundo plano a un snapshot nuevo.
+_WAL_MAX_BYTES  = 8 * 1024 * 1024   # ~2000 vectores de 1024 dims
+_compactando    = set()             # pids con compactación en curso
+_disco_lock     = threading.Lock()  # serializa escrituras de snapshot a disco
+_escrito        = {}                # pid → (gen, seq) del último snapshot escrito
+
+# ── Cabecera del índice (embeddings.header.json) ─────────────────────────────
+# Registra con qué proveedor/modelo y dimensión se construyó el índice. Los
+# vectores se guardan normalizados y se busca por producto interno (= coseno),
+# así los umbrales no dependen de la escala de cada modelo. Si la config pasa a
+# otro modelo, el índice sigue usando el de la cabecera (consultas incluidas)
+# hasta reindexar: nunca se mezclan vectores de modelos distintos.
+
+# ── Ids estables ──────────────────────────────────────────────────────────────
+# Cada vector tiene un id de 64 bits que no cambia nunca (ni al borrar otros,
+# ni al promover, ni al reindexar) y no se reutiliza: es el embedding_id que
+# guardan memoria_episodica, mensajes y memoria_permanente. Flat y HNSW van
+# envueltos en IndexIDMap2; los IVF guardan los ids en sus listas (DirectMap
+# Hashtable). Borrar es remove_ids: cuesta lo borrado, no el tamaño del índice.
+# HNSW no sabe borrar: sus bajas quedan como lápidas (vector sin metadata, la
+# búsqueda lo saltea) hasta la próxima reconstrucción.
+
+# ── Metadata en SQLite ────────────────────────────────────────────────────────
+# Tabla `vectores` de memoria.db (la crea init_database_personaje): una fila
+# por vector, clave = id estable, índices por tipo y timestamp. Tras una
+# búsqueda se leen solo las filas de los resultados; un alta inserta solo sus
+# filas. Las filas se escriben al aplicar cada registro del WAL, que sigue
+# siendo la fuente de verdad: al reproducirlo se reescriben (INSERT OR REPLACE
+# / DELETE son idempotentes).
+
+# ── Mapeo a memoria (faiss.mmap) ──────────────────────────────────────────────
+# Con faiss.mmap = true, embeddings.index se abre mapeado y de solo lectura
+# (IO_FLAG_MMAP_IFC): cargar o cambiar de personaje no lee los vectores, el
+# sistema operativo los pagina a demanda y no cuentan para memoryBudgetMB.
+# El índice mapeado NUNCA se modifica (FAISS aborta el proceso si se intenta):
+#   - las altas van a un índice delta chico en RAM (flat), que se busca junto
+#     con el base y se fusiona con él al escribir el próximo snapshot;
+#   - las bajas de vectores del base quedan como lápidas (sin fila en
+#     `vectores`, la búsqueda las saltea) hasta ese mismo snapshot.
+# Después de cada snapshot (compactación, guardar_faiss, promoción,
+# reindexado) se vuelve a mapear el archivo nuevo con un delta vacío.
+# IO_FLAG_MMAP_IFC no existe en las versiones viejas de faiss-cpu: sin él,
+# faiss.mmap queda desactivado y el índice se lee entero en RAM.
+_FLAG_MMAP = getattr(faiss, 'IO_FLAG_MMAP_IFC', None)
 
 
 def _get_modelo_embedding():
@@ -39,59 +128,1294 @@ def _get_modelo_embedding():
         return 'mistral-embed'
 
 
-def init_faiss_personaje(pid):
-    """Carga el índice FAISS del personaje, o crea uno nuevo si no existe."""
-    global faiss_index, embeddings_metadata
+def _wal_leer(ruta):
+    """
+    Lee todos los registros completos del WAL. Si el último quedó cortado
+    (crash a mitad de escritura) lo descarta y trunca el archivo a lo válido.
+    """
+    if not os.path.exists(ruta):
+        return []
+    with open(ruta, 'rb') as f:
+        crudo = f.read()
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(crudo)
+    registros, valido = [], 0
+    try:
+        for reg in unpacker:
+            registros.append(reg)
+            valido = unpacker.tell()
+    except Exception as e:
+        print(f"⚠️ WAL FAISS corrupto desde byte {valido}: {e}")
+    if valido < len(crudo):
+        print(f"⚠️ WAL FAISS: descartando {len(crudo) - valido} bytes de un registro incompleto")
+        with open(ruta, 'r+b') as f:
+            f.truncate(valido)
+    return registros
+
+
+def _wal_append(pid, registro):
+    """Agrega un registro al WAL del personaje y lo fuerza a disco. Devuelve el tamaño del WAL."""
+    with open(paths(pid)['emb_wal'], 'ab') as f:
+        f.write(msgpack.packb(registro, use_bin_type=True))
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def _wal_aplicar(index, delta, conn, registro, prox_id):
+    """
+    Aplica un registro del WAL (alta, baja o vaciado) sobre un índice que
+    todavía NO está publicado y sobre la tabla `vectores` (conn, sin commit).
+    delta: el de _copia_escribible() en modo mmap (el registro va ahí); si se
+    guardan los vectores completos lo decide el almacenamiento del base.
+    Devuelve el próximo id libre.
+    """
+    base = index
+    if delta is not None:
+        index = delta
+    op = registro.get('op')
+    if op == 'add':
+        if registro['dim'] != index.d:
+            print(f"⚠️ WAL FAISS: registro {registro.get('seq')} de {registro['dim']} dims "
+                  f"no entra en un índice de {index.d}, se descarta")
+            return prox_id
+        # Registros previos a la normalización se normalizan al reproducirlos
+        vecs = _normalizar(np.frombuffer(registro['vec'], dtype=np.float32).reshape(-1, registro['dim']))
+        # Registros previos a los ids estables: ids consecutivos (= posiciones)
+        ids = np.asarray(registro.get('ids') or range(prox_id, prox_id + len(vecs)), dtype=np.int64)
+        index.add_with_ids(vecs, ids)
+        completos = _guarda_completos(_almacenamiento_indice(base))
+        _meta_insertar(conn, ids.tolist(), registro['meta'], vecs if completos else None)
+        return max(prox_id, int(ids.max()) + 1)
+    if op == 'del':
+        _quitar_ids(index, registro['ids'])
+        conn.executemany('DELETE FROM vectores WHERE id=?', [(i,) for i in registro['ids']])
+    elif op == 'reset':
+        index.reset()
+        conn.execute('DELETE FROM vectores')
+    return prox_id
+
+
+def _publicar(alm, index, seq, nueva_generacion=False, cabecera=None, prox_id=None, vivos=None,
+              delta=None):
+    """
+    Publica una versión nueva del índice del almacén. Llamar con alm.lock tomado.
+    delta: el de _copia_escribible() para seguir en modo mmap; None = índice
+    en RAM sin delta (reconstrucciones).
+    """
+    global faiss_index
+    previo = alm.snapshot
+    gen = next(_generaciones) if nueva_generacion else previo.gen
+    alm.snapshot = _Snapshot(index, seq, gen,
+                             previo.cabecera if cabecera is None else cabecera,
+                             previo.prox_id if prox_id is None else prox_id,
+                             previo.vivos if vivos is None else vivos,
+                             delta)
+    if alm.pid == _pid_activo:
+        faiss_index = index
+
+
+def _wal_recortar(pid, hasta_seq):
+    """Reescribe el WAL dejando solo los registros posteriores a hasta_seq. Llamar con el lock del almacén."""
+    ruta = paths(pid)['emb_wal']
+    restantes = [r for r in _wal_leer(ruta) if r.get('seq', 0) > hasta_seq]
+    tmp = ruta + '.tmp'
+    with open(tmp, 'wb') as f:
+        for r in restantes:
+            f.write(msgpack.packb(r, use_bin_type=True))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, ruta)
+
+
+def _escribir_snapshot(pid, snap):
+    """
+    Escribe un snapshot completo de forma atómica (tmp + os.replace).
+    Orden: primero el índice, después el registro de commit (seq, prox_id,
+    cabecera). Si hay un crash entre ambos, _cargar_almacen() recorta los
+    vectores con id >= prox_id del commit y reproduce el WAL desde su seq.
+    La metadata de los vectores ya está en SQLite: acá no se reescribe.
+
+    Se escribe fuera del lock del almacén, así que dos hilos pueden competir (una
+    compactación lenta y un reemplazo del índice): si ya se escribió una
+    versión más nueva, esta se descarta. Devuelve True si escribió.
+    """
+    p = paths(pid)
+    with _disco_lock:
+        if _escrito.get(pid, (-1, -1)) > (snap.gen, snap.seq):
+            return False
+        index = snap.index if snap.delta is None else _fusionar(pid, snap)
+        faiss.write_index(index, p['emb'] + '.tmp')
+        os.replace(p['emb'] + '.tmp', p['emb'])
+        with open(p['emb_m'] + '.tmp', 'wb') as f:
+            f.write(msgpack.packb({'seq': snap.seq, 'prox_id': snap.prox_id,
+                                   'cabecera': snap.cabecera}, use_bin_type=True))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(p['emb_m'] + '.tmp', p['emb_m'])
+        if snap.cabecera:
+            _escribir_cabecera(pid, snap.cabecera)
+        _escrito[pid] = (snap.gen, snap.seq)
+        return True
+
+
+def _normalizar(vecs):
+    """Copia float32 contigua con norma 1 por fila (para búsqueda por coseno)."""
+    vecs = np.array(vecs, dtype=np.float32, copy=True, order='C')
+    if vecs.ndim == 1:
+        vecs = vecs.reshape(1, -1)
+    faiss.normalize_L2(vecs)
+    return vecs
+
+
+def _indice_vacio(dim):
+    """Índice exacto vacío, direccionable por id."""
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+
+def _leer_indice(ruta, mapear=False):
+    """read_index normal, o mapeado y de solo lectura (los vectores quedan en disco)."""
+    if mapear and _FLAG_MMAP is not None:
+        return faiss.read_index(ruta, _FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    return faiss.read_index(ruta)
+
+
+def _en_memoria(index):
+    """Copia en RAM, escribible, de un índice (p. ej. uno mapeado)."""
+    return faiss.deserialize_index(faiss.serialize_index(index))
+
+
+def _copia_escribible(snap):
+    """
+    (index, delta) listos para aplicar un registro del WAL sin tocar lo
+    publicado. En modo mmap solo se clona el delta: el registro va a `delta`.
+    """
+    if snap.delta is None:
+        return faiss.clone_index(snap.index), None
+    return snap.index, faiss.clone_index(snap.delta)
+
+
+def _ntotal(snap):
+    """Vectores en el índice publicado, lápidas incluidas (base + delta)."""
+    return snap.index.ntotal + (snap.delta.ntotal if snap.delta is not None else 0)
+
+
+def _fusionar(pid, snap):
+    """Índice en RAM con base + delta y sin lápidas: lo que se escribe a disco en modo mmap."""
+    index = _en_memoria(snap.index)
+    _preparar_indice(index)
+    if not snap.vivos:
+        index.reset()   # vaciado: que ni HNSW deje lápidas
+        return index
+    if snap.delta.ntotal:
+        ids, vecs = _vectores_de(snap.delta)
+        index.add_with_ids(vecs, ids)
+    if index.ntotal != snap.vivos:
+        bajas = np.setdiff1d(_ids_de(index), _ids_vigentes(pid, hasta=snap.prox_id))
+        index = _quitar_ids(index, bajas)
+    return index
+
+
+def _remapear(alm, escrito):
+    """
+    Tras escribir `escrito` a disco: si faiss.mmap está activo vuelve a mapear
+    embeddings.index y deja en el delta solo las altas posteriores. Se saltea
+    si en el medio se reconstruyó el índice o se escribió otra versión.
+    Llamar con alm.lock tomado.
+    """
+    actual = alm.snapshot
+    if not _get_config_faiss().get('mmap') or actual.gen != escrito.gen:
+        return
+    with _disco_lock:
+        if _escrito.get(alm.pid) != (escrito.gen, escrito.seq):
+            return
+        base = _leer_indice(paths(alm.pid)['emb'], mapear=True)
+    _preparar_indice(base)
+    delta = _indice_vacio(base.d)
+    altas = _ids_vigentes(alm.pid, desde=escrito.prox_id)
+    if len(altas):
+        delta.add_with_ids(_reconstruir(actual, altas), altas)
+    _publicar(alm, base, actual.seq, delta=delta)
+
+
+def _con_ids(index):
+    """
+    Deja un índice leído de disco direccionable por id. Los índices anteriores
+    a los ids estables se envuelven tal cual: id = posición, sin copiar vectores.
+    Los IVF ya guardaban la posición como id en sus listas.
+    """
+    if isinstance(index, faiss.IndexIDMap2) or faiss.try_extract_index_ivf(index) is not None:
+        return _preparar_indice(index)
+    mapa = faiss.IndexIDMap2(index)
+    faiss.copy_array_to_vector(np.arange(index.ntotal, dtype=np.int64), mapa.id_map)
+    mapa.construct_rev_map()
+    return mapa
+
+
+def _ids_de(index):
+    """Todos los ids del índice, en su orden interno."""
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.vector_to_array(index.id_map).astype(np.int64)
+    invlists = faiss.extract_index_ivf(index).invlists
+    partes = [faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+              for l in range(invlists.nlist) if invlists.list_size(l)]
+    return np.concatenate(partes).astype(np.int64) if partes else np.zeros(0, dtype=np.int64)
+
+
+def _vectores_de(index):
+    """(ids, vectores) de todo el índice. En IVF-PQ los vectores son aproximados."""
+    ids = _ids_de(index)
+    if not len(ids):
+        return ids, np.zeros((0, index.d), dtype=np.float32)
+    if isinstance(index, faiss.IndexIDMap2):
+        return ids, index.index.reconstruct_n(0, index.ntotal)
+    return ids, index.reconstruct_batch(ids)
+
+
+def _vectores_vivos(pid, snap):
+    """(ids, vectores) de un snapshot (base + delta) sin las lápidas (ids sin metadata)."""
+    ids, vecs = _vectores_de(snap.index)
+    if snap.delta is not None and snap.delta.ntotal:
+        ids_d, vecs_d = _vectores_de(snap.delta)
+        ids, vecs = np.concatenate([ids, ids_d]), np.vstack([vecs, vecs_d])
+    if len(ids) != snap.vivos:
+        vivos = np.isin(ids, _ids_vigentes(pid, hasta=snap.prox_id))
+        ids, vecs = ids[vivos], vecs[vivos]
+    return ids, vecs
+
+
+def _reconstruir(snap, ids):
+    """Vectores de esos ids del snapshot, estén en el índice base o en el delta."""
+    ids = np.asarray(ids, dtype=np.int64)
+    if snap.delta is None or not snap.delta.ntotal:
+        return snap.index.reconstruct_batch(ids)
+    en_delta = np.isin(ids, _ids_de(snap.delta))
+    vecs = np.empty((len(ids), snap.index.d), dtype=np.float32)
+    if en_delta.any():
+        vecs[en_delta] = snap.delta.reconstruct_batch(ids[en_delta])
+    if not en_delta.all():
+        vecs[~en_delta] = snap.index.reconstruct_batch(ids[~en_delta])
+    return vecs
+
+
+def _buscar(snap, consultas, k, params=None):
+    """search() sobre base + delta, combinando por similitud. Devuelve (sims, ids)."""
+    sims, ids = snap.index.search(consultas, k, params=params)
+    if snap.delta is None or not snap.delta.ntotal:
+        return sims, ids
+    sims_d, ids_d = snap.delta.search(consultas, min(k, snap.delta.ntotal))
+    sims, ids = np.hstack([sims, sims_d]), np.hstack([ids, ids_d])
+    orden = np.argsort(-sims, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(sims, orden, axis=1), np.take_along_axis(ids, orden, axis=1)
+
+
+def _meta_insertar(conn, ids, metas, vecs=None):
+    """Filas de un alta. vecs: vectores completos para re-puntuar (None = no se guardan)."""
+    blobs = [None] * len(ids) if vecs is None else [v.tobytes() for v in np.asarray(vecs, dtype=np.float32)]
+    conn.executemany(
+        'INSERT OR REPLACE INTO vectores (id, tipo, texto, metadata, timestamp, vector) VALUES (?,?,?,?,?,?)',
+        [(i, m.get('tipo', 'episodio'), _texto_guardado(m), _str_meta(m.get('metadata')), m.get('timestamp'), b)
+         for i, m, b in zip(ids, metas, blobs)]
+    )
+
+
+def _texto_guardado(meta):
+    """Texto a guardar en la fila. None si no hay (episodios muy viejos): reindexado lo busca en la DB."""
+    if meta.get('texto'):
+        return meta['texto']
+    if 'mensaje_usuario' in meta:
+        return _extraer_texto_meta(meta)
+    return None
+
+
+def _str_meta(valor):
+    if valor is None or isinstance(valor, str):
+        return valor
+    return json.dumps(valor, ensure_ascii=False)
+
+
+def _meta_filas(pid, ids, con_vector=False):
+    """
+    {id: meta} de los ids pedidos que tengan fila (los que no, son lápidas).
+    con_vector: agrega 'vector' (float32 completo, o None si no se guardó).
+    """
+    filas = {}
+    ids = [int(i) for i in ids]
+    if not ids:
+        return filas
+    columnas = 'id, tipo, texto, metadata, timestamp' + (', vector' if con_vector else '')
+    with _get_conn(paths(pid)['db']) as conn:
+        for i in range(0, len(ids), 500):
+            lote = ids[i:i + 500]
+            for fila in conn.execute(
+                    f'SELECT {columnas} FROM vectores '
+                    f'WHERE id IN ({",".join("?" * len(lote))})', lote):
+                filas[fila[0]] = {'tipo': fila[1], 'texto': fila[2] or '',
+                                  'metadata': fila[3], 'timestamp': fila[4]}
+                if con_vector:
+                    filas[fila[0]]['vector'] = (np.frombuffer(fila[5], dtype=np.float32)
+                                                if fila[5] else None)
+    return filas
+
+
+def _con_vectores_completos(pid, ids, vecs):
+    """Reemplaza en vecs (decodificados de un índice cuantizado) los que tengan vector completo guardado."""
+    vecs  = np.array(vecs, dtype=np.float32, copy=True)
+    filas = _meta_filas(pid, ids, con_vector=True)
+    for pos, i in enumerate(ids.tolist()):
+        v = filas.get(i, {}).get('vector')
+        if v is not None and len(v) == vecs.shape[1]:
+            vecs[pos] = v
+    return vecs
+
+
+def _guardar_vectores_completos(pid, ids, vecs):
+    """Guarda los vectores completos de filas ya existentes (conversión, reindexado)."""
+    vecs = np.asarray(vecs, dtype=np.float32)
+    with _get_conn(paths(pid)['db']) as conn:
+        conn.executemany('UPDATE vectores SET vector=? WHERE id=?',
+                         [(v.tobytes(), int(i)) for i, v in zip(ids, vecs)])
+
+
+def _repuntuar(emb, ids, sims, filas):
+    """
+    Re-puntuación con los vectores completos: la similitud exacta reemplaza a
+    la del índice cuantizado (si la fila no tiene vector, queda la aproximada).
+    Devuelve (ids, sims) ordenados de mayor a menor similitud.
+    """
+    sims = np.array(sims, dtype=np.float32, copy=True)
+    for pos, i in enumerate(ids):
+        v = filas.get(i, {}).get('vector')
+        if v is not None and len(v) == emb.shape[1]:
+            sims[pos] = float(v @ emb[0])
+    orden = np.argsort(-sims, kind='stable')
+    return [ids[j] for j in orden], sims[orden]
+
+
+def _ids_vigentes(pid, desde=0, hasta=None, limite=None):
+    """Ids con metadata en [desde, hasta), en orden, como array int64."""
+    sql, args = 'SELECT id FROM vectores WHERE id >= ?', [int(desde)]
+    if hasta is not None:
+        sql += ' AND id < ?'
+        args.append(int(hasta))
+    sql += ' ORDER BY id'
+    if limite:
+        sql += ' LIMIT ?'
+        args.append(int(limite))
+    with _get_conn(paths(pid)['db']) as conn:
+        return np.array([r[0] for r in conn.execute(sql, args)], dtype=np.int64)
+
+
+def _quitar_ids(index, ids, reconstruir=False):
+    """
+    Saca ids de un índice que todavía NO está publicado. Devuelve el índice.
+    HNSW no soporta remove_ids: sin reconstruir=True los ids quedan como
+    lápidas (hay que sacarlos de la metadata); con True se rearma sin ellos.
+    """
+    ids = np.asarray(list(ids), dtype=np.int64)
+    if not len(ids):
+        return index
+    # El DirectMap Hashtable de IVF solo borra con IDSelectorArray; el
+    # IndexIDMap2 consulta el selector por cada vector, ahí conviene Batch.
+    if isinstance(index, faiss.IndexIDMap2):
+        selector = faiss.IDSelectorBatch(ids)
+    else:
+        selector = faiss.IDSelectorArray(ids)
+    try:
+        index.remove_ids(selector)
+        return index
+    except RuntimeError:
+        if not reconstruir:
+            return index
+        todos, vecs = _vectores_de(index)
+        quedan = ~np.isin(todos, ids)
+        if not quedan.any():
+            index.reset()
+            return index
+        return _construir_indice(_tipo_indice(index), vecs[quedan], todos[quedan], _get_config_faiss())
+
+
+def _modelo_configurado():
+    """(proveedor, modelo) de embeddings según api_config.json."""
+    try:
+        from utils import cargar_config_apis
+        cfg    = cargar_config_apis()
+        modelo = cfg.get('models', {}).get('embeddings', 'mistral-embed') or 'mistral-embed'
+        return _detectar_proveedor_embedding(modelo, cfg), modelo
+    except Exception:
+        return 'mistral', 'mistral-embed'
+
+
+def _dim_modelo(modelo):
+    """Dimensión conocida del modelo, o None (se detecta con el primer vector)."""
+    from modelos_utils import obtener_dimensiones_embedding
+    return obtener_dimensiones_embedding(modelo)
+
+
+def _leer_cabecera(pid):
+    ruta = paths(pid)['emb_header']
+    if not os.path.exists(ruta):
+        return {}
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ Cabecera FAISS ilegible ({e}), se regenera")
+        return {}
+
+
+def _escribir_cabecera(pid, cabecera):
+    ruta = paths(pid)['emb_header']
+    with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(cabecera, f, ensure_ascii=False, indent=2)
+    os.replace(ruta + '.tmp', ruta)
+
+
+def _nueva_cabecera(proveedor, modelo, dim):
+    return {'proveedor': proveedor, 'modelo': modelo, 'dim': int(dim),
+            'metrica': 'ip', 'normalizado': True,
+            'creado': now_argentina().isoformat()}
+
+
+def _modelo_indice(pid):
+    """
+    (proveedor, modelo) con el que hay que embeber para este personaje: el de
+    la cabecera de su índice, o el configurado si todavía no tiene índice.
+    """
+    alm = _residente(pid)
+    cab = alm.snapshot.cabecera if alm else _leer_cabecera(pid)
+    if cab.get('modelo'):
+        return cab.get('proveedor') or 'mistral', cab['modelo']
+    return _modelo_configurado()
+
+
+def _migrar_a_coseno(index):
+    """
+    Índices legacy (L2 sin normalizar, sin ids) → mismo tipo, vectores
+    normalizados, producto interno e id = posición.
+    """
+    vecs = _normalizar(index.reconstruct_n(0, index.ntotal)) if index.ntotal else None
+    ids  = np.arange(index.ntotal, dtype=np.int64)
+    tipo = _tipo_indice(index)
+    if vecs is None or tipo == 'flat':
+        nuevo = _indice_vacio(index.d)
+        if vecs is not None:
+            nuevo.add_with_ids(vecs, ids)
+        return nuevo
+    return _construir_indice(tipo, vecs, ids, _get_config_faiss())
+
+
+def _vincular_hechos(pid):
+    """
+    Migración a ids estables: completa memoria_permanente.embedding_id de los
+    hechos viejos buscando su texto en la tabla vectores (el más nuevo gana).
+    Así borrar un hecho guardado antes de la migración también borra su vector.
+    """
+    try:
+        with _get_conn(paths(pid)['db']) as conn:
+            texto_hecho = "mp.categoria || ': ' || mp.clave || ' - ' || mp.valor"
+            vinculados = conn.execute(f'''UPDATE memoria_permanente AS mp SET embedding_id = (
+                    SELECT MAX(v.id) FROM vectores v
+                    WHERE v.tipo = 'memoria_permanente' AND v.texto = {texto_hecho})
+                WHERE mp.embedding_id IS NULL AND EXISTS (
+                    SELECT 1 FROM vectores v
+                    WHERE v.tipo = 'memoria_permanente' AND v.texto = {texto_hecho})''').rowcount
+        if vinculados:
+            print(f"🔗 FAISS [{pid}]: {vinculados} hechos vinculados a su vector")
+    except Exception as e:
+        print(f"⚠️ No se pudieron vincular hechos a sus vectores: {e}")
+
+
+def _cargar_almacen(pid):
+    """
+    Lee de disco el índice FAISS del personaje (o crea uno nuevo si no existe)
+    y reproduce el WAL: las altas posteriores al último snapshot.
+    Verifica la cabecera: migra índices legacy a coseno y deja en
+    alm.desalineado el motivo si el modelo configurado ya no es el del índice.
+    Snapshots viejos con la metadata adentro del msgpack se pasan a la tabla
+    vectores y se reescriben sin ella.
+    No registra el almacén: eso lo hace _almacen() / init_faiss_personaje().
+    """
     p = paths(pid)
-    with _faiss_lock:
-        if os.path.exists(p['emb']):
-            faiss_index = faiss.read_index(p['emb'])
+    init_database_personaje(pid)
+    proveedor_cfg, modelo_cfg = _modelo_configurado()
+    mapear = bool(_get_config_faiss().get('mmap'))
+    seq_snapshot = 0
+    prox_id  = 0
+    cabecera = _leer_cabecera(pid)
+    migrado  = False
+    legado   = False
+    if os.path.exists(p['emb']):
+        index = _leer_indice(p['emb'], mapear)
+        items = None
+        if os.path.exists(p['emb_m']):
             with open(p['emb_m'], 'rb') as f:
-                embeddings_metadata = msgpack.unpackb(f.read(), raw=False)
-            print(f"✅ FAISS cargado: {faiss_index.ntotal} vectores")
-        else:
-            faiss_index = faiss.IndexFlatL2(1024)
-            embeddings_metadata = []
-            print("✅ Nuevo índice FAISS creado")
+                guardado = msgpack.unpackb(f.read(), raw=False, strict_map_key=False)
+            # Formato legacy: lista pelada sin número de secuencia
+            items = guardado
+            if isinstance(guardado, dict):
+                items        = guardado.get('items')
+                seq_snapshot = guardado.get('seq', 0)
+                prox_id      = guardado.get('prox_id', 0)
+                # La cabecera del commit manda sobre el .json suelto
+                cabecera     = guardado.get('cabecera') or cabecera
+            if isinstance(items, list):
+                # Antes de los ids estables: id = posición en el índice
+                items   = dict(enumerate(items))
+                prox_id = len(items)
+                legado  = True
+        if mapear and (items is not None or index.metric_type != faiss.METRIC_INNER_PRODUCT or not (
+                isinstance(index, faiss.IndexIDMap2) or faiss.try_extract_index_ivf(index) is not None)):
+            # Hay que migrarlo: primero en RAM, se vuelve a mapear tras reescribirlo
+            index  = _en_memoria(index)
+            mapear = False
+        if items is not None:
+            # Antes de la tabla vectores: la metadata venía en el snapshot
+            with _get_conn(p['db']) as conn:
+                conn.execute('DELETE FROM vectores')
+                _meta_insertar(conn, list(items), list(items.values()))
+            migrado = True
+            print(f"🔄 FAISS [{pid}]: metadata de {len(items)} vectores pasada a SQLite")
+        if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+            # Índice legacy: L2 sin normalizar, sin cabecera. Hasta ahora
+            # solo entraban vectores de 1024 dims → mistral-embed salvo que
+            # el modelo configurado tenga esa misma dimensión.
+            index   = _migrar_a_coseno(index)
+            migrado = True
+            if not cabecera:
+                if _dim_modelo(modelo_cfg) == index.d:
+                    cabecera = _nueva_cabecera(proveedor_cfg, modelo_cfg, index.d)
+                else:
+                    cabecera = _nueva_cabecera('mistral', 'mistral-embed', index.d)
+            print(f"🔄 FAISS legacy migrado a coseno: {index.ntotal} vectores ({cabecera['modelo']})")
+        index = _con_ids(index)
+        migrado = migrado or legado
+        # Crash entre escribir índice y commit: los ids asignados después del
+        # commit son huérfanos (el WAL los vuelve a agregar)
+        ids = _ids_de(index)
+        huerfanos = ids[ids >= prox_id]
+        if len(huerfanos):
+            if mapear:
+                index, mapear = _en_memoria(index), False
+            index = _quitar_ids(index, huerfanos, reconstruir=True)
+            print(f"⚠️ FAISS: {len(huerfanos)} vectores sin commit descartados (se recuperan del WAL)")
+        print(f"✅ FAISS cargado [{pid}]: {index.ntotal} vectores")
+    else:
+        dim      = _dim_modelo(modelo_cfg) or 1024
+        index    = _indice_vacio(dim)
+        mapear   = False
+        cabecera = _nueva_cabecera(proveedor_cfg, modelo_cfg, dim)
+        _escribir_cabecera(pid, cabecera)
+        print(f"✅ Nuevo índice FAISS creado [{pid}] ({modelo_cfg}, {dim} dims)")
+
+    if not cabecera.get('modelo'):
+        cabecera = _nueva_cabecera(proveedor_cfg, modelo_cfg, index.d)
+        _escribir_cabecera(pid, cabecera)
+    if cabecera.get('dim') != index.d:
+        print(f"⚠️ Cabecera FAISS decía {cabecera.get('dim')} dims pero el índice tiene {index.d}: se corrige")
+        cabecera['dim'] = index.d
+        _escribir_cabecera(pid, cabecera)
+
+    seq = seq_snapshot
+    reproducidos = 0
+    delta = _indice_vacio(index.d) if mapear else None
+    with _get_conn(p['db']) as conn:
+        # Filas de altas posteriores al commit: el WAL las vuelve a escribir
+        conn.execute('DELETE FROM vectores WHERE id >= ?', (prox_id,))
+        for reg in _wal_leer(p['emb_wal']):
+            if reg.get('seq', 0) <= seq_snapshot:
+                continue
+            prox_id = _wal_aplicar(index, delta, conn, reg, prox_id)
+            seq = reg['seq']
+            reproducidos += 1
+        vivos = conn.execute('SELECT COUNT(*) FROM vectores').fetchone()[0]
+    if reproducidos:
+        print(f"✅ WAL FAISS: {reproducidos} registro(s) reproducidos → {vivos} vectores")
+    if not vivos and (cabecera.get('proveedor'), cabecera.get('modelo')) != (proveedor_cfg, modelo_cfg):
+        # Índice vacío: no hay nada que reindexar, se adopta el modelo nuevo
+        index    = _indice_vacio(_dim_modelo(modelo_cfg) or index.d)
+        delta    = None
+        cabecera = _nueva_cabecera(proveedor_cfg, modelo_cfg, index.d)
+        migrado  = True
+
+    _preparar_indice(index)
+    alm = _Almacen(pid, _Snapshot(index, seq, next(_generaciones), cabecera, prox_id, vivos, delta))
+    if migrado:
+        _escribir_snapshot(pid, alm.snapshot)
+        _wal_recortar(pid, seq)
+        _remapear(alm, alm.snapshot)
+    if legado:
+        _vincular_hechos(pid)
+
+    if (cabecera.get('proveedor'), cabecera.get('modelo')) != (proveedor_cfg, modelo_cfg):
+        alm.desalineado = (f"índice con {cabecera.get('proveedor')}:{cabecera.get('modelo')} "
+                           f"({index.d} dims), config con {proveedor_cfg}:{modelo_cfg}")
+        print(f"⚠️ FAISS [{pid}]: {alm.desalineado}. Se sigue embebiendo con el modelo del índice hasta reindexar")
+    return alm
+
+
+def _get_config_residencia():
+    """(máximo de personajes residentes, presupuesto en bytes) desde api_config.json → faiss."""
+    cfg = _get_config_faiss()
+    return max(1, int(cfg.get('maxResident', 8))), float(cfg.get('memoryBudgetMB', 1024)) * 1024 * 1024
+
+
+def _bytes_indice(index, mapeado=False):
+    """
+    Estimación de la memoria que ocupa un índice (vectores + estructura).
+    mapeado: los vectores (y las listas IVF) están en disco, no cuentan.
+    """
+    n       = index.ntotal
+    interno = _interno(index)
+    if isinstance(interno, faiss.IndexHNSW):
+        m = interno.hnsw.nb_neighbors(0)
+        codigo = faiss.downcast_index(interno.storage).code_size
+        return n * ((0 if mapeado else codigo) + m * 4 * 1.5 + 16)
+    if isinstance(interno, faiss.IndexIVF):
+        return n * ((0 if mapeado else interno.code_size + 8) + 16)
+    return n * ((0 if mapeado else interno.code_size) + 16)   # + id_map / rev_map
+
+
+def _bytes_almacen(snap):
+    """Memoria residente de un snapshot: en modo mmap, estructura del base + delta."""
+    if snap.delta is None:
+        return _bytes_indice(snap.index)
+    return _bytes_indice(snap.index, mapeado=True) + _bytes_indice(snap.delta)
+
+
+def _expulsar_sobrantes(pid_actual):
+    """
+    Saca del registro a los menos usados hasta entrar en el presupuesto. Nunca
+    expulsa a pid_actual ni al personaje activo. Llamar con _registro_lock. Lo expulsado ya está en
+    disco (snapshot + WAL): volver a ese personaje solo cuesta releerlo.
+    """
+    max_residentes, presupuesto = _get_config_residencia()
+    total = sum(_bytes_almacen(a.snapshot) for a in _almacenes.values())
+    for pid in list(_almacenes):
+        if len(_almacenes) <= 1:
+            break
+        if len(_almacenes) <= max_residentes and total <= presupuesto:
+            break
+        if pid in (pid_actual, _pid_activo):
+            continue
+        alm = _almacenes.pop(pid)
+        with alm.lock:
+            alm.vigente = False
+        total -= _bytes_almacen(alm.snapshot)
+        print(f"📤 FAISS: índice de {pid} fuera de memoria (LRU)")
+
+
+def _residente(pid):
+    """Almacén del personaje si está en memoria, sin cargarlo ni tocar el orden LRU."""
+    with _registro_lock:
+        return _almacenes.get(pid)
+
+
+def _almacen(pid=None):
+    """
+    Devuelve el almacén del personaje, cargándolo de disco si no está residente.
+    pid=None → personaje activo (compatibilidad; los módulos pasan el pid explícito).
+    """
+    pid = pid or get_personaje_activo_id()
+    with _registro_lock:
+        alm = _almacenes.get(pid)
+        if alm is not None:
+            _almacenes.move_to_end(pid)
+            return alm
+        carga = _carga_locks.setdefault(pid, threading.Lock())
+    with carga:
+        with _registro_lock:
+            alm = _almacenes.get(pid)
+            if alm is not None:
+                _almacenes.move_to_end(pid)
+                return alm
+        alm = _cargar_almacen(pid)
+        _registrar(alm)
+    _al_cargar(alm)
+    return alm
+
+
+def _registrar(alm):
+    """Pone el almacén en el registro (reemplazando uno viejo del mismo pid) y aplica el LRU."""
+    global faiss_index
+    with _registro_lock:
+        viejo = _almacenes.pop(alm.pid, None)
+        if viejo is not None:
+            with viejo.lock:
+                viejo.vigente = False
+        _almacenes[alm.pid] = alm
+        _expulsar_sobrantes(alm.pid)
+    if alm.pid == _pid_activo:
+        faiss_index = alm.snapshot.index
+
+
+def _al_cargar(alm):
+    """Trabajos de fondo que pueden corresponder a un índice recién cargado."""
+    _promover_si_corresponde(alm)
+    from .reindexado import reanudar_reindexado
+    reanudar_reindexado(alm.pid)
+
+
+def init_faiss_personaje(pid):
+    """
+    (Re)carga desde disco el índice FAISS del personaje y lo deja residente.
+    Si ya había uno en memoria se reemplaza: sus escritores en curso reintentan
+    sobre el nuevo. Para solo asegurarse de que esté cargado, usar _almacen().
+    """
+    with _registro_lock:
+        carga = _carga_locks.setdefault(pid, threading.Lock())
+        viejo = _almacenes.get(pid)
+    with carga:
+        if viejo is not None:
+            # Cortar escritores del viejo ANTES de leer el WAL: nada se agrega a
+            # disco que la carga nueva no vea.
+            with viejo.lock:
+                viejo.vigente = False
+        alm = _cargar_almacen(pid)
+        _registrar(alm)
+    _al_cargar(alm)
 
 
 def guardar_faiss(pid=None):
     """
-    Persiste el índice FAISS a disco.
+    Persiste un snapshot completo del índice FAISS y vacía el WAL.
     Usa pid explícito para evitar guardar en el personaje equivocado
     si hubo un cambio de personaje mientras se procesaba un mensaje.
+    Las altas normales NO pasan por acá (van al WAL); se usa después de
+    reconstrucciones completas como limpiar_faiss_episodios().
     """
-    p = paths(pid)
-    faiss.write_index(faiss_index, p['emb'])
-    with open(p['emb_m'], 'wb') as f:
-        f.write(msgpack.packb(embeddings_metadata, use_bin_type=True))
+    alm = _almacen(pid)
+    with alm.lock:
+        snap = alm.snapshot
+        _escribir_snapshot(alm.pid, snap)
+        _wal_recortar(alm.pid, snap.seq)
+        _remapear(alm, snap)
+
+
+def _compactar_faiss(pid):
+    """
+    Vuelca la versión publicada del índice a un snapshot nuevo y recorta el WAL.
+    Como lo publicado es inmutable, la escritura pesada se hace FUERA del lock
+    sin copiar nada: las altas que llegan mientras tanto siguen entrando al WAL.
+    En modo mmap es acá donde el delta se fusiona con el base.
+    """
+    try:
+        alm = _residente(pid)
+        if alm is None:
+            return
+        snap = alm.snapshot
+        if not _escribir_snapshot(pid, snap):
+            return
+        with alm.lock:
+            _wal_recortar(pid, snap.seq)
+            _remapear(alm, snap)
+        print(f"✅ FAISS compactado [{pid}]: {snap.vivos} vectores (seq {snap.seq})")
+    except Exception as e:
+        print(f"⚠️ Error compactando FAISS: {e}")
+    finally:
+        _compactando.discard(pid)
+
+
+def _compactar_en_fondo(pid):
+    """Lanza la compactación en un hilo daemon si no hay otra en curso para ese personaje."""
+    if pid in _compactando:
+        return
+    _compactando.add(pid)
+    threading.Thread(target=_compactar_faiss, args=(pid,), daemon=True).start()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# TIPOS DE ÍNDICE (flat / IVF / HNSW) Y PROMOCIÓN AUTOMÁTICA
+# Modificar acá si querés cambiar los umbrales o agregar otro tipo de índice.
+#
+# IndexFlatL2 es exacto pero lineal: con cientos de miles de vectores cada
+# búsqueda tarda decenas de ms. Con faiss.indexType = "auto" el índice se
+# promueve solo a IVF-Flat (y más adelante a IVF-PQ) cuando ntotal cruza los
+# umbrales; con un tipo explícito se usa ese tipo en cuanto hay datos para
+# entrenarlo. El entrenamiento y la reconstrucción corren en un hilo daemon
+# sobre el snapshot publicado; las altas que llegan mientras tanto se copian
+# al índice nuevo antes de publicarlo. El índice entrenado queda en
+# embeddings.index, así que al reiniciar no se vuelve a entrenar.
+#
+# faiss.storage elige cómo se guarda cada vector dentro del tipo: float
+# (4 bytes por dimensión), sq8 (1 byte, 4x menos) o pq (pqM bytes en total,
+# 16x o más). Cambiarlo dispara la misma reconstrucción que una promoción
+# (o convertir_almacenamiento_faiss() para hacerlo ya, en todos los
+# personajes). Con faiss.rerank los vectores completos se guardan además en
+# la columna vectores.vector y los mejores candidatos se re-puntúan con ellos.
+# ─────────────────────────────────────────────────────────────────────────────
+
+_TIPOS_INDICE = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+_ALMACENAMIENTOS = ('float', 'sq8', 'pq')
+_ESCALA_AUTO  = ('flat', 'ivf_flat', 'ivf_pq')   # orden de promoción en modo auto
+_promoviendo  = set()             # pids con promoción en curso
+
+_CONFIG_FAISS_DEFAULT = {
+    'indexType':    'auto',       # auto | flat | ivf_flat | ivf_pq | hnsw
+    'ivfThreshold': 20000,        # auto: desde acá IVF-Flat
+    'pqThreshold':  500000,       # auto: desde acá IVF-PQ (comprimido)
+    'nprobe':       16,           # listas IVF visitadas por búsqueda
+    'efSearch':     64,           # amplitud de búsqueda HNSW
+    'hnswM':        32,           # vecinos por nodo HNSW
+    'pqM':          64,           # subcuantizadores PQ (se ajusta a un divisor de la dimensión)
+    'reindexAuto':  True,         # re-embeber solo al detectar cambio de modelo (reindexado.py)
+    'reindexPauseMs': 500,        # pausa entre lotes del re-embebido
+    'maxResident':  8,            # personajes con el índice en memoria a la vez
+    'memoryBudgetMB': 1024,       # tope de memoria entre todos los índices residentes
+    'mmap':         True,         # abrir embeddings.index mapeado (solo lectura) + delta en RAM
+    'storage':      'float',      # float | sq8 | pq: cómo se guarda cada vector en el índice
+    'rerank':       True,         # con sq8/pq: re-puntuar los candidatos con el vector completo
+    'rerankFactor': 4,            # candidatos extra por resultado pedido al re-puntuar
+    'hybrid':       True,         # fusionar con la búsqueda léxica FTS5 (busqueda_lexica.py)
+    'embedTimeoutMs': 1500,       # presupuesto del embedding de la query; pasado, solo léxica
+}
+
+
+def _get_config_faiss():
+    """Lee la sección faiss de api_config.json, completando con los defaults."""
+    cfg = dict(_CONFIG_FAISS_DEFAULT)
+    try:
+        from utils import cargar_config_apis
+        cfg.update(cargar_config_apis().get('faiss', {}) or {})
+    except Exception:
+        pass
+    if _FLAG_MMAP is None:
+        cfg['mmap'] = False   # faiss sin soporte de mmap (ver MAPEO A MEMORIA)
+    return cfg
+
+
+def _interno(index):
+    """El índice que guarda los vectores (el envuelto por IndexIDMap2, si lo hay)."""
+    if isinstance(index, faiss.IndexIDMap2):
+        index = index.index
+    return faiss.downcast_index(index)
+
+
+def _tipo_indice(index):
+    """Nombre del tipo de un índice FAISS ya construido."""
+    index = _interno(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(index, faiss.IndexIVF):
+        return 'ivf_flat'
+    return 'flat'
+
+
+def _almacenamiento_indice(index):
+    """Cómo guarda los vectores un índice ya construido: float, sq8 o pq."""
+    interno = _interno(index)
+    if isinstance(interno, faiss.IndexHNSW):
+        interno = faiss.downcast_index(interno.storage)
+    if isinstance(interno, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return 'pq'
+    if isinstance(interno, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return 'sq8'
+    return 'float'
+
+
+def _almacenamiento_objetivo(tipo, cfg):
+    """Almacenamiento pedido por faiss.storage (IVF-PQ ya es PQ por definición)."""
+    if tipo == 'ivf_pq':
+        return 'pq'
+    almacenamiento = cfg.get('storage', 'float')
+    return almacenamiento if almacenamiento in _ALMACENAMIENTOS else 'float'
+
+
+def _guarda_completos(almacenamiento, cfg=None):
+    """
+    True si hay que guardar también el vector completo (re-puntuación) para
+    un índice con ese almacenamiento: el del índice real, no faiss.storage
+    (auto promueve a IVF-PQ aunque storage sea float).
+    """
+    cfg = cfg or _get_config_faiss()
+    return bool(cfg.get('rerank')) and almacenamiento != 'float'
+
+
+def _tipo_objetivo(ntotal, cfg):
+    """Tipo de índice que corresponde a este tamaño según la config."""
+    tipo = cfg.get('indexType', 'auto')
+    if tipo in _TIPOS_INDICE:
+        return tipo
+    if ntotal >= int(cfg['pqThreshold']):
+        return 'ivf_pq'
+    if ntotal >= int(cfg['ivfThreshold']):
+        return 'ivf_flat'
+    return 'flat'
+
+
+def _nlist_para(ntotal):
+    """Cantidad de listas IVF: ~√n, acotada para que el entrenamiento tenga datos."""
+    return int(max(16, min(65536, np.sqrt(ntotal))))
+
+
+def _minimo_para_entrenar(tipo, ntotal, almacenamiento='float'):
+    """
+    Vectores necesarios antes de construir ese tipo (IVF necesita ~39 por
+    lista; PQ, 39 por cada uno de sus 256 centroides; SQ8, rangos estables).
+    """
+    minimo = _nlist_para(ntotal) * 39 if tipo in ('ivf_flat', 'ivf_pq') else 0
+    if almacenamiento == 'pq' and tipo != 'ivf_pq':
+        minimo = max(minimo, 256 * 39)
+    elif almacenamiento == 'sq8':
+        minimo = max(minimo, 1000)
+    return minimo
+
+
+def _pq_m(dim, pedido):
+    """Mayor divisor de dim que no supere lo pedido (PQ exige que m divida la dimensión)."""
+    for m in range(min(int(pedido), dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def _factory_indice(tipo, dim, ntotal, cfg, almacenamiento='float'):
+    """Cadena de faiss.index_factory para el tipo y almacenamiento pedidos."""
+    if tipo == 'ivf_pq':
+        almacenamiento = 'pq'
+    codigo = {'float': 'Flat', 'sq8': 'SQ8', 'pq': f"PQ{_pq_m(dim, cfg['pqM'])}"}[almacenamiento]
+    if tipo in ('ivf_flat', 'ivf_pq'):
+        return f"IVF{_nlist_para(ntotal)},{codigo}"
+    if tipo == 'hnsw':
+        return f"HNSW{int(cfg['hnswM'])}" + ('' if almacenamiento == 'float' else f",{codigo}")
+    return codigo
+
+
+def _preparar_indice(index):
+    """
+    Deja el índice listo para reconstruct() y remove_ids() por id: los IVF
+    no guardan el mapa id → lista por defecto. Hashtable (y no Array) porque
+    los ids no son posiciones. Llamar ANTES de publicarlo.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type != faiss.DirectMap.Hashtable:
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index
+
+
+def _construir_indice(tipo, vecs, ids, cfg):
+    """
+    Entrena (si hace falta) y llena un índice nuevo del tipo pedido con vecs / ids.
+    Con faiss.storage sq8/pq, mientras no haya datos para entrenar se usa float.
+    """
+    n, dim = vecs.shape
+    almacenamiento = _almacenamiento_objetivo(tipo, cfg)
+    if n < _minimo_para_entrenar(tipo, n, almacenamiento):
+        almacenamiento = 'float'
+    index = faiss.index_factory(dim, _factory_indice(tipo, dim, n, cfg, almacenamiento),
+                                faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        muestra = vecs
+        tope = max(_nlist_para(n), 256) * 256
+        if n > tope:
+            muestra = vecs[np.random.default_rng(0).choice(n, tope, replace=False)]
+        index.train(muestra)
+    if faiss.try_extract_index_ivf(index) is None:
+        index = faiss.IndexIDMap2(index)
+    _preparar_indice(index)
+    index.add_with_ids(vecs, np.asarray(ids, dtype=np.int64))
+    return index
+
+
+def _promover_si_corresponde(alm):
+    """Chequeo barato tras cada alta/carga: lanza la promoción si el tipo quedó chico."""
+    if alm.pid in _promoviendo or not alm.vigente:
+        return
+    cfg  = _get_config_faiss()
+    snap = alm.snapshot
+    n    = snap.vivos
+    actual = _tipo_indice(snap.index)
+    if actual == 'hnsw' and _ntotal(snap) - n > _ntotal(snap) * 0.2:
+        tipo = 'hnsw'   # demasiadas lápidas: reconstruir sin ellas
+    else:
+        tipo = _tipo_objetivo(n, cfg)
+        almacenamiento = _almacenamiento_objetivo(tipo, cfg)
+        if (tipo, almacenamiento) == (actual, _almacenamiento_indice(snap.index)):
+            return
+        if n < max(1, _minimo_para_entrenar(tipo, n, almacenamiento)):
+            return
+        # En auto solo se sube: tras una limpieza grande no vale la pena volver a flat
+        if cfg.get('indexType', 'auto') not in _TIPOS_INDICE and (
+                actual == 'hnsw' or _ESCALA_AUTO.index(tipo) < _ESCALA_AUTO.index(actual)):
+            return
+    _promoviendo.add(alm.pid)
+    threading.Thread(target=_promover_indice, args=(alm, tipo, cfg), daemon=True).start()
+
+
+def _promover_indice(alm, tipo, cfg):
+    """
+    Reconstruye el índice publicado como `tipo` sin bloquear altas ni búsquedas.
+    Al final, con el lock, copia las altas y aplica las bajas que entraron
+    durante el entrenamiento, y publica. Si en el medio hubo una reconstrucción
+    (limpieza, cambio de personaje) se descarta: la próxima alta vuelve a
+    evaluar la promoción. Las lápidas de HNSW no pasan al índice nuevo.
+    Si el índice viejo estaba cuantizado se parte de los vectores completos
+    de la tabla vectores (los que estén), no de los decodificados.
+    """
+    pid = alm.pid
+    try:
+        base = alm.snapshot
+        origen = f"{_tipo_indice(base.index)}/{_almacenamiento_indice(base.index)}"
+        destino = f"{tipo}/{_almacenamiento_objetivo(tipo, cfg)}"
+        print(f"🏗️ FAISS: promoviendo índice {origen} → {destino} ({base.vivos} vectores)...")
+        ids, vecs = _vectores_vivos(pid, base)
+        cuantizado = _almacenamiento_indice(base.index) != 'float'
+        if cuantizado:
+            vecs = _con_vectores_completos(pid, ids, vecs)
+        nuevo = _construir_indice(tipo, vecs, ids, cfg)
+        # Según lo que quedó construido (con pocos datos sq8/pq sigue en float)
+        completos = _guarda_completos(_almacenamiento_indice(nuevo), cfg)
+        if completos and not cuantizado:
+            _guardar_vectores_completos(pid, ids, vecs)
+        with alm.lock:
+            actual = alm.snapshot
+            if not alm.vigente or actual.gen != base.gen:
+                print("⚠️ FAISS: promoción descartada (el índice se reconstruyó mientras tanto)")
+                return
+            altas = _ids_vigentes(pid, desde=base.prox_id, hasta=actual.prox_id)
+            if len(altas):
+                vecs_altas = _reconstruir(actual, altas)
+                if cuantizado:
+                    vecs_altas = _con_vectores_completos(pid, altas, vecs_altas)
+                elif completos:
+                    _guardar_vectores_completos(pid, altas, vecs_altas)
+                nuevo.add_with_ids(vecs_altas, altas)
+            if actual.vivos != base.vivos + len(altas):
+                bajas = np.setdiff1d(ids, _ids_vigentes(pid, hasta=base.prox_id))
+                nuevo = _quitar_ids(nuevo, bajas)
+            _publicar(alm, nuevo, actual.seq, nueva_generacion=True)
+            snap = alm.snapshot
+        # Persistir ya: el entrenamiento no se repite al reiniciar
+        _escribir_snapshot(pid, snap)
+        with alm.lock:
+            _wal_recortar(pid, snap.seq)
+            _remapear(alm, snap)
+        print(f"✅ FAISS promovido a {destino} [{pid}]: {snap.vivos} vectores")
+    except Exception as e:
+        print(f"⚠️ Error promoviendo índice FAISS: {e}")
+    finally:
+        _promoviendo.discard(pid)
+
+
+def _parametros_busqueda(index, nprobe=None, ef_search=None):
+    """
+    Parámetros por llamada (no se tocan los del índice compartido). Sin
+    valores explícitos se usan faiss.nprobe / faiss.efSearch de la config.
+    """
+    tipo = _tipo_indice(index)
+    if tipo == 'flat':
+        return None
+    cfg = _get_config_faiss()
+    if tipo == 'hnsw':
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search or cfg['efSearch']))
+    return faiss.SearchParametersIVF(nprobe=int(nprobe or cfg['nprobe']))
+
+
+def evaluar_recall_faiss(k=10, n_consultas=200, nprobe=None, ef_search=None, pid=None):
+    """
+    Mide el recall@k del índice publicado contra una búsqueda exacta (flat)
+    sobre los mismos vectores, para elegir nprobe / efSearch.
+    nprobe y ef_search aceptan un valor o una lista (barrido).
+    Las consultas son vectores del propio índice. Con almacenamiento sq8/pq la
+    verdad y las consultas salen de los vectores completos de la tabla
+    vectores (los que estén; sin ellos, de los decodificados del índice y el
+    recall no ve lo perdido al cuantizar). Ahí también se mide el recall
+    después de re-puntuar (faiss.rerank), como en la búsqueda real.
+    """
+    pid   = pid or get_personaje_activo_id()
+    snap  = _almacen(pid).snapshot
+    index = snap.index
+    tipo  = _tipo_indice(index)
+    almacenamiento = _almacenamiento_indice(index)
+    ids, vecs = _vectores_vivos(pid, snap)
+    n     = len(ids)
+    if n == 0:
+        return {'tipo': tipo, 'almacenamiento': almacenamiento, 'ntotal': 0, 'resultados': []}
+    cfg   = _get_config_faiss()
+    k     = min(int(k), n)
+    completos = 0
+    filas = {}
+    if almacenamiento != 'float':
+        filas = _meta_filas(pid, ids, con_vector=True)
+        completos = sum(1 for f in filas.values() if f.get('vector') is not None)
+        vecs = _con_vectores_completos(pid, ids, vecs)
+    consultas = vecs[np.random.default_rng(0).choice(n, min(int(n_consultas), n), replace=False)]
+
+    exacto = faiss.IndexFlatIP(vecs.shape[1])
+    exacto.add(vecs)
+    t0 = time.perf_counter()
+    _, verdad = exacto.search(consultas, k)
+    ms_flat = (time.perf_counter() - t0) * 1000 / len(consultas)
+    verdad = ids[verdad]   # posiciones del flat → ids estables
+
+    def _recall(resultados):
+        aciertos = sum(len(set(a) & set(v)) for a, v in zip(resultados, verdad))
+        return round(aciertos / (len(consultas) * k), 4)
+
+    # Re-puntuación solo si el índice es cuantizado y hay vectores completos
+    repuntuar = bool(cfg.get('rerank')) and completos > 0
+    factor = max(1, int(cfg.get('rerankFactor', 4)))
+
+    # Solo se barre el parámetro que usa este tipo de índice
+    valores = ef_search if tipo == 'hnsw' else nprobe
+    if not isinstance(valores, (list, tuple)):
+        valores = [valores]
+
+    resultados = []
+    for valor in valores:
+        params = _parametros_busqueda(index, nprobe=valor, ef_search=valor)
+        t0 = time.perf_counter()
+        _, aprox = _buscar(snap, consultas, k, params=params)
+        ms = (time.perf_counter() - t0) * 1000 / len(consultas)
+        fila = {'recall': _recall(aprox), 'ms_por_consulta': round(ms, 3)}
+        if repuntuar:
+            t0 = time.perf_counter()
+            sims, cands = _buscar(snap, consultas, min(k * factor, _ntotal(snap)), params=params)
+            repuntuados = []
+            for q, s_q, c_q in zip(consultas, sims, cands):
+                validos = c_q >= 0
+                orden, _ = _repuntuar(q.reshape(1, -1), c_q[validos].tolist(), s_q[validos], filas)
+                repuntuados.append(orden[:k])
+            fila['recall_repuntuado'] = _recall(repuntuados)
+            fila['ms_por_consulta_repuntuado'] = round((time.perf_counter() - t0) * 1000 / len(consultas), 3)
+        if tipo == 'hnsw':
+            fila['efSearch'] = params.efSearch
+        elif tipo != 'flat':
+            fila['nprobe'] = params.nprobe
+        resultados.append(fila)
+    return {'tipo': tipo, 'almacenamiento': almacenamiento, 'ntotal': n, 'k': k,
+            'consultas': len(consultas), 'vectores_completos': completos,
+            'ms_por_consulta_flat': round(ms_flat, 3), 'resultados': resultados}
+
+
+def convertir_almacenamiento_faiss(almacenamiento=None, pid=None, todos=False):
+    """
+    Migración en el lugar: reescribe embeddings.index con el almacenamiento de
+    faiss.storage (o con `almacenamiento`, que además queda guardado en la
+    config). pid=None → personaje activo; todos=True → todos los personajes.
+    Es la misma reconstrucción que una promoción pero sincrónica: al volver,
+    el archivo ya está reescrito. Devuelve un resumen por personaje.
+    """
+    if almacenamiento is not None:
+        if almacenamiento not in _ALMACENAMIENTOS:
+            raise ValueError(f"almacenamiento desconocido: {almacenamiento}")
+        from utils import cargar_config_apis, guardar_config_apis
+        config = cargar_config_apis()
+        config.setdefault('faiss', {})['storage'] = almacenamiento
+        guardar_config_apis(config)
+    cfg  = _get_config_faiss()
+    pids = [p['id'] for p in listar_personajes()] if todos else [pid or get_personaje_activo_id()]
+    resumen = []
+    for p in pids:
+        alm = _almacen(p)
+        while p in _promoviendo:   # la carga pudo lanzar la misma conversión en segundo plano
+            time.sleep(0.1)
+        snap     = alm.snapshot
+        tipo     = _tipo_indice(snap.index)
+        objetivo = _almacenamiento_objetivo(tipo, cfg)
+        ruta     = paths(p)['emb']
+        fila = {'pid': p, 'tipo': tipo, 'antes': _almacenamiento_indice(snap.index),
+                'bytes_antes': os.path.getsize(ruta) if os.path.exists(ruta) else 0}
+        if fila['antes'] != objetivo:
+            if snap.vivos < _minimo_para_entrenar(tipo, snap.vivos, objetivo):
+                fila['error'] = f"{snap.vivos} vectores: pocos para entrenar {objetivo}"
+            else:
+                _promoviendo.add(p)
+                _promover_indice(alm, tipo, cfg)
+        fila['despues'] = _almacenamiento_indice(alm.snapshot.index)
+        fila['bytes_despues'] = os.path.getsize(ruta) if os.path.exists(ruta) else 0
+        print(f"🗜️ FAISS [{p}]: {fila['antes']} → {fila['despues']} "
+              f"({fila['bytes_antes'] // 1024} KB → {fila['bytes_despues'] // 1024} KB)")
+        resumen.append(fila)
+    return resumen
 
 
-def get_faiss_ntotal():
-    """Devuelve faiss_index.ntotal de forma segura para módulos externos."""
-    return faiss_index.ntotal
+def get_faiss_ntotal(pid=None):
+    """Devuelve la cantidad de vectores vigentes del índice publicado (sin lápidas)."""
+    return _almacen(pid).snapshot.vivos
+
+
+def eliminar_embeddings(ids, pid=None):
+    """
+    Borra vectores por su embedding_id (el que guardan memoria_episodica,
+    mensajes y memoria_permanente). Va al WAL como un registro de baja y se
+    aplica con remove_ids: el costo es proporcional a lo borrado.
+    Ids inexistentes o None se ignoran. Devuelve cuántos se borraron.
+    """
+    ids = {int(i) for i in ids if i is not None}
+    if not ids:
+        return 0
+    pid_actual = pid or get_personaje_activo_id()
+    for _ in range(3):
+        alm = _almacen(pid_actual)
+        with alm.lock:
+            if not alm.vigente:
+                continue   # el almacén salió del registro (LRU o recarga): otra vez
+            base = alm.snapshot
+            presentes = sorted(_meta_filas(pid_actual, ids))
+            if not presentes:
+                return 0
+            registro = {'seq': base.seq + 1, 'op': 'del', 'ids': presentes}
+            tam_wal  = _wal_append(pid_actual, registro)
+            index, delta = _copia_escribible(base)
+            with _get_conn(paths(pid_actual)['db']) as conn:
+                _wal_aplicar(index, delta, conn, registro, base.prox_id)
+            _publicar(alm, index, registro['seq'], vivos=base.vivos - len(presentes), delta=delta)
+            break
+    else:
+        return 0
+    snap = alm.snapshot
+    lapidas = _ntotal(snap) - snap.vivos
+    if tam_wal > _WAL_MAX_BYTES or (snap.delta is not None and lapidas > _ntotal(snap) * 0.2
+                                    and _tipo_indice(snap.index) != 'hnsw'):
+        # En modo mmap las bajas del base son lápidas: las saca el próximo
+        # snapshot (las de HNSW, la promoción)
+        _compactar_en_fondo(pid_actual)
+    _promover_si_corresponde(alm)
+    return len(presentes)
 
 
 def limpiar_faiss_episodios(pid_actual):
-    """Elimina del índice FAISS los vectores de tipo 'episodio'. Llamado por limpiar_historial."""
-    global faiss_index, embeddings_metadata
-    nuevos_embs, nueva_meta = [], []
-    for i, meta in enumerate(embeddings_metadata):
-        if meta.get('tipo') != 'episodio' and i < faiss_index.ntotal:
-            nuevos_embs.append(faiss_index.reconstruct(i))
-            nueva_meta.append(meta)
-    faiss_index = faiss.IndexFlatL2(1024)
-    if nuevos_embs:
-        faiss_index.add(np.array(nuevos_embs, dtype=np.float32))
-    embeddings_metadata = nueva_meta
+    """Elimina del índice FAISS los vectores de episodios. Llamado por limpiar_historial."""
+    _almacen(pid_actual)
+    with _get_conn(paths(pid_actual)['db']) as conn:
+        ids = [r[0] for r in conn.execute(
+            "SELECT id FROM vectores WHERE tipo IN ('episodio', 'episodio_continuar')")]
+    return eliminar_embeddings(ids, pid_actual)
+
+
+def vaciar_faiss(pid_actual):
+    """
+    Saca TODOS los vectores del personaje (reset total). Conserva el tipo de
+    índice entrenado y el contador de ids: un id nunca se reutiliza.
+    """
+    alm = _almacen(pid_actual)
+    with alm.lock:
+        snap = alm.snapshot
+        registro = {'seq': snap.seq + 1, 'op': 'reset'}
+        _wal_append(pid_actual, registro)
+        # Mismo tipo de índice: clonar y vaciar conserva el entrenamiento IVF.
+        # En modo mmap el base queda entero como lápidas hasta guardar_faiss().
+        index, delta = _copia_escribible(snap)
+        with _get_conn(paths(pid_actual)['db']) as conn:
+            _wal_aplicar(index, delta, conn, registro, snap.prox_id)
+        _preparar_indice(index)
+        _publicar(alm, index, registro['seq'], nueva_generacion=True, vivos=0, delta=delta)
     guardar_faiss(pid_actual)
 
 
 def cargar_personaje(pid):
-    """Orquesta la carga completa: DB + FAISS + escenario default."""
+    """
+    Orquesta la carga completa: DB + FAISS + escenario default.
+    Si el índice del personaje sigue residente (LRU) no se relee de disco.
+    """
+    global _pid_activo, faiss_index
     set_personaje_activo_id(pid)
     init_database_personaje(pid)
-    init_faiss_personaje(pid)
+    _pid_activo = pid
+    faiss_index = _almacen(pid).snapshot.index
     _asegurar_escenario_default(pid)
     print(f"✅ Personaje activo: {pid}")
 
@@ -145,50 +1469,63 @@ def _detectar_proveedor_embedding(modelo_id, cfg):
 # ─────────────────────────────────────────────────────────────────────────────
 # SUB-FUNCIONES DE EMBEDDING POR PROVEEDOR
 # Modificar acá si querés agregar un proveedor nuevo (ej: Voyage, Cohere v4)
+#
+# Todas reciben una LISTA de textos y devuelven una matriz float32 (n, dim).
+# El troceado en lotes lo hace obtener_embeddings_batch() según _LOTE_MAXIMO.
 # ─────────────────────────────────────────────────────────────────────────────
 
-def _embedding_mistral(texto):
-    """Embedding via Mistral."""
+# Máximo de textos por request que acepta cada proveedor (con margen de seguridad)
+_LOTE_MAXIMO = {
+    'mistral': 64,
+    'openai':  256,
+    'cohere':  96,    # límite duro de la API v1/embed
+    'jina':    128,
+    'ollama':  32,
+}
+
+
+def _embeddings_mistral(textos, modelo=None):
+    """Embeddings via Mistral."""
     from utils import _get_mistral_client
     client = _get_mistral_client()   # inicializa lazy desde api_config.json
     if not client:
         raise RuntimeError("Cliente Mistral no disponible")
     response = client.embeddings.create(
-        model=_get_modelo_embedding(),
-        inputs=[texto]
+        model=modelo or _get_modelo_embedding(),
+        inputs=list(textos)
     )
-    return np.array(response.data[0].embedding, dtype=np.float32)
+    return np.array([d.embedding for d in response.data], dtype=np.float32)
 
 
-def _embedding_openai(texto, modelo, cfg):
-    """Embedding via OpenAI o endpoint compatible."""
-    import requests
+def _embeddings_openai(textos, modelo, cfg):
+    """Embeddings via OpenAI o endpoint compatible."""
+    http = http_cliente()
     api_key  = (cfg.get('openai', {}).get('apiKey') or '').strip()
     endpoint = (cfg.get('openai', {}).get('endpoint') or 'https://api.openai.com/v1').rstrip('/')
     if not api_key:
         raise RuntimeError("OpenAI API key no configurada")
-    resp = requests.post(
+    resp = http.post(
         f"{endpoint}/embeddings",
         headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-        json={"model": modelo, "input": texto},
+        json={"model": modelo, "input": list(textos)},
         timeout=30
     )
     resp.raise_for_status()
-    data = resp.json()
-    return np.array(data['data'][0]['embedding'], dtype=np.float32)
+    data = sorted(resp.json()['data'], key=lambda d: d.get('index', 0))
+    return np.array([d['embedding'] for d in data], dtype=np.float32)
 
 
-def _embedding_cohere(texto, modelo, cfg):
-    """Embedding via Cohere. Ideal para español."""
-    import requests
+def _embeddings_cohere(textos, modelo, cfg):
+    """Embeddings via Cohere. Ideal para español."""
+    http = http_cliente()
     api_key = (cfg.get('cohere', {}).get('apiKey') or '').strip()
     if not api_key:
         raise RuntimeError("Cohere API key no configurada")
-    resp = requests.post(
+    resp = http.post(
         'https://api.cohere.com/v1/embed',
         headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
         json={
-            "texts": [texto],
+            "texts": list(textos),
             "model": modelo,
             "input_type": "search_document",
             "truncate": "END"
@@ -197,163 +1534,397 @@ def _embedding_cohere(texto, modelo, cfg):
     )
     resp.raise_for_status()
     data = resp.json()
-    return np.array(data['embeddings'][0], dtype=np.float32)
+    return np.array(data['embeddings'], dtype=np.float32)
 
 
-def _embedding_jina(texto, modelo, cfg):
-    """Embedding via Jina AI."""
-    import requests
+def _embeddings_jina(textos, modelo, cfg):
+    """Embeddings via Jina AI."""
+    http = http_cliente()
     api_key = (cfg.get('jina', {}).get('apiKey') or '').strip()
     if not api_key:
         raise RuntimeError("Jina API key no configurada")
-    resp = requests.post(
+    resp = http.post(
         'https://api.jina.ai/v1/embeddings',
         headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-        json={"input": [texto], "model": modelo},
+        json={"input": list(textos), "model": modelo},
         timeout=30
     )
     resp.raise_for_status()
-    data = resp.json()
-    return np.array(data['data'][0]['embedding'], dtype=np.float32)
+    data = sorted(resp.json()['data'], key=lambda d: d.get('index', 0))
+    return np.array([d['embedding'] for d in data], dtype=np.float32)
 
 
-def _embedding_ollama(texto, modelo, cfg):
-    """Embedding via Ollama local."""
-    import requests
+def _embeddings_ollama(textos, modelo, cfg):
+    """
+    Embeddings via Ollama local.
+    Usa /api/embed (acepta lista, Ollama >= 0.3). Si el servidor es viejo y no
+    lo tiene, cae a /api/embeddings texto por texto.
+    """
+    http = http_cliente()
     endpoint = (cfg.get('ollama', {}).get('endpoint') or 'http://localhost:11434').rstrip('/')
-    resp = requests.post(
-        f"{endpoint}/api/embeddings",
-        json={"model": modelo, "prompt": texto},
+    resp = http.post(
+        f"{endpoint}/api/embed",
+        json={"model": modelo, "input": list(textos)},
         timeout=60
     )
-    resp.raise_for_status()
-    data = resp.json()
-    return np.array(data['embedding'], dtype=np.float32)
+    if resp.status_code != 404:
+        resp.raise_for_status()
+        return np.array(resp.json()['embeddings'], dtype=np.float32)
+
+    vectores = []
+    for texto in textos:
+        r = http.post(
+            f"{endpoint}/api/embeddings",
+            json={"model": modelo, "prompt": texto},
+            timeout=60
+        )
+        r.raise_for_status()
+        vectores.append(r.json()['embedding'])
+    return np.array(vectores, dtype=np.float32)
+
 
+def _embeddings_proveedor(proveedor, textos, modelo, cfg):
+    """Despacha un lote (ya troceado) al proveedor correspondiente."""
+    if proveedor == 'openai':
+        return _embeddings_openai(textos, modelo, cfg)
+    elif proveedor == 'cohere':
+        return _embeddings_cohere(textos, modelo, cfg)
+    elif proveedor == 'jina':
+        return _embeddings_jina(textos, modelo, cfg)
+    elif proveedor == 'ollama':
+        return _embeddings_ollama(textos, modelo, cfg)
+    else:
+        return _embeddings_mistral(textos, modelo)
 
-def obtener_embedding(texto):
+
+def _en_lotes(proveedor, modelo, textos, fn, cfg=None):
     """
-    Genera embedding vectorial del texto.
-    Proveedor determinado por api_config.json → models.embedding_provider
-    Soporta: mistral, openai, cohere, jina, ollama
+    Trocea textos según el límite del proveedor y apila las matrices resultantes.
+    Cada lote es un request: antes de mandarlo espera cupo en el limitador
+    (rpmLimit del proveedor, con la prioridad del hilo que pide).
+    """
+    tam = _LOTE_MAXIMO.get(proveedor, 32)
+    partes = []
+    for i in range(0, len(textos), tam):
+        esperar_turno(proveedor, modelo, cfg)
+        partes.append(fn(textos[i:i + tam]))
+    return np.vstack(partes).astype(np.float32, copy=False)
+
+
+def obtener_embeddings_batch(textos, pid=None, modelo=None):
+    """
+    Genera embeddings para varios textos con la menor cantidad de requests posible.
+    Trocea según el límite de lote de cada proveedor y devuelve UNA matriz
+    float32 de forma (len(textos), dim), en el mismo orden que la entrada.
+    Mismo proveedor y mismo fallback a Mistral que obtener_embedding().
+
+    Antes de ir a la red consulta la caché persistente del personaje
+    (cache_embeddings.py): solo se piden al proveedor los textos que faltan.
+
+    modelo: (proveedor, modelo) fijo, p. ej. el de la cabecera del índice.
+    Con un modelo fijo distinto de mistral-embed no hay fallback: un vector
+    de otro modelo no es comparable con los del índice.
     """
-    proveedor = '?'
+    textos = list(textos)
+    if not textos:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    proveedor, fijo = '?', modelo is not None
     try:
         from utils import cargar_config_apis
-        cfg       = cargar_config_apis()
-        modelo    = cfg.get('models', {}).get('embeddings', 'mistral-embed') or 'mistral-embed'
-        proveedor = _detectar_proveedor_embedding(modelo, cfg)
-
-        print(f"🔍 Embedding [{proveedor}] modelo={modelo}")
-
-        if proveedor == 'openai':
-            return _embedding_openai(texto, modelo, cfg)
-        elif proveedor == 'cohere':
-            return _embedding_cohere(texto, modelo, cfg)
-        elif proveedor == 'jina':
-            return _embedding_jina(texto, modelo, cfg)
-        elif proveedor == 'ollama':
-            return _embedding_ollama(texto, modelo, cfg)
+        cfg = cargar_config_apis()
+        if fijo:
+            proveedor, modelo = modelo
         else:
-            return _embedding_mistral(texto)
+            modelo    = cfg.get('models', {}).get('embeddings', 'mistral-embed') or 'mistral-embed'
+            proveedor = _detectar_proveedor_embedding(modelo, cfg)
+        clave_cache = f"{proveedor}:{modelo}"
+
+        en_cache = cache_buscar(pid, clave_cache, textos)
+        faltan   = [i for i in range(len(textos)) if i not in en_cache]
+        if not faltan:
+            return np.vstack([en_cache[i] for i in range(len(textos))])
+
+        print(f"🔍 Embedding [{proveedor}] modelo={modelo} textos={len(faltan)} (caché: {len(en_cache)})")
+        nuevos = _en_lotes(proveedor, modelo, [textos[i] for i in faltan],
+                           lambda lote: _embeddings_proveedor(proveedor, lote, modelo, cfg), cfg)
+        cache_guardar(pid, clave_cache, [textos[i] for i in faltan], nuevos)
+
+        if not en_cache:
+            return nuevos
+        resultado = np.empty((len(textos), nuevos.shape[1]), dtype=np.float32)
+        for i, v in en_cache.items():
+            resultado[i] = v
+        resultado[faltan] = nuevos
+        return resultado
 
     except Exception as e:
         print(f"❌ Error embedding [{proveedor}]: {e}")
+        if fijo and modelo != 'mistral-embed':
+            raise   # el fallback daría vectores incompatibles con el índice
         try:
+            # El resultado del fallback NO se cachea: quedaría guardado bajo la
+            # clave del modelo configurado siendo un vector de mistral-embed.
             print("⚠️ Fallback a Mistral embed...")
-            return _embedding_mistral(texto)
+            return _en_lotes('mistral', 'mistral-embed', textos,
+                             lambda lote: _embeddings_mistral(lote, 'mistral-embed'))
         except Exception as e2:
             print(f"❌ Fallback Mistral también falló: {e2}")
             raise
 
 
-def agregar_embedding(texto, tipo, metadata_extra=""):
-    """Agrega un vector al índice. Devuelve el embedding_id asignado, o None si falla."""
-    global faiss_index, embeddings_metadata
-    pid_actual = get_personaje_activo_id()
-    emb = obtener_embedding(texto)
-    if emb is None:
+def obtener_embedding(texto, pid=None):
+    """
+    Genera embedding vectorial del texto.
+    Proveedor determinado por api_config.json → models.embedding_provider
+    Soporta: mistral, openai, cohere, jina, ollama
+    """
+    return obtener_embeddings_batch([texto], pid=pid)[0]
+
+
+def agregar_embedding(texto, tipo, metadata_extra="", pid=None):
+    """Agrega un vector al índice del personaje. Devuelve el embedding_id asignado, o None si falla."""
+    ids = agregar_embeddings_batch([(texto, tipo, metadata_extra)], pid=pid)
+    return ids[0] if ids else None
+
+
+def agregar_embeddings_batch(items, pid=None):
+    """
+    Versión masiva de agregar_embedding.
+    items: lista de tuplas (texto, tipo, metadata_extra).
+    Pide todos los embeddings en lotes, agrega la matriz entera al índice y
+    la persiste como UN registro del WAL (append + fsync, sin reescribir el
+    índice). Devuelve la lista de embedding_id (ids estables, nunca
+    reutilizados) en el mismo orden.
+    pid: personaje dueño del índice (None = activo). Un cambio de personaje
+    en medio del post-proceso ya no desvía el alta.
+    """
+    items = list(items)
+    if not items:
+        return []
+    pid_actual = pid or get_personaje_activo_id()
+    ts = now_argentina().isoformat()
+    for _ in range(3):
+        alm    = _almacen(pid_actual)
+        modelo = _modelo_indice(pid_actual)
+        embs = obtener_embeddings_batch([texto for texto, _, _ in items], pid=pid_actual, modelo=modelo)
+        if embs is None or len(embs) != len(items):
+            return []
+        embs = _normalizar(embs)
+        with alm.lock:
+            if not alm.vigente:
+                continue   # el almacén salió del registro (LRU o recarga): otra vez
+            base = alm.snapshot
+            if base.cabecera and (base.cabecera.get('proveedor'), base.cabecera.get('modelo')) != modelo:
+                continue   # un reindexado cambió el modelo mientras se embebía: otra vez
+            if embs.shape[1] != base.index.d:
+                if base.index.ntotal:
+                    print(f"❌ FAISS: vectores de {embs.shape[1]} dims para un índice de {base.index.d}, alta descartada")
+                    return []
+                # Índice vacío con dimensión supuesta: se ajusta a la real del modelo
+                base = base._replace(index=_indice_vacio(embs.shape[1]), delta=None,
+                                     cabecera=dict(base.cabecera, dim=int(embs.shape[1])))
+                _escribir_cabecera(pid_actual, base.cabecera)
+                print(f"📐 FAISS: dimensión detectada {embs.shape[1]}")
+            registro = {
+                'seq': base.seq + 1, 'op': 'add', 'dim': int(embs.shape[1]),
+                'vec': embs.tobytes(),
+                'ids': list(range(base.prox_id, base.prox_id + len(items))),
+                'meta': [{'tipo': tipo, 'texto': texto,
+                          'metadata': metadata_extra, 'timestamp': ts}
+                         for texto, tipo, metadata_extra in items],
+            }
+            # Primero al WAL (durable), después a memoria: si el fsync falla no
+            # queda un vector en el índice que no sobreviva a un reinicio.
+            tam_wal = _wal_append(pid_actual, registro)
+            # Copy-on-write: los lectores en curso siguen con `base` intacto
+            index, delta = _copia_escribible(base)
+            with _get_conn(paths(pid_actual)['db']) as conn:
+                prox_id = _wal_aplicar(index, delta, conn, registro, base.prox_id)
+            _publicar(alm, index, registro['seq'], cabecera=base.cabecera,
+                      prox_id=prox_id, vivos=base.vivos + len(items), delta=delta)
+            ids = registro['ids']
+            break
+    else:
+        return []
+    if tam_wal > _WAL_MAX_BYTES:
+        _compactar_en_fondo(pid_actual)
+    _promover_si_corresponde(alm)
+    return ids
+
+
+_consultas_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='embed-query')
+
+
+def _embeber_consulta(query, pid, cfg):
+    """
+    Embebe la query con el modelo del índice dentro del presupuesto
+    faiss.embedTimeoutMs (0 = sin límite). Devuelve el vector normalizado o
+    None si falla o tarda más: el llamado sigue en segundo plano y su
+    resultado queda en la caché de embeddings para la próxima vez.
+    """
+    fut = _consultas_pool.submit(
+        lambda: obtener_embeddings_batch([query], pid=pid, modelo=_modelo_indice(pid)))
+    presupuesto = float(cfg.get('embedTimeoutMs') or 0) / 1000
+    try:
+        emb = fut.result(timeout=presupuesto or None)
+    except FuturesTimeout:
+        print(f"⏱️ Embedding de la query tardó más de {presupuesto * 1000:.0f} ms: búsqueda solo léxica")
+        return None
+    except Exception as e:
+        print(f"⚠️ Embedding de la query falló ({e}): búsqueda solo léxica")
+        return None
+    if emb is None or len(emb) == 0:
         return None
-    with _faiss_lock:
-        faiss_index.add(np.array([emb]))
-        embeddings_metadata.append({
-            'tipo': tipo, 'texto': texto,
-            'metadata': metadata_extra, 'timestamp': now_argentina().isoformat()
+    return _normalizar(emb)
+
+
+def _episodios_recientes(pid, snap):
+    """Ancla temporal: los (hasta) 3 episodios más nuevos del índice."""
+    recientes = []
+    with _get_conn(paths(pid)['db']) as conn:
+        ultimos = conn.execute('SELECT id, tipo, texto FROM vectores WHERE id < ? '
+                               'ORDER BY id DESC LIMIT 6', (snap.prox_id,)).fetchall()
+    for i, tipo, texto in ultimos:
+        if tipo == 'episodio':
+            recientes.append({
+                'texto': texto,
+                'tipo': 'episodio_reciente',
+                'distancia': 0.0,
+                '_idx': i
+            })
+            if len(recientes) >= 3:
+                break
+    return recientes
+
+
+def _buscar_semanticos(pid, snap, emb, k, nprobe, ef_search, indices_recientes, cfg):
+    """Los k+5 mejores resultados vectoriales bajo el umbral de distancia, en orden."""
+    index = snap.index
+    total = snap.vivos
+    # Buscar un poco más para poder filtrar (y saltear lápidas de HNSW)
+    # Con almacenamiento cuantizado y faiss.rerank se piden más candidatos
+    # y se re-puntúan con el vector completo
+    repuntuar = bool(cfg.get('rerank')) and _almacenamiento_indice(index) != 'float'
+    pedidos = (k + 5) * (max(1, int(cfg.get('rerankFactor', 4))) if repuntuar else 1)
+    k_buscar = min(pedidos + _ntotal(snap) - total, _ntotal(snap))
+    sims, idxs = _buscar(snap, emb, k_buscar,
+                         params=_parametros_busqueda(index, nprobe, ef_search))
+    candidatos = [i for i in idxs[0].tolist() if i >= 0]
+    # Solo se leen de SQLite las filas de los resultados
+    filas = _meta_filas(pid, candidatos, con_vector=repuntuar)
+    ids_orden, sims_orden = idxs[0].tolist(), sims[0]
+    if repuntuar:
+        ids_orden, sims_orden = _repuntuar(emb, candidatos, sims[0][idxs[0] >= 0], filas)
+    dists = 1.0 - np.asarray(sims_orden)
+
+    # Umbral dinámico (distancia coseno): si hay poco contenido, sé más
+    # permisivo. Equivalen a los viejos 2.5 / 4.0 de L2² sobre vectores unitarios.
+    umbral = 1.25 if total > 50 else 2.0
+
+    semanticos = []
+    for i, d in zip(ids_orden, dists):
+        meta = filas.get(i)
+        if meta is None:
+            continue   # -1 o lápida
+        if i in indices_recientes:
+            continue   # ya está en recientes, no duplicar
+        if float(d) > umbral:
+            continue   # demasiado distante = ruido
+        semanticos.append({
+            'texto': _extraer_texto_meta(meta),
+            'tipo': meta.get('tipo', 'episodio'),
+            'distancia': float(d),
+            '_idx': i
         })
-        idx = faiss_index.ntotal - 1
-    guardar_faiss(pid_actual)
-    return idx
+    return semanticos
 
 
-def buscar_contexto_relevante(query, k=8):
+def buscar_contexto_relevante(query, k=8, nprobe=None, ef_search=None, pid=None, solo_lexico=False):
     """
-    Búsqueda semántica mejorada. Devuelve hasta k fragmentos combinando dos estrategias:
+    Búsqueda híbrida (léxica + semántica). Devuelve hasta k fragmentos combinando:
       A) Los 3 episodios más recientes (ancla temporal — lo que pasó justo antes)
-      B) Los k mejores resultados semánticos filtrados por distancia < umbral
+      B) Los mejores resultados semánticos filtrados por distancia < umbral,
+         fusionados por reciprocal-rank fusion con los de la búsqueda léxica
+         local (FTS5/BM25, busqueda_lexica.py) si faiss.hybrid está activo
     Los duplicados entre A y B se eliminan. El resultado está ordenado por relevancia.
+
+    Sin vectores, con solo_lexico, si el embedding falla o si tarda más que
+    faiss.embedTimeoutMs, B sale solo de la búsqueda léxica (cero red) en
+    lugar de quedar vacío. Esos resultados llevan 'distancia' None.
+
+    No toma ningún lock: el embedding de la query (llamada de red) se calcula
+    sin bloquear a nadie, mientras tanto corre la búsqueda léxica, y la
+    vectorial corre sobre el snapshot publicado.
+    nprobe / ef_search: precisión vs velocidad para índices IVF / HNSW
+    (None = lo de api_config.json → faiss).
+
+    La query se embebe con el modelo de la cabecera del índice y se compara
+    por coseno: 'distancia' es 1 - similitud (0 = idéntico, 2 = opuesto).
+    pid: personaje cuyo índice se consulta (None = activo).
     """
-    with _faiss_lock:
-        if faiss_index.ntotal == 0:
-            return []
-        emb = obtener_embedding(query)
-        if emb is None:
-            return []
-        try:
-            # ── A) Episodios recientes (ancla temporal) ───────────────────────
-            recientes = []
-            total = faiss_index.ntotal
-            indices_recientes = set()
-            for i in range(total - 1, max(total - 6, -1), -1):
-                if i < len(embeddings_metadata):
-                    meta = embeddings_metadata[i]
-                    if meta.get('tipo') == 'episodio':
-                        texto = _extraer_texto_meta(meta)
-                        recientes.append({
-                            'texto': texto,
-                            'tipo': 'episodio_reciente',
-                            'distancia': 0.0,
-                            '_idx': i
-                        })
-                        indices_recientes.add(i)
-                        if len(recientes) >= 3:
-                            break
-
-            # ── B) Búsqueda semántica con umbral de distancia ─────────────────
-            k_buscar = min(k + 5, total)   # buscar un poco más para poder filtrar
-            dists, idxs = faiss_index.search(np.array([emb]), k_buscar)
-
-            # Umbral dinámico: si hay poco contenido, sé más permisivo
-            umbral = 2.5 if total > 50 else 4.0
-
-            semanticos = []
-            for i, d in zip(idxs[0], dists[0]):
-                if i < 0 or i >= len(embeddings_metadata):
-                    continue
-                if i in indices_recientes:
-                    continue   # ya está en recientes, no duplicar
-                if float(d) > umbral:
-                    continue   # demasiado distante = ruido
-                meta = embeddings_metadata[i]
-                texto = _extraer_texto_meta(meta)
-                semanticos.append({
-                    'texto': texto,
-                    'tipo': meta.get('tipo', 'episodio'),
-                    'distancia': float(d),
-                    '_idx': i
-                })
-
-            # ── Combinar: recientes primero, luego semánticos ─────────────────
-            combinados = recientes + semanticos
-            # Quitar campo interno _idx antes de retornar
-            for r in combinados:
-                r.pop('_idx', None)
-
-            return combinados[:k]
-
-        except Exception as e:
-            print(f"❌ Error FAISS search: {e}")
+    pid    = pid or get_personaje_activo_id()
+    alm    = _almacen(pid)
+    previo = alm.snapshot
+    cfg    = _get_config_faiss()
+    hibrida = bool(cfg.get('hybrid', True))
+    if not hibrida and (solo_lexico or not previo.vivos):
+        return []
+    try:
+        emb = None
+        if previo.vivos and not solo_lexico:
+            emb = _embeber_consulta(query, pid, cfg)
+        lex_episodios, lex_hechos = buscar_lexico(query, k=k + 5, pid=pid) if hibrida else ([], [])
+        if emb is None and not hibrida:
             return []
 
+        # Si entró un alta mientras se embebía la query, buscar sobre lo más nuevo
+        # (salvo que un reindexado haya cambiado el modelo: ahí sirve el previo)
+        snap = alm.snapshot
+        if snap.cabecera.get('modelo') != previo.cabecera.get('modelo'):
+            snap = previo
+
+        # ── A) Episodios recientes (ancla temporal) ───────────────────────
+        recientes = _episodios_recientes(pid, snap) if snap.vivos else []
+        indices_recientes = {r['_idx'] for r in recientes}
+
+        # ── B) Búsqueda semántica con umbral de distancia ─────────────────
+        semanticos = []
+        if emb is not None:
+            if emb.shape[1] != snap.index.d:
+                print(f"❌ FAISS: query de {emb.shape[1]} dims contra índice de {snap.index.d}")
+            else:
+                try:
+                    semanticos = _buscar_semanticos(pid, snap, emb, k, nprobe, ef_search,
+                                                    indices_recientes, cfg)
+                except Exception as e:
+                    print(f"❌ Error FAISS search: {e}")
+
+        # ── Fusión con la búsqueda léxica (RRF) ──────────────────────────
+        # Un mismo registro se reconoce por su embedding_id; los que no
+        # tienen vector se identifican por su texto.
+        if lex_episodios or lex_hechos:
+            listas = [[(s['_idx'], s) for s in semanticos]]
+            for lista in (lex_episodios, lex_hechos):
+                listas.append([
+                    (r['embedding_id'] if r['embedding_id'] is not None else (r['tipo'], r['texto']),
+                     {'texto': r['texto'], 'tipo': r['tipo'], 'distancia': None})
+                    for r in lista if r['embedding_id'] not in indices_recientes
+                ])
+            semanticos = fusionar_rrf(listas)
+
+        # ── Combinar: recientes primero, luego semánticos ─────────────────
+        combinados = recientes + semanticos
+        # Quitar campo interno _idx antes de retornar
+        for r in combinados:
+            r.pop('_idx', None)
+
+        return combinados[:k]
+
+    except Exception as e:
+        print(f"❌ Error búsqueda de contexto: {e}")
+        return []
+
 
 def _extraer_texto_meta(meta):
     """Extrae el texto legible de un dict de metadata FAISS."""
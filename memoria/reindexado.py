@@ -0,0 +1,310 @@
+# ═══════════════════════════════════════════════════════════════════════════
+# MEMORIA/REINDEXADO.PY — Re-embebido en segundo plano al cambiar de modelo
+# Cuando models.embeddings / embedding_provider cambian, el índice sigue con
+# el modelo de su cabecera (ver faiss_store). Este trabajo arma un índice
+# "sombra" con el modelo nuevo a partir de los mismos textos, en lotes, y lo
+# publica de una sola vez al terminar. El chat sigue usando el índice viejo
+# todo el tiempo.
+#
+# Progreso en data/personajes/<pid>/reindex/:
+#   estado.json  → modelo destino, cuántos ítems van, último id procesado
+#   sombra.f32   → vectores ya calculados (append + fsync por lote)
+#   sombra.ids   → el id estable de cada vector de sombra.f32
+# Se avanza por id (los ids no cambian ni se reutilizan): las bajas que entran
+# mientras tanto se descartan al armar el índice, las altas se procesan al final.
+# Si el proceso se reinicia, el trabajo retoma desde el último lote guardado.
+#
+# Modificar acá si querés:
+#   - Cambiar la pausa entre lotes (faiss.reindexPauseMs)
+#   - Cambiar de dónde salen los textos (_textos_fuente)
+# ═══════════════════════════════════════════════════════════════════════════
+
+import os
+import json
+import time
+import shutil
+import threading
+import numpy as np
+
+from utils import paths, get_personaje_activo_id, _get_conn
+from limitador import en_segundo_plano
+from . import faiss_store as fs
+from .cache_embeddings import cache_descartar_modelo
+
+
+_MAX_REINTENTOS = 5
+
+_en_curso  = set()                # pids con un trabajo corriendo en este proceso
+_estados   = {}                   # pid → último estado conocido (para la API)
+
+
+def _get_config_reindex():
+    """Lee faiss.reindexAuto / reindexPauseMs desde api_config.json."""
+    cfg = fs._get_config_faiss()
+    return bool(cfg.get('reindexAuto', True)), max(0, int(cfg.get('reindexPauseMs', 500))) / 1000
+
+
+def _ruta(pid, archivo=''):
+    return os.path.join(paths(pid)['emb_reindex'], archivo)
+
+
+def _leer_estado(pid):
+    try:
+        with open(_ruta(pid, 'estado.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _guardar_estado(pid, estado):
+    ruta = _ruta(pid, 'estado.json')
+    with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(estado, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(ruta + '.tmp', ruta)
+    _estados[pid] = dict(estado)
+
+
+def _borrar_trabajo(pid):
+    shutil.rmtree(paths(pid)['emb_reindex'], ignore_errors=True)
+
+
+def _textos_fuente(pid, ids):
+    """
+    (ids, textos) a re-embeber, en el mismo orden. Los ids que se borraron
+    mientras tanto no vuelven. Sale de la tabla vectores; si un episodio
+    viejo no guardó el texto se reconstruye desde memoria_episodica
+    (por embedding_id).
+    """
+    filas = fs._meta_filas(pid, ids)
+    ids   = [i for i in ids if i in filas]
+    textos, faltan = [], {}
+    for i in ids:
+        texto = filas[i]['texto']
+        if not texto:
+            faltan[i] = len(textos)
+        textos.append(texto)
+    if faltan:
+        try:
+            ph = ','.join('?' * len(faltan))
+            with _get_conn(paths(pid)['db']) as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    f'SELECT embedding_id, contenido_usuario, contenido_hiro FROM memoria_episodica '
+                    f'WHERE embedding_id IN ({ph})', list(faltan))
+                for emb_id, usuario, hiro in cursor.fetchall():
+                    textos[faltan[emb_id]] = f"Usuario: {usuario}\nPersonaje: {hiro or ''}"
+        except Exception as e:
+            print(f"⚠️ Reindexado: no se pudieron leer episodios de la DB: {e}")
+    return ids, textos
+
+
+def _leer_sombra(pid, dim, cantidad):
+    """(ids, vectores) ya calculados (descarta una cola a medio escribir)."""
+    ruta_v, ruta_i = _ruta(pid, 'sombra.f32'), _ruta(pid, 'sombra.ids')
+    if not os.path.exists(ruta_v) or not os.path.exists(ruta_i) or not dim:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, dim or 1), dtype=np.float32)
+    vecs = np.fromfile(ruta_v, dtype=np.float32)
+    ids  = np.fromfile(ruta_i, dtype=np.int64)
+    n = min(len(vecs) // dim, len(ids), cantidad)
+    return ids[:n], vecs[:n * dim].reshape(n, dim)
+
+
+def _agregar_sombra(pid, vecs, ids, cantidad_previa, dim):
+    """Append + fsync del lote. Antes trunca lo que haya quedado después del último checkpoint."""
+    for archivo, datos, tam in (('sombra.f32', np.ascontiguousarray(vecs, dtype=np.float32), dim * 4),
+                                ('sombra.ids', np.asarray(ids, dtype=np.int64), 8)):
+        with open(_ruta(pid, archivo), 'ab') as f:
+            f.truncate(cantidad_previa * tam)
+            f.seek(0, os.SEEK_END)
+            f.write(datos.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _actualizar_vectores_completos(pid, estado, almacenamiento):
+    """
+    Los vectores completos guardados para re-puntuar (faiss.rerank) son del
+    modelo viejo: se reemplazan por los de la sombra o, si el índice nuevo
+    (con ese almacenamiento) no los usa, se borran.
+    """
+    if fs._guarda_completos(almacenamiento):
+        ids, vecs = _leer_sombra(pid, estado['dim'], estado['hecho'])
+        fs._guardar_vectores_completos(pid, ids, vecs)
+    else:
+        with _get_conn(paths(pid)['db']) as conn:
+            conn.execute('UPDATE vectores SET vector = NULL WHERE vector IS NOT NULL')
+
+
+def _embeber(pid, destino, textos, pausa):
+    """Un lote con reintentos y espera creciente (límites de tasa del proveedor)."""
+    for intento in range(_MAX_REINTENTOS):
+        try:
+            vecs = fs.obtener_embeddings_batch(textos, pid=pid, modelo=destino)
+            return fs._normalizar(vecs)
+        except Exception as e:
+            espera = max(pausa, 1) * (2 ** intento)
+            print(f"⚠️ Reindexado: lote falló ({e}), reintento en {espera:.0f}s")
+            time.sleep(espera)
+    raise RuntimeError(f"el proveedor falló {_MAX_REINTENTOS} veces seguidas")
+
+
+def _nuevo_estado(origen, destino):
+    return {'origen': list(origen), 'destino': list(destino), 'hecho': 0,
+            'ultimo_id': -1, 'dim': None, 'estado': 'corriendo', 'error': None}
+
+
+def _trabajo(pid, destino):
+    """
+    Hilo del re-embebido. Avanza por lotes de ids sobre la tabla vectores,
+    guardando checkpoint tras cada uno. Al alcanzar el final arma el índice
+    nuevo, aplica las altas y bajas que hayan entrado mientras tanto y lo
+    publica con el lock del almacén tomado (reemplazo atómico).
+    """
+    try:
+        _, pausa = _get_config_reindex()
+        os.makedirs(paths(pid)['emb_reindex'], exist_ok=True)
+        origen = fs._modelo_indice(pid)
+        estado = _leer_estado(pid)
+        # Sin 'ultimo_id': trabajo de antes de los ids estables, se empieza de cero
+        if not estado or estado.get('destino') != list(destino) or 'ultimo_id' not in estado:
+            _borrar_trabajo(pid)
+            os.makedirs(paths(pid)['emb_reindex'], exist_ok=True)
+            estado = _nuevo_estado(origen, destino)
+        estado.update(estado='corriendo', error=None)
+        _guardar_estado(pid, estado)
+        tam_lote = fs._LOTE_MAXIMO.get(destino[0], 32)
+        nuevo, en_nuevo = None, set()
+
+        alm = fs._residente(pid)
+        while True:
+            if alm is None or not alm.vigente:
+                estado['estado'] = 'pausado'
+                _guardar_estado(pid, estado)
+                print(f"⏸️ Reindexado de {pid} pausado (índice fuera de memoria)")
+                return
+            snap = alm.snapshot
+
+            pendientes = fs._ids_vigentes(pid, desde=estado['ultimo_id'] + 1, limite=tam_lote).tolist()
+            if pendientes:
+                lote, textos = _textos_fuente(pid, pendientes)
+                dim = estado['dim']
+                if lote:
+                    vecs = _embeber(pid, destino, textos, pausa)
+                    dim  = dim or int(vecs.shape[1])
+                    if vecs.shape[1] != dim:
+                        raise RuntimeError(f"el modelo devolvió {vecs.shape[1]} dims (esperaba {dim})")
+                    _agregar_sombra(pid, vecs, lote, estado['hecho'], dim)
+                    if nuevo is not None:
+                        nuevo.add_with_ids(vecs, np.asarray(lote, dtype=np.int64))
+                        en_nuevo.update(lote)
+                estado.update(hecho=estado['hecho'] + len(lote), ultimo_id=pendientes[-1], dim=dim)
+                _guardar_estado(pid, estado)
+                restan = max(snap.vivos - estado['hecho'], 0)
+                if estado['hecho'] % (tam_lote * 20) < tam_lote or not restan:
+                    print(f"🔁 Reindexado {pid}: {estado['hecho']} hechos, faltan {restan}")
+                if pausa:
+                    time.sleep(pausa)
+                continue
+
+            # ── Al día: armar el índice nuevo (fuera del lock) y publicarlo ──
+            if nuevo is None:
+                ids, vecs = _leer_sombra(pid, estado['dim'], estado['hecho'])
+                if len(ids) != estado['hecho']:
+                    raise RuntimeError("sombra.f32 / sombra.ids incompletos")
+                # Lo que se borró mientras tanto no entra al índice nuevo
+                vivos = np.isin(ids, fs._ids_vigentes(pid))
+                ids, vecs = ids[vivos], vecs[vivos]
+                tipo = fs._tipo_indice(snap.index)
+                if not len(ids) or len(ids) < fs._minimo_para_entrenar(tipo, len(ids)):
+                    nuevo = fs._indice_vacio(estado['dim'] or fs._dim_modelo(destino[1]) or snap.index.d)
+                    if len(ids):
+                        nuevo.add_with_ids(vecs, ids)
+                else:
+                    nuevo = fs._construir_indice(tipo, vecs, ids, fs._get_config_faiss())
+                en_nuevo = set(ids.tolist())
+                continue   # pudo entrar algo mientras se entrenaba
+
+            with alm.lock:
+                actual = alm.snapshot
+                if not alm.vigente or len(fs._ids_vigentes(pid, desde=estado['ultimo_id'] + 1, limite=1)):
+                    continue   # entraron altas o el almacén se recargó: otra vuelta
+                if len(en_nuevo) != actual.vivos:
+                    bajas = list(en_nuevo.difference(fs._ids_vigentes(pid).tolist()))
+                    nuevo = fs._quitar_ids(nuevo, bajas)
+                    en_nuevo.difference_update(bajas)
+                _actualizar_vectores_completos(pid, estado, fs._almacenamiento_indice(nuevo))
+                cabecera = fs._nueva_cabecera(destino[0], destino[1], nuevo.d)
+                fs._preparar_indice(nuevo)
+                fs._publicar(alm, nuevo, actual.seq, nueva_generacion=True, cabecera=cabecera)
+                alm.desalineado = None
+                publicado = alm.snapshot
+            fs._escribir_snapshot(pid, publicado)
+            with alm.lock:
+                fs._wal_recortar(pid, publicado.seq)
+                fs._remapear(alm, publicado)
+            cache_descartar_modelo(pid, f"{origen[0]}:{origen[1]}")
+            _borrar_trabajo(pid)
+            _estados[pid] = dict(estado, estado='terminado')
+            print(f"✅ Reindexado {pid} terminado: {publicado.vivos} vectores con "
+                  f"{destino[0]}:{destino[1]} ({nuevo.d} dims)")
+            return
+
+    except Exception as e:
+        print(f"❌ Reindexado {pid} detenido: {e}")
+        try:
+            estado = _leer_estado(pid) or {}
+            estado.update(estado='error', error=str(e))
+            _guardar_estado(pid, estado)
+        except Exception:
+            pass
+    finally:
+        _en_curso.discard(pid)
+
+
+def iniciar_reindexado(pid=None, forzar=False):
+    """
+    Lanza el re-embebido si el modelo configurado no es el del índice cargado
+    (o siempre, con forzar=True). Si había un trabajo a medias lo retoma.
+    Devuelve el estado actual.
+    """
+    pid = pid or get_personaje_activo_id()
+    if fs._residente(pid) is None:
+        return estado_reindexado(pid)   # se retoma cuando se cargue su índice
+    destino = fs._modelo_configurado()
+    if destino == fs._modelo_indice(pid) and not forzar:
+        if _leer_estado(pid):
+            _borrar_trabajo(pid)   # volvieron al modelo del índice: trabajo obsoleto
+        return estado_reindexado(pid)
+    if pid in _en_curso:
+        return estado_reindexado(pid)
+    _en_curso.add(pid)
+    print(f"🔁 Reindexado {pid}: {'%s:%s' % fs._modelo_indice(pid)} → {destino[0]}:{destino[1]}")
+    threading.Thread(target=en_segundo_plano, args=(_trabajo, pid, destino), daemon=True).start()
+    return estado_reindexado(pid)
+
+
+def reanudar_reindexado(pid):
+    """Al cargar un personaje: retoma o arranca el trabajo si corresponde (faiss.reindexAuto)."""
+    auto, _ = _get_config_reindex()
+    if auto or _leer_estado(pid):
+        iniciar_reindexado(pid)
+
+
+def estado_reindexado(pid=None):
+    """Progreso del re-embebido del personaje (para la API)."""
+    pid    = pid or get_personaje_activo_id()
+    estado = _leer_estado(pid) or _estados.get(pid) or {}
+    alm    = fs._residente(pid)
+    total  = alm.snapshot.vivos if alm else None
+    return {
+        'activo':      pid in _en_curso,
+        'estado':      estado.get('estado', 'inactivo'),
+        'hecho':       estado.get('hecho', 0),
+        'total':       total,
+        'origen':      ':'.join(estado.get('origen') or fs._modelo_indice(pid)),
+        'destino':     ':'.join(estado['destino']) if estado.get('destino') else None,
+        'error':       estado.get('error'),
+        'desalineado': alm.desalineado if alm else None,
+    }
@@ -19,6 +19,7 @@ from utils import (
     _get_conn,
     reparar_valor_db,
 )
+from limitador import ANALISIS
 
 
 
@@ -141,7 +142,8 @@ IMPORTANTE: No inventes sentimientos de "siempre" o "eterno" si la relación es
         resp = llamada_mistral_segura(
             model=_get_modelo("synthesis"),
             messages=[{'role': 'user', 'content': prompt}],
-            max_tokens=250
+            max_tokens=250,
+            prioridad=ANALISIS
         )
         resumen = resp.choices[0].message.content.strip()
         with _get_conn(paths()['db']) as conn:
@@ -206,7 +208,8 @@ Objetivo: Un resumen útil y seco, no una novela."""
         resp = llamada_mistral_segura(
             model=_get_modelo("synthesis"),
             messages=[{'role': 'user', 'content': prompt}],
-            max_tokens=300
+            max_tokens=300,
+            prioridad=ANALISIS
         )
         perfil = resp.choices[0].message.content.strip()
         with _get_conn(paths()['db']) as conn:
@@ -260,7 +263,8 @@ REGLAS:
             resp = llamada_mistral_segura(
                 model=_get_modelo("synthesis"),
                 messages=[{'role':'user','content':prompt}],
-                max_tokens=150
+                max_tokens=150,
+                prioridad=ANALISIS
             )
             if not resp or not resp.choices:
                 errores.append(f"{cat}: respuesta vacía del modelo")
@@ -5,10 +5,9 @@
 
 import os
 import json
-import requests
 from dotenv import load_dotenv
 from datetime import datetime
-from utils import llamada_mistral_segura
+from utils import llamada_mistral_segura, http_cliente
 
 load_dotenv()
 
@@ -135,8 +134,8 @@ def listar_modelos_mistral():
         if not api_key:
             api_key = os.getenv('MISTRAL_API_KEY', '').strip()
         if api_key:
-            from mistralai import Mistral
-            Mistral(api_key=api_key)
+            from utils import _cliente_mistral
+            _cliente_mistral(api_key)
             print("✅ Conexión a Mistral verificada")
     except Exception as e:
         print(f"⚠️ Mistral: {e}")
@@ -166,7 +165,7 @@ def listar_modelos_openrouter(sin_censura_solo=True):
 
         if api_key:
             headers = {'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'}
-            resp = requests.get('https://openrouter.ai/api/v1/models', headers=headers, timeout=10)
+            resp = http_cliente().get('https://openrouter.ai/api/v1/models', headers=headers, timeout=10)
             if resp.status_code == 200:
                 raw = resp.json().get('data', [])
                 modelos = []
@@ -343,12 +342,11 @@ def probar_modelo(modelo_id, proveedor='openrouter'):
         cfg = cargar_config_apis()
 
         if proveedor == 'openrouter':
-            import requests
             api_key = (cfg.get('openrouter', {}).get('apiKey') or '').strip()
             if not api_key:
                 return {'ok': False, 'error': 'No hay API key de OpenRouter configurada'}
 
-            resp = requests.post(
+            resp = http_cliente().post(
                 'https://openrouter.ai/api/v1/chat/completions',
                 headers={
                     'Authorization': f'Bearer {api_key}',
@@ -0,0 +1,273 @@
+# ═══════════════════════════════════════════════════════════════════════════
+# RESILIENCIA.PY — Errores clasificados, backoff y circuit breaker por proveedor
+# Lo usa llamada_mistral_segura() (utils.py) para decidir, ante cada error,
+# si vale la pena reintentar, cuánto esperar y si conviene ir directo al
+# proveedor secundario.
+#
+#   - es_reintentable(): 429, 5xx, timeouts y cortes de red sí; 4xx de
+#     auth / request mal armado / modelo inexistente no (reintentar no cambia nada).
+#   - espera_reintento(): backoff exponencial con jitter completo, o lo que
+#     pida el header Retry-After del proveedor.
+#   - Circuit breaker: tras N fallos reintentables seguidos el proveedor queda
+#     ABIERTO y las llamadas van directo al secundario; pasado el tiempo de
+#     apertura se deja pasar UNA llamada de prueba (semiabierto): si sale bien
+#     se cierra, si falla vuelve a abrirse.
+#   - Hedging: latencias recientes por proveedor para saber cuándo una llamada
+#     de chat "tarda demasiado" y vale la pena lanzar la misma al secundario,
+#     y la cancelación cooperativa de la que pierde la carrera.
+#
+# Independiente: solo stdlib (los errores se leen por duck typing: status_code,
+# headers, response). La config la pasa utils.py.
+# ═══════════════════════════════════════════════════════════════════════════
+
+import time
+import random
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+
+class LlamadaCancelada(Exception):
+    """La llamada perdió una carrera de hedging antes de enviarse: no cuenta como fallo."""
+
+
+class ErrorProveedor(Exception):
+    """Respuesta HTTP de error de un proveedor, con lo necesario para clasificarla."""
+
+    def __init__(self, mensaje, status_code=None, headers=None):
+        super().__init__(mensaje)
+        self.status_code = status_code
+        self.headers     = headers or {}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# CLASIFICACIÓN Y BACKOFF
+# ─────────────────────────────────────────────────────────────────────────────
+
+_STATUS_REINTENTABLES = {408, 409, 425, 429}   # + todos los 5xx
+
+
+def _status(e):
+    """Código HTTP del error (SDK de Mistral, httpx, ErrorProveedor) o None."""
+    status = getattr(e, 'status_code', None)
+    if status is None and getattr(e, 'response', None) is not None:
+        status = getattr(e.response, 'status_code', None)
+    return status
+
+
+def _headers(e):
+    headers = getattr(e, 'headers', None)
+    if headers is None and getattr(e, 'response', None) is not None:
+        headers = getattr(e.response, 'headers', None)
+    return headers or {}
+
+
+def es_reintentable(e):
+    """
+    True si otro intento puede salir distinto: límite de tasa, error del
+    servidor, timeout o falla de red. Un error de configuración (ValueError:
+    falta la key) o un 4xx como 400/401/403/404/422 no se reintenta.
+    """
+    if isinstance(e, (ValueError, LlamadaCancelada)):
+        return False
+    status = _status(e)
+    if status is None:
+        return True   # timeout, conexión caída, respuesta ilegible
+    return status in _STATUS_REINTENTABLES or status >= 500
+
+
+def retry_after(e):
+    """Segundos pedidos por el header Retry-After del error (número o fecha HTTP), o None."""
+    valor = _headers(e).get('retry-after') or _headers(e).get('Retry-After')
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(valor).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def espera_reintento(intento, e=None, base=0.5, tope=8.0):
+    """
+    Segundos a esperar antes del intento `intento + 1`: Retry-After si el
+    proveedor lo mandó, si no backoff exponencial con jitter completo
+    (uniforme entre 0 y min(tope, base·2^intento)).
+    """
+    pedido = retry_after(e) if e is not None else None
+    if pedido is not None:
+        return pedido
+    return random.uniform(0, min(tope, base * (2 ** intento)))
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# CIRCUIT BREAKER POR PROVEEDOR
+# ─────────────────────────────────────────────────────────────────────────────
+
+CERRADO, ABIERTO, SEMIABIERTO = 'cerrado', 'abierto', 'semiabierto'
+
+_circuitos = {}     # proveedor → dict de estado
+_circ_lock = threading.Lock()
+
+
+def _circuito(proveedor):
+    return _circuitos.setdefault(proveedor, {
+        'estado': CERRADO, 'fallos': 0, 'abierto_desde': 0.0, 'prueba_en_curso': False,
+        'aperturas': 0, 'rechazadas': 0, 'ultimo_error': None,
+    })
+
+
+def permitir(proveedor, segundos_abierto=30):
+    """
+    ¿Se puede llamar a este proveedor ahora? Cerrado: sí. Abierto: no, hasta
+    que pasen `segundos_abierto`; ahí pasa a semiabierto y deja pasar una
+    sola llamada de prueba (las demás siguen yendo al secundario).
+    """
+    with _circ_lock:
+        c = _circuito(proveedor)
+        if c['estado'] == CERRADO:
+            return True
+        if c['estado'] == ABIERTO and time.monotonic() - c['abierto_desde'] >= segundos_abierto:
+            c['estado'] = SEMIABIERTO
+            c['prueba_en_curso'] = False
+        if c['estado'] == SEMIABIERTO and not c['prueba_en_curso']:
+            c['prueba_en_curso'] = True
+            print(f"🔌 [{proveedor}] circuito semiabierto: llamada de prueba")
+            return True
+        c['rechazadas'] += 1
+        return False
+
+
+def registrar_exito(proveedor):
+    with _circ_lock:
+        c = _circuito(proveedor)
+        if c['estado'] != CERRADO:
+            print(f"✅ [{proveedor}] circuito cerrado: el proveedor respondió")
+        c.update(estado=CERRADO, fallos=0, prueba_en_curso=False)
+
+
+def registrar_fallo(proveedor, error, umbral=3):
+    """Cuenta un fallo reintentable; al llegar a `umbral` seguidos (o si falla la prueba) abre el circuito."""
+    with _circ_lock:
+        c = _circuito(proveedor)
+        c['fallos'] += 1
+        c['ultimo_error'] = str(error)[:200]
+        if c['estado'] == SEMIABIERTO or (c['estado'] == CERRADO and c['fallos'] >= umbral):
+            c.update(estado=ABIERTO, abierto_desde=time.monotonic(), prueba_en_curso=False)
+            c['aperturas'] += 1
+            print(f"⚡ [{proveedor}] circuito abierto tras {c['fallos']} fallo(s): {c['ultimo_error'][:80]}")
+
+
+def liberar_prueba(proveedor):
+    """La llamada de prueba terminó sin veredicto (error no reintentable, descartada): dejar pasar otra."""
+    with _circ_lock:
+        _circuito(proveedor)['prueba_en_curso'] = False
+
+
+def stats_circuitos():
+    """Estado de cada circuito: estado, fallos seguidos, aperturas, llamadas desviadas, último error."""
+    with _circ_lock:
+        ahora = time.monotonic()
+        return {
+            p: {
+                'estado': c['estado'],
+                'fallos_seguidos': c['fallos'],
+                'abierto_hace_s': round(ahora - c['abierto_desde'], 1) if c['estado'] != CERRADO else None,
+                'aperturas': c['aperturas'],
+                'rechazadas': c['rechazadas'],
+                'ultimo_error': c['ultimo_error'],
+            }
+            for p, c in sorted(_circuitos.items())
+        }
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# LATENCIA Y HEDGING
+# ─────────────────────────────────────────────────────────────────────────────
+
+_MUESTRAS = 100     # latencias recientes que se guardan por proveedor
+
+_latencias = {}     # proveedor → deque de segundos (solo llamadas de chat exitosas)
+_hedge = {'llamadas': 0, 'hedges': 0, 'gana_primario': 0, 'gana_secundario': 0,
+          'fallan_ambos': 0, 'ahorro_s': 0.0}
+_hedge_lock = threading.Lock()
+_local = threading.local()
+
+
+def registrar_latencia(proveedor, segundos):
+    with _hedge_lock:
+        _latencias.setdefault(proveedor, deque(maxlen=_MUESTRAS)).append(segundos)
+
+
+def percentil_latencia(proveedor, p=95, minimo=20):
+    """Percentil p de las latencias recientes del proveedor, o None si hay menos de `minimo` muestras."""
+    with _hedge_lock:
+        muestras = sorted(_latencias.get(proveedor, ()))
+    if len(muestras) < max(1, minimo):
+        return None
+    return muestras[min(len(muestras) - 1, int(len(muestras) * p / 100))]
+
+
+def registrar_hedge(disparado, gano_primario=None):
+    """
+    Cuenta una llamada con hedging habilitado. disparado: si se llegó a lanzar
+    la del secundario; gano_primario: True/False según quién respondió primero
+    (None si fallaron las dos).
+    """
+    with _hedge_lock:
+        _hedge['llamadas'] += 1
+        if not disparado:
+            return
+        _hedge['hedges'] += 1
+        if gano_primario is None:
+            _hedge['fallan_ambos'] += 1
+        elif gano_primario:
+            _hedge['gana_primario'] += 1
+        else:
+            _hedge['gana_secundario'] += 1
+
+
+def registrar_ahorro(segundos):
+    """El primario terminó bien `segundos` después de que ganara el secundario: eso se ahorró el usuario."""
+    with _hedge_lock:
+        _hedge['ahorro_s'] += segundos
+
+
+def stats_hedging():
+    """Tasa de hedging (el costo extra: llamadas duplicadas), quién gana y percentiles por proveedor."""
+    with _hedge_lock:
+        h = dict(_hedge)
+        latencias = {p: sorted(d) for p, d in _latencias.items()}
+    h['tasa_hedge'] = round(h['hedges'] / h['llamadas'], 3) if h['llamadas'] else 0.0
+    h['ahorro_s'] = round(h['ahorro_s'], 1)
+    h['latencias'] = {
+        p: {'muestras': len(m),
+            'p50_s': round(m[len(m) // 2], 2),
+            'p95_s': round(m[min(len(m) - 1, int(len(m) * 0.95))], 2)}
+        for p, m in sorted(latencias.items()) if m
+    }
+    return h
+
+
+def con_cancelacion(evento, fn, *args, **kwargs):
+    """Ejecuta fn en este hilo asociado a `evento` (ver verificar_cancelacion())."""
+    _local.cancelacion = evento
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.cancelacion = None
+
+
+def verificar_cancelacion():
+    """
+    Lanza LlamadaCancelada si la llamada de este hilo ya perdió la carrera.
+    Se consulta justo antes de enviar (al salir de la cola): una request ya
+    en vuelo no se puede abortar con el cliente sincrónico, pero la que
+    todavía esperaba cupo no llega a gastarse.
+    """
+    evento = getattr(_local, 'cancelacion', None)
+    if evento is not None and evento.is_set():
+        raise LlamadaCancelada("La otra llamada del hedge ya respondió")
@@ -15,9 +15,14 @@ from utils import (
     paths, get_personaje_activo_id,
     init_database_personaje,
     importar_personaje_desde_json, listar_personajes,
-    _get_conn,
+    _get_conn, http_cliente, stats_busqueda,
     llamada_mistral_segura,   # estaba siendo importada de memoria por accidente
 )
+from limitador import stats_limitador, stats_cola
+from resiliencia import stats_circuitos, stats_hedging
+from trabajos import stats_trabajos
+from clasificador_busqueda import stats_clasificador
+from turnos import TurnoDuplicado, estado_turnos
 from modelos_utils import (
     cargar_modelos_activos,
     cambiar_modelo,
@@ -39,9 +44,12 @@ from memoria import (
     cargar_personaje,
     _ejecutar_sintesis,
     generar_perfil_narrativo, generar_resumen_relacion, generar_sintesis,
-    limpiar_faiss_episodios,
+    limpiar_faiss_episodios, vaciar_faiss, eliminar_embeddings,
+    stats_cache_embeddings,
+    evaluar_recall_faiss, convertir_almacenamiento_faiss,
+    iniciar_reindexado, estado_reindexado,
 )
-from chat_engine import _procesar_mensaje, _procesar_continuar, verificar_eventos_automaticos
+from chat_engine import _procesar_mensaje, _procesar_mensaje_stream, _procesar_continuar, verificar_eventos_automaticos
 
 bp = Blueprint('main', __name__)
 
@@ -94,6 +102,14 @@ def save_api_config():
         guardar_modelos_activos(activos)
         print(f"✅ modelos_activos.json sincronizado — provider={provider}, chat={chat_model}, small={small_model}")
 
+        # Si cambió el modelo de embeddings, re-embeber el índice en segundo plano
+        try:
+            from memoria.faiss_store import _get_config_faiss
+            if _get_config_faiss().get('reindexAuto', True):
+                iniciar_reindexado()
+        except Exception as e:
+            print(f"⚠️ No se pudo iniciar el reindexado: {e}")
+
         return jsonify({"ok": True, "mensaje": "Configuración guardada"})
     except Exception as e:
         print(f"❌ Error guardando config: {e}")
@@ -124,12 +140,11 @@ def test_api_connections():
         # Test OpenRouter
         if config.get('openrouter', {}).get('enabled') and config.get('openrouter', {}).get('apiKey'):
             try:
-                import requests
                 headers = {
                     "Authorization": f"Bearer {config['openrouter']['apiKey']}",
                     "HTTP-Referer": "http://localhost"
                 }
-                response = requests.get('https://openrouter.ai/api/v1/models', headers=headers, timeout=5)
+                response = http_cliente().get('https://openrouter.ai/api/v1/models', headers=headers, timeout=5)
                 if response.status_code == 200:
                     results["openrouter"] = {"ok": True}
                 else:
@@ -707,7 +722,7 @@ def chat():
         if len(mensaje) > 2000:
             return jsonify({'error': 'Mensaje demasiado largo (máximo 2000 caracteres)'}), 400
 
-        respuesta = _procesar_mensaje(mensaje)
+        respuesta = _procesar_mensaje(mensaje, _clave_idempotencia(data))
 
         eventos_disparados = []
         try:
@@ -716,11 +731,76 @@ def chat():
             print(f"⚠️ Error verificando eventos: {e}")
 
         return jsonify({'response': respuesta, 'eventos_disparados': eventos_disparados})
+    except TurnoDuplicado as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         print(f"❌ Error en /api/chat: {e}")
         return jsonify({'error': f'Error interno: {str(e)}'}), 500
 
 
+def _clave_idempotencia(data):
+    """Clave del cliente para este envío (campo 'clave' o header Idempotency-Key), o None."""
+    clave = (data.get('clave') or request.headers.get('Idempotency-Key') or '').strip()
+    return clave[:100] or None
+
+
+def _sse(evento, datos):
+    """Un evento de Server-Sent Events con payload JSON."""
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+
+@bp.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Como /api/chat pero la respuesta llega en Server-Sent Events a medida que
+    el modelo escribe: 'cola' {posicion} cada segundo mientras espera su
+    turno (hay otro mensaje del mismo personaje en curso), 'delta' {texto}
+    por fragmento, y al final 'fin' {response, eventos_disparados} con el
+    texto definitivo (ya recortado y guardado) o 'error' {error}.
+    """
+    data    = request.json or {}
+    mensaje = data.get('message', '').strip()
+    if not mensaje:
+        return jsonify({'error': 'Mensaje vacío'}), 400
+    if len(mensaje) > 2000:
+        return jsonify({'error': 'Mensaje demasiado largo (máximo 2000 caracteres)'}), 400
+
+    clave = _clave_idempotencia(data)
+
+    def _eventos():
+        try:
+            respuesta = ''
+            for tipo, valor in _procesar_mensaje_stream(mensaje, clave):
+                if tipo == 'delta':
+                    yield _sse('delta', {'texto': valor})
+                elif tipo == 'cola':
+                    yield _sse('cola', {'posicion': valor})
+                else:
+                    respuesta = valor
+
+            eventos_disparados = []
+            try:
+                eventos_disparados = verificar_eventos_automaticos()
+            except Exception as e:
+                print(f"⚠️ Error verificando eventos: {e}")
+
+            yield _sse('fin', {'response': respuesta, 'eventos_disparados': eventos_disparados})
+        except TurnoDuplicado as e:
+            yield _sse('error', {'error': str(e)})
+        except Exception as e:
+            print(f"❌ Error en /api/chat/stream: {e}")
+            yield _sse('error', {'error': f'Error interno: {str(e)}'})
+
+    return Response(_eventos(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@bp.route('/api/chat/cola', methods=['GET'])
+def obtener_cola_chat():
+    """Turnos de chat por personaje: si hay uno en curso y cuántos esperan; duplicados unidos / rechazados."""
+    return jsonify(estado_turnos())
+
+
 @bp.route('/api/mensaje', methods=['POST'])
 def enviar_mensaje_legacy():
     """Endpoint legacy — reutiliza _procesar_mensaje."""
@@ -848,6 +928,108 @@ def obtener_estadisticas():
         'tiene_backstory'           : bool(bs_row and bs_row[0]),
     })
 
+@bp.route('/api/embeddings/cache', methods=['GET'])
+def obtener_stats_cache_embeddings():
+    """Hits/misses de la caché de embeddings del proceso + entradas del personaje activo."""
+    return jsonify(stats_cache_embeddings(get_personaje_activo_id()))
+
+
+@bp.route('/api/limites', methods=['GET'])
+def obtener_stats_limitador():
+    """Estado del limitador de rpm: por cubeta (proveedor o proveedor:modelo) fichas, cola y espera actual."""
+    return jsonify(stats_limitador())
+
+
+@bp.route('/api/cola', methods=['GET'])
+def obtener_stats_cola():
+    """Cola de llamadas LLM (queueEnabled): cupos por proveedor y, por clase, en cola / en curso / descartadas."""
+    return jsonify(stats_cola())
+
+
+@bp.route('/api/circuitos', methods=['GET'])
+def obtener_circuitos():
+    """Circuit breaker por proveedor: estado, fallos seguidos, aperturas y llamadas desviadas."""
+    return jsonify(stats_circuitos())
+
+
+@bp.route('/api/hedging', methods=['GET'])
+def obtener_stats_hedging():
+    """Hedging del chat: tasa de llamadas duplicadas (costo extra), quién gana, ahorro y latencias p50/p95."""
+    return jsonify(stats_hedging())
+
+
+@bp.route('/api/trabajos', methods=['GET'])
+def obtener_stats_trabajos():
+    """Cola de trabajos en segundo plano: pendientes / fallidos por personaje, demora de la cola y ritmo."""
+    return jsonify(stats_trabajos())
+
+
+@bp.route('/api/busqueda/cache', methods=['GET'])
+def obtener_stats_busqueda():
+    """Caché de búsquedas web: hits frescos y vencidos, misses, refrescos y qué proveedor gana la carrera."""
+    return jsonify(stats_busqueda())
+
+
+@bp.route('/api/busqueda/clasificador', methods=['GET'])
+def obtener_stats_clasificador():
+    """Clasificador local de búsqueda: mensajes resueltos sin LLM, precisión / recall auditados y calibración."""
+    return jsonify(stats_clasificador())
+
+
+@bp.route('/api/faiss/recall', methods=['GET'])
+def obtener_recall_faiss():
+    """
+    Recall@k del índice activo vs búsqueda exacta.
+    ?k=10&consultas=200&nprobe=4,8,16,32  (o &ef=32,64,128 para HNSW)
+    """
+    def _valores(nombre):
+        crudo = request.args.get(nombre, '')
+        vals = [int(v) for v in crudo.split(',') if v.strip().isdigit()]
+        return vals or None
+    try:
+        return jsonify(evaluar_recall_faiss(
+            k=request.args.get('k', 10, type=int),
+            n_consultas=request.args.get('consultas', 200, type=int),
+            nprobe=_valores('nprobe'),
+            ef_search=_valores('ef'),
+            pid=get_personaje_activo_id(),
+        ))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@bp.route('/api/faiss/convertir', methods=['POST'])
+def convertir_faiss():
+    """
+    Reescribe embeddings.index con otro almacenamiento (float | sq8 | pq).
+    {"almacenamiento": "sq8", "todos": true} — sin almacenamiento usa faiss.storage.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        return jsonify(convertir_almacenamiento_faiss(
+            almacenamiento=data.get('almacenamiento'),
+            pid=get_personaje_activo_id(),
+            todos=bool(data.get('todos')),
+        ))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@bp.route('/api/faiss/reindexar', methods=['GET'])
+def obtener_estado_reindexado():
+    """Progreso del re-embebido del índice del personaje activo."""
+    return jsonify(estado_reindexado(get_personaje_activo_id()))
+
+
+@bp.route('/api/faiss/reindexar', methods=['POST'])
+def lanzar_reindexado():
+    """Arranca (o retoma) el re-embebido con el modelo configurado. {"forzar": true} lo hace aunque coincida."""
+    data = request.get_json(silent=True) or {}
+    return jsonify(iniciar_reindexado(get_personaje_activo_id(), forzar=bool(data.get('forzar'))))
+
+
 @bp.route('/api/perfil', methods=['GET'])
 def obtener_perfil():
     with _get_conn(paths()['db']) as conn:
@@ -917,9 +1099,18 @@ def editar_mensaje(msg_id):
 
 @bp.route('/api/mensaje/<int:msg_id>', methods=['DELETE'])
 def eliminar_mensaje(msg_id):
-    with _get_conn(paths()['db']) as conn:
+    """Borra el mensaje; si su turno ya tenía episodio, se va también (fila y vector)."""
+    pid = get_personaje_activo_id()
+    with _get_conn(paths(pid)['db']) as conn:
         cursor = conn.cursor()
+        cursor.execute('SELECT embedding_id FROM mensajes WHERE id = ?', (msg_id,))
+        fila = cursor.fetchone()
+        emb_id = fila[0] if fila else None
         cursor.execute('DELETE FROM mensajes WHERE id = ?', (msg_id,))
+        if emb_id is not None:
+            cursor.execute('DELETE FROM memoria_episodica WHERE embedding_id = ?', (emb_id,))
+            cursor.execute('UPDATE mensajes SET embedding_id = NULL WHERE embedding_id = ?', (emb_id,))
+    eliminar_embeddings([emb_id], pid=pid)
     return jsonify({'success': True})
 
 
@@ -953,27 +1144,39 @@ def editar_hecho(hid):
 
 @bp.route('/api/memoria/hecho/<int:hid>', methods=['DELETE'])
 def eliminar_hecho(hid):
-    with _get_conn(paths()['db']) as conn:
+    pid = get_personaje_activo_id()
+    with _get_conn(paths(pid)['db']) as conn:
         cursor = conn.cursor()
+        cursor.execute('SELECT embedding_id FROM memoria_permanente WHERE id = ?', (hid,))
+        ids = [r[0] for r in cursor.fetchall()]
         cursor.execute('DELETE FROM memoria_permanente WHERE id = ?', (hid,))
+    eliminar_embeddings(ids, pid=pid)
     return jsonify({'success': True})
 
 
 @bp.route('/api/memoria/categoria/<cat>', methods=['DELETE'])
 def eliminar_categoria(cat):
-    with _get_conn(paths()['db']) as conn:
+    pid = get_personaje_activo_id()
+    with _get_conn(paths(pid)['db']) as conn:
         cursor = conn.cursor()
+        cursor.execute('SELECT embedding_id FROM memoria_permanente WHERE categoria = ?', (cat,))
+        ids = [r[0] for r in cursor.fetchall()]
         cursor.execute('DELETE FROM memoria_permanente WHERE categoria = ?', (cat,))
         n = cursor.rowcount
+    eliminar_embeddings(ids, pid=pid)
     return jsonify({'success': True, 'mensaje': f'{n} registros eliminados'})
 
 
 @bp.route('/api/memoria/limpiar-todo', methods=['DELETE'])
 def limpiar_memoria():
-    with _get_conn(paths()['db']) as conn:
+    pid = get_personaje_activo_id()
+    with _get_conn(paths(pid)['db']) as conn:
         cursor = conn.cursor()
+        cursor.execute('SELECT embedding_id FROM memoria_permanente')
+        ids = [r[0] for r in cursor.fetchall()]
         cursor.execute('DELETE FROM memoria_permanente')
         cursor.execute('DELETE FROM sintesis_conocimiento')
+    eliminar_embeddings(ids, pid=pid)
     return jsonify({'success': True, 'mensaje': 'Memoria eliminada'})
 
 
@@ -1058,9 +1261,9 @@ def reset_total():
                 except Exception:
                     pass
 
-        # ── Limpiar FAISS ─────────────────────────────────────────────────────
+        # ── Limpiar FAISS (episodios y hechos: no queda nada) ─────────────────
         try:
-            limpiar_faiss_episodios(get_personaje_activo_id())
+            vaciar_faiss(get_personaje_activo_id())
         except Exception as e:
             print(f"⚠️ Error limpiando FAISS en reset-total: {e}")
 
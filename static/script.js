@@ -1,6 +1,6 @@
 // ═══════════════════════════════════════════════════════════════════════════
 // HIRO CHAT — Frontend
-// Mejoras: /api/chat en lugar de /api/mensaje, avatar dinámico,
+// Mejoras: /api/chat/stream (respuesta en vivo) en lugar de /api/mensaje, avatar dinámico,
 // sin monkey-patch de fetch, sin funciones duplicadas, sin console.log
 // ═══════════════════════════════════════════════════════════════════════════
 
@@ -348,10 +348,10 @@ function scrollToBottom() {
 // ─────────────────────────────────────────────────────────────────────────────
 
 /**
- * Crea un mensaje del asistente vacío en el chat y escribe el texto
- * palabra por palabra. Devuelve una Promise que resuelve cuando termina.
+ * Crea un mensaje del asistente vacío en el chat.
+ * Devuelve { wrapper, bubble } para ir llenando la burbuja.
  */
-function renderMessageTypewriter(contenido, messageId = null) {
+function _crearMensajeHiroVacio(messageId = null) {
     const msgId = messageId || ++messageIdCounter;
 
     const wrapper = document.createElement('div');
@@ -387,6 +387,15 @@ function renderMessageTypewriter(contenido, messageId = null) {
 
     chatContainer.appendChild(wrapper);
     scrollToBottom();
+    return { wrapper, bubble };
+}
+
+/**
+ * Crea un mensaje del asistente vacío en el chat y escribe el texto
+ * palabra por palabra. Devuelve una Promise que resuelve cuando termina.
+ */
+function renderMessageTypewriter(contenido, messageId = null) {
+    const { wrapper, bubble } = _crearMensajeHiroVacio(messageId);
 
     // Efecto typewriter palabra por palabra
     return new Promise(resolve => {
@@ -634,14 +643,110 @@ async function continuarRespuesta() {
 // ENVÍO DE MENSAJES
 // ─────────────────────────────────────────────────────────────────────────────
 
-async function _callChatAPI(mensaje) {
-    const resp = await fetch('/api/chat', {
+async function _ocultarTyping() {
+    if (typingIndicator.style.display === 'none') return;
+    typingIndicator.style.opacity = '0';
+    await new Promise(r => setTimeout(r, 200));
+    typingIndicator.style.display = 'none';
+    typingIndicator.style.opacity = '1';
+}
+
+/**
+ * Clave de idempotencia de un envío: se crea una vez por mensaje (en
+ * sendMessage / sendExistingMessage) y la reusan sus reenvíos, así si el
+ * mismo envío llega dos veces el servidor lo procesa una sola.
+ */
+function _nuevaClaveEnvio() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+
+/** "En cola" junto a los puntitos mientras otro mensaje del mismo personaje se está procesando. */
+function _mostrarPosicionCola(posicion) {
+    const label = document.getElementById('typingCola');
+    if (!label) return;
+    label.textContent   = posicion > 0 ? `En cola (${posicion} antes)` : '';
+    label.style.display = posicion > 0 ? 'inline' : 'none';
+}
+
+/**
+ * Envía el mensaje a /api/chat/stream y va pintando la respuesta a medida
+ * que llega (Server-Sent Events sobre fetch: EventSource no admite POST).
+ * Mientras espera turno llegan eventos 'cola' con la posición.
+ * `clave` es la del envío: si la conexión falla antes de recibir respuesta
+ * se reenvía una vez con la misma clave (el servidor no lo duplica: si el
+ * primero llegó, el reenvío recibe su respuesta).
+ * Devuelve el payload del evento final { response, eventos_disparados }
+ * o { error }. La burbuja queda con el texto definitivo (ya recortado).
+ */
+async function _callChatStream(mensaje, clave) {
+    const pedir = () => fetch('/api/chat/stream', {
         method : 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body   : JSON.stringify({ message: mensaje }),
+        body   : JSON.stringify({ message: mensaje, clave }),
         signal : stopController ? stopController.signal : undefined,
     });
-    return await resp.json();
+    let resp;
+    try {
+        resp = await pedir();
+    } catch (e) {
+        if (e.name === 'AbortError') throw e;
+        await new Promise(r => setTimeout(r, 1000));
+        resp = await pedir();   // reenvío del mismo envío
+    }
+    if (!resp.ok || !resp.body) return await resp.json();   // validación (400)
+
+    const reader  = resp.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '', texto = '', burbuja = null, final = null;
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let corte;
+        while ((corte = buffer.indexOf('\n\n')) >= 0) {
+            const bloque = buffer.slice(0, corte);
+            buffer = buffer.slice(corte + 2);
+            let evento = 'message', datos = '';
+            bloque.split('\n').forEach(linea => {
+                if (linea.startsWith('event:'))     evento = linea.slice(6).trim();
+                else if (linea.startsWith('data:')) datos += linea.slice(5).trim();
+            });
+            if (!datos) continue;
+            const payload = JSON.parse(datos);
+
+            if (evento === 'cola') {
+                _mostrarPosicionCola(payload.posicion);
+            } else if (evento === 'delta') {
+                _mostrarPosicionCola(0);
+                if (!burbuja) {
+                    await _ocultarTyping();
+                    burbuja = _crearMensajeHiroVacio().bubble;
+                }
+                texto += payload.texto;
+                burbuja.innerHTML = formatHiroMessage(texto);
+                scrollToBottom();
+            } else if (evento === 'fin') {
+                final = payload;
+            } else if (evento === 'error') {
+                final = { error: payload.error };
+            }
+        }
+    }
+
+    _mostrarPosicionCola(0);
+    await _ocultarTyping();
+    if (!final) final = { error: 'La conexión se cortó antes de terminar la respuesta' };
+    if (final.error) {
+        if (burbuja) burbuja.closest('.message-wrapper').remove();
+    } else if (burbuja) {
+        burbuja.innerHTML = formatHiroMessage(final.response);   // texto definitivo
+    } else {
+        await renderMessageTypewriter(final.response);           // llegó sin fragmentos
+    }
+    return final;
 }
 
 async function sendExistingMessage(mensaje) {
@@ -656,15 +761,10 @@ async function sendExistingMessage(mensaje) {
     scrollToBottom();
 
     try {
-        const data = await _callChatAPI(mensaje);
-        typingIndicator.style.opacity = '0';
-        await new Promise(r => setTimeout(r, 200));
-        typingIndicator.style.display = 'none';
-        typingIndicator.style.opacity = '1';
+        const data = await _callChatStream(mensaje, _nuevaClaveEnvio());
         if (data.error) {
             renderMessage('assistant', `❌ Error: ${data.error}`);
         } else {
-            await renderMessageTypewriter(data.response);
             await detectarYMostrarExpresion(data.response);
             _procesarEventosDisparados(data.eventos_disparados);
         }
@@ -690,6 +790,7 @@ async function sendMessage() {
     const mensaje = messageInput.value.trim();
     if (!mensaje) return;
 
+    const clave = _nuevaClaveEnvio();   // una por envío, la comparten sus reenvíos
     messageInput.value = '';
     messageInput.style.height = 'auto';
     isWaiting = true;
@@ -705,15 +806,10 @@ async function sendMessage() {
     scrollToBottom();
 
     try {
-        const data = await _callChatAPI(mensaje);
-        typingIndicator.style.opacity = '0';
-        await new Promise(r => setTimeout(r, 200));
-        typingIndicator.style.display = 'none';
-        typingIndicator.style.opacity = '1';
+        const data = await _callChatStream(mensaje, clave);
         if (data.error) {
             renderMessage('assistant', `❌ Error: ${data.error}`);
         } else {
-            await renderMessageTypewriter(data.response);
             await detectarYMostrarExpresion(data.response); 
             _procesarEventosDisparados(data.eventos_disparados);
             loadStats();
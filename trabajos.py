@@ -0,0 +1,327 @@
+# ═══════════════════════════════════════════════════════════════════════════
+# TRABAJOS.PY — Cola durable de trabajos en segundo plano
+# Lo que antes era un threading.Thread suelto por mensaje (el post-proceso
+# del turno) ahora es una fila en la tabla `trabajos` de la DB del personaje
+# y lo ejecuta un pool FIJO de workers (jobs.workers en api_config.json):
+#
+#   - Durable: si el proceso se cae, al arrancar (iniciar_trabajos, desde
+#     app._init_app) los trabajos pendientes o a medio hacer se retoman.
+#   - Al menos una vez: un trabajo que falla se reintenta con backoff hasta
+#     jobs.maxAttempts; después queda 'fallido' con su error, a la vista.
+#   - Idempotente: cada trabajo tiene una clave única ("<id mensaje>:<etapa>"),
+#     encolarlo dos veces no lo duplica; y cada paso ya completado se guarda
+#     con su resultado (Trabajo.paso), así un reintento solo repite lo que
+#     faltaba — no vuelve a pagar la llamada al LLM ni a insertar dos veces.
+#   - Observable: stats_trabajos() → pendientes, en curso, fallidos, demora
+#     de la cola y trabajos por minuto (GET /api/trabajos).
+#
+# Los tipos de trabajo los registra quien los define (chat_engine.py) con
+# registrar_tipo(). Los handlers corren con prioridad SEGUNDO_PLANO en el
+# limitador y con el personaje del trabajo fijado en el hilo
+# (utils.personaje_del_hilo): cambiar de personaje no los desvía.
+# ═══════════════════════════════════════════════════════════════════════════
+
+import os
+import json
+import time
+import heapq
+import sqlite3
+import itertools
+import threading
+from collections import deque
+
+from utils import paths, _get_conn, PERSONAJES_DIR, cargar_config_apis, personaje_del_hilo
+from limitador import en_segundo_plano
+
+PENDIENTE, EN_CURSO, HECHO, FALLIDO = 'pendiente', 'en_curso', 'hecho', 'fallido'
+
+_tipos    = {}                    # tipo → handler(trabajo)
+_agenda   = []                    # heap (disponible_desde, llegada, pid, id)
+_llegadas = itertools.count()
+_cond     = threading.Condition()
+_workers  = []
+_pids     = set()                 # personajes con trabajos vistos en este proceso
+
+_metricas = {'hechos': 0, 'fallidos': 0, 'reintentos': 0, 'retomados': 0,
+             'duracion_total': 0.0, 'espera_total': 0.0}
+_terminados = deque(maxlen=1000)  # time.time() de cada trabajo terminado (para el ritmo)
+_met_lock = threading.Lock()
+
+
+class PasosFallidos(Exception):
+    """Uno o más pasos del trabajo fallaron: se reintenta solo lo que faltó."""
+
+
+def _config():
+    try:
+        return cargar_config_apis().get('jobs', {}) or {}
+    except Exception:
+        return {}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# TRABAJO (lo que recibe cada handler)
+# ─────────────────────────────────────────────────────────────────────────────
+
+class Trabajo:
+    """Un trabajo en ejecución: pid, tipo, payload y los pasos ya completados."""
+
+    def __init__(self, pid, tid, tipo, payload, pasos, intento):
+        self.pid     = pid
+        self.id      = tid
+        self.tipo    = tipo
+        self.payload = payload
+        self.intento = intento
+        self._pasos  = pasos
+        self._errores = []
+
+    def paso(self, nombre, fn, *args, **kwargs):
+        """
+        Ejecuta fn UNA sola vez a lo largo de todos los intentos: si el paso ya
+        se completó antes devuelve el resultado guardado (debe ser serializable
+        a JSON). Si falla, anota el error y devuelve None — los pasos que
+        siguen se ejecutan igual y al final el trabajo se reintenta.
+        Un paso falla solo si fn lanza: las funciones que atrapan sus propios
+        errores tienen que llamarse en su variante que los propaga.
+        """
+        if nombre in self._pasos:
+            return self._pasos[nombre]
+        try:
+            resultado = fn(*args, **kwargs)
+        except Exception as e:
+            print(f"⚠️ [{self.tipo}#{self.id}] Error en {nombre}: {e}")
+            self._errores.append(f"{nombre}: {e}")
+            return None
+        self._pasos[nombre] = resultado
+        with _get_conn(paths(self.pid)['db']) as conn:
+            conn.execute('UPDATE trabajos SET pasos = ? WHERE id = ?',
+                         (json.dumps(self._pasos, ensure_ascii=False), self.id))
+        return resultado
+
+    @property
+    def hubo_errores(self):
+        """True si algún paso falló en este intento."""
+        return bool(self._errores)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# ENCOLAR
+# ─────────────────────────────────────────────────────────────────────────────
+
+def registrar_tipo(tipo, fn):
+    """Asocia un tipo de trabajo a su handler: fn(trabajo)."""
+    _tipos[tipo] = fn
+
+
+def _agendar(pid, tid, cuando):
+    with _cond:
+        heapq.heappush(_agenda, (cuando, next(_llegadas), pid, tid))
+        _cond.notify()
+
+
+def encolar(pid, tipo, payload, clave=None):
+    """
+    Guarda el trabajo en la DB del personaje y lo agenda. Con `clave`, un
+    trabajo con la misma clave ya encolado (o hecho) no se duplica: devuelve
+    None. Si no, el id del trabajo nuevo.
+    """
+    ahora = time.time()
+    with _get_conn(paths(pid)['db']) as conn:
+        cursor = conn.execute(
+            '''INSERT OR IGNORE INTO trabajos
+               (clave, tipo, payload, estado, max_intentos, creado, disponible_desde)
+               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            (clave, tipo, json.dumps(payload, ensure_ascii=False), PENDIENTE,
+             max(1, int(_config().get('maxAttempts', 4))), ahora, ahora))
+        if cursor.rowcount == 0:
+            return None
+        tid = cursor.lastrowid
+    _pids.add(pid)
+    _agendar(pid, tid, ahora)
+    return tid
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# WORKERS
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _tomar(pid, tid):
+    """Marca el trabajo en curso si sigue pendiente (si no, otro ya lo tomó). Devuelve su fila o None."""
+    with _get_conn(paths(pid)['db']) as conn:
+        cursor = conn.execute(
+            '''UPDATE trabajos SET estado = ?, intentos = intentos + 1, iniciado = ?
+               WHERE id = ? AND estado = ?''', (EN_CURSO, time.time(), tid, PENDIENTE))
+        if cursor.rowcount == 0:
+            return None
+        return conn.execute(
+            '''SELECT tipo, payload, pasos, intentos, max_intentos, disponible_desde
+               FROM trabajos WHERE id = ?''', (tid,)).fetchone()
+
+
+def _ejecutar(pid, tid):
+    try:
+        fila = _tomar(pid, tid)
+    except sqlite3.Error as e:
+        print(f"⚠️ No se pudo tomar el trabajo {tid} [{pid}]: {e}")
+        return
+    if fila is None:
+        return
+    tipo, payload, pasos, intento, max_intentos, disponible = fila
+    inicio = time.time()
+    trabajo = Trabajo(pid, tid, tipo, json.loads(payload or '{}'), json.loads(pasos or '{}'), intento)
+
+    error = None
+    try:
+        handler = _tipos.get(tipo)
+        if handler is None:
+            raise LookupError(f"tipo de trabajo desconocido: {tipo}")
+        with personaje_del_hilo(pid):
+            handler(trabajo)
+        if trabajo._errores:
+            raise PasosFallidos('; '.join(trabajo._errores))
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"[:500]
+
+    fin = time.time()
+    with _met_lock:
+        _metricas['espera_total'] += max(0.0, inicio - (disponible or inicio))
+        _metricas['duracion_total'] += fin - inicio
+        if error is None:
+            _metricas['hechos'] += 1
+            _terminados.append(fin)
+        elif intento < max_intentos:
+            _metricas['reintentos'] += 1
+        else:
+            _metricas['fallidos'] += 1
+
+    try:
+        with _get_conn(paths(pid)['db']) as conn:
+            if error is None:
+                conn.execute('UPDATE trabajos SET estado = ?, terminado = ?, error = NULL WHERE id = ?',
+                             (HECHO, fin, tid))
+            elif intento < max_intentos:
+                espera = float(_config().get('retryBaseS', 10)) * (2 ** (intento - 1))
+                conn.execute('UPDATE trabajos SET estado = ?, disponible_desde = ?, error = ? WHERE id = ?',
+                             (PENDIENTE, fin + espera, error, tid))
+                _agendar(pid, tid, fin + espera)
+                print(f"🔁 Trabajo {tipo}#{tid} [{pid}] falló (intento {intento}/{max_intentos}), "
+                      f"reintento en {espera:.0f}s: {error[:120]}")
+            else:
+                conn.execute('UPDATE trabajos SET estado = ?, terminado = ?, error = ? WHERE id = ?',
+                             (FALLIDO, fin, error, tid))
+                print(f"❌ Trabajo {tipo}#{tid} [{pid}] fallido tras {intento} intento(s): {error[:120]}")
+    except sqlite3.Error as e:
+        print(f"⚠️ No se pudo registrar el resultado del trabajo {tid} [{pid}]: {e}")
+
+
+def _worker():
+    while True:
+        with _cond:
+            while not _agenda or _agenda[0][0] > time.time():
+                _cond.wait(None if not _agenda else _agenda[0][0] - time.time())
+            _, _, pid, tid = heapq.heappop(_agenda)
+        try:
+            en_segundo_plano(_ejecutar, pid, tid)
+        except Exception as e:
+            print(f"⚠️ Error en worker de trabajos: {e}")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# ARRANQUE
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _retomar(pid):
+    """Devuelve a pendiente lo que quedó en curso (el proceso murió), agenda lo pendiente y purga lo viejo."""
+    dias = float(_config().get('keepDoneDays', 7))
+    with _get_conn(paths(pid)['db']) as conn:
+        conn.execute('UPDATE trabajos SET estado = ? WHERE estado = ?', (PENDIENTE, EN_CURSO))
+        conn.execute('DELETE FROM trabajos WHERE estado = ? AND terminado < ?',
+                     (HECHO, time.time() - dias * 86400))
+        filas = conn.execute('SELECT id, disponible_desde FROM trabajos WHERE estado = ?',
+                             (PENDIENTE,)).fetchall()
+    _pids.add(pid)
+    for tid, disponible in filas:
+        _agendar(pid, tid, disponible or 0)
+    return len(filas)
+
+
+def iniciar_trabajos():
+    """
+    Arranca el pool de workers (una sola vez) y retoma los trabajos que
+    quedaron pendientes en la DB de cada personaje. Lo llama app._init_app().
+    """
+    if _workers:
+        return
+    retomados = 0
+    if os.path.isdir(PERSONAJES_DIR):
+        for pid in sorted(os.listdir(PERSONAJES_DIR)):
+            if not os.path.exists(paths(pid)['db']):
+                continue
+            try:
+                retomados += _retomar(pid)
+            except sqlite3.OperationalError:
+                pass   # DB de antes de la tabla trabajos: se crea al cargar el personaje
+            except Exception as e:
+                print(f"⚠️ No se pudieron retomar los trabajos de {pid}: {e}")
+    with _met_lock:
+        _metricas['retomados'] += retomados
+
+    n = max(1, int(_config().get('workers', 2)))
+    for i in range(n):
+        hilo = threading.Thread(target=_worker, name=f'trabajos-{i}', daemon=True)
+        hilo.start()
+        _workers.append(hilo)
+    print(f"🧵 Cola de trabajos: {n} worker(s)" + (f", {retomados} retomado(s)" if retomados else ""))
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# MÉTRICAS
+# ─────────────────────────────────────────────────────────────────────────────
+
+def stats_trabajos():
+    """
+    Conteo por estado y demora actual de la cola (el pendiente más viejo ya
+    disponible) por personaje, más el ritmo y los tiempos medios del proceso.
+    """
+    ahora = time.time()
+    personajes = {}
+    for pid in sorted(_pids):
+        try:
+            with _get_conn(paths(pid)['db']) as conn:
+                conteo = dict(conn.execute(
+                    'SELECT estado, COUNT(*) FROM trabajos GROUP BY estado').fetchall())
+                mas_viejo = conn.execute(
+                    'SELECT MIN(disponible_desde) FROM trabajos WHERE estado = ? AND disponible_desde <= ?',
+                    (PENDIENTE, ahora)).fetchone()[0]
+                ultimo_error = conn.execute(
+                    'SELECT tipo, error FROM trabajos WHERE estado = ? ORDER BY terminado DESC LIMIT 1',
+                    (FALLIDO,)).fetchone()
+        except sqlite3.Error:
+            continue
+        personajes[pid] = {
+            'pendientes': conteo.get(PENDIENTE, 0),
+            'en_curso': conteo.get(EN_CURSO, 0),
+            'hechos': conteo.get(HECHO, 0),
+            'fallidos': conteo.get(FALLIDO, 0),
+            'demora_s': round(ahora - mas_viejo, 1) if mas_viejo else 0.0,
+            'ultimo_fallo': {'tipo': ultimo_error[0], 'error': ultimo_error[1]} if ultimo_error else None,
+        }
+
+    with _met_lock:
+        m = dict(_metricas)
+        ultimos_5min = sum(1 for t in _terminados if ahora - t <= 300)
+    ejecutados = m['hechos'] + m['fallidos'] + m['reintentos']
+    with _cond:
+        agendados = len(_agenda)
+    return {
+        'workers': len(_workers),
+        'agendados': agendados,
+        'hechos': m['hechos'],
+        'fallidos': m['fallidos'],
+        'reintentos': m['reintentos'],
+        'retomados_al_arrancar': m['retomados'],
+        'por_minuto': round(ultimos_5min / 5, 2),
+        'espera_media_s': round(m['espera_total'] / ejecutados, 2) if ejecutados else 0.0,
+        'duracion_media_s': round(m['duracion_total'] / ejecutados, 2) if ejecutados else 0.0,
+        'personajes': personajes,
+    }
@@ -0,0 +1,186 @@
+# ═══════════════════════════════════════════════════════════════════════════
+# TURNOS.PY — Un turno de chat a la vez por personaje
+# Dos requests de chat solapadas (doble click, dos pestañas, un reintento)
+# se intercalaban en _procesar_mensaje: cada una leía el historial e
+# insertaba sus mensajes sin ver a la otra. Acá cada personaje tiene una
+# fila: los turnos se atienden de a uno, en orden de llegada; personajes
+# distintos no se esperan entre sí.
+#
+# Idempotencia: el cliente manda una clave por mensaje. Si la misma clave
+# llega otra vez mientras el turno original está en la fila o en curso (o
+# ya terminó, durante _RETENCION_S), no se procesa de nuevo: con la política
+# 'merge' el duplicado recibe la respuesta del original, con 'reject' se
+# rechaza con TurnoDuplicado. Si el original falla, la clave se libera y un
+# reintento posterior corre de cero.
+#
+# Posición en la fila: Turno.posicion() (0 = le toca) y estado_turnos(),
+# para que la UI muestre "en cola".
+#
+# Independiente: solo stdlib. La política la pasa chat_engine.py.
+# ═══════════════════════════════════════════════════════════════════════════
+
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_RETENCION_S = 600    # cuánto se recuerda la respuesta de una clave ya terminada
+_MAX_CLAVES  = 500
+
+
+class TurnoDuplicado(Exception):
+    """Esa clave ya se está procesando (o ya se procesó) y la política es rechazar."""
+
+
+class _Fila:
+    """Turnos de un personaje en orden de llegada: el primero es el que está en curso."""
+
+    def __init__(self):
+        self.cond   = threading.Condition()
+        self.espera = []
+
+
+class _Resultado:
+    """Lo que produjo el turno de una clave, para sus duplicados."""
+
+    def __init__(self, turno):
+        self.turno     = turno
+        self.evento    = threading.Event()
+        self.respuesta = None
+        self.error     = None
+        self.terminado = None
+
+    def listo(self, timeout=None):
+        return self.evento.wait(timeout)
+
+    def posicion(self):
+        return self.turno.posicion()
+
+    def valor(self):
+        """La respuesta del turno original (esperándolo si hace falta), o su error."""
+        self.evento.wait()
+        if self.error is not None:
+            raise RuntimeError(f"El mensaje original no se pudo procesar: {self.error}")
+        return self.respuesta
+
+
+_filas    = {}              # pid → _Fila
+_claves   = OrderedDict()   # (pid, clave) → _Resultado
+_lock     = threading.Lock()
+_metricas = {'turnos': 0, 'unidos': 0, 'rechazados': 0, 'esperaron': 0, 'espera_total': 0.0}
+
+
+class Turno:
+    """Un lugar en la fila del personaje. original != None: es un duplicado (no hace fila)."""
+
+    def __init__(self, pid, clave, fila, original=None):
+        self.pid      = pid
+        self.clave    = clave
+        self.original = original
+        self._fila    = fila
+        self._llegada = time.monotonic()
+        self._inicio  = None
+
+    def posicion(self):
+        """Turnos delante de este (0 = le toca o ya está en curso)."""
+        with self._fila.cond:
+            try:
+                return self._fila.espera.index(self)
+            except ValueError:
+                return 0
+
+    def esperar(self, timeout=None):
+        """Bloquea hasta que le toque. True si le toca; False si pasó `timeout` antes."""
+        with self._fila.cond:
+            listo = self._fila.cond.wait_for(lambda: self._fila.espera[0] is self, timeout)
+        if listo and self._inicio is None:
+            self._inicio = time.monotonic()
+            espera = self._inicio - self._llegada
+            with _lock:
+                _metricas['espera_total'] += espera
+                if espera >= 0.05:
+                    _metricas['esperaron'] += 1
+        return listo
+
+    def terminar(self, respuesta=None, error=None):
+        """Deja la fila (haya llegado a atenderse o no) y publica el resultado para los duplicados."""
+        with self._fila.cond:
+            if self in self._fila.espera:
+                self._fila.espera.remove(self)
+                self._fila.cond.notify_all()
+        if self.clave is None:
+            return
+        with _lock:
+            resultado = _claves.get((self.pid, self.clave))
+            if resultado is None or resultado.turno is not self:
+                return
+            if error is not None:
+                resultado.error = str(error) or type(error).__name__
+                del _claves[(self.pid, self.clave)]   # un reintento con la misma clave corre de cero
+            else:
+                resultado.respuesta = respuesta
+            resultado.terminado = time.monotonic()
+        resultado.evento.set()
+
+
+def _purgar_claves(ahora):
+    while _claves:
+        clave, r = next(iter(_claves.items()))
+        if len(_claves) > _MAX_CLAVES or (r.terminado is not None and ahora - r.terminado > _RETENCION_S):
+            _claves.popitem(last=False)
+        else:
+            break
+
+
+def pedir_turno(pid, clave=None, duplicados='merge'):
+    """
+    Pone un turno en la fila del personaje (al final). Con `clave` ya vista:
+    'merge' → Turno con .original (el resultado del primero, no hace fila);
+    'reject' → TurnoDuplicado. Siempre hay que llamar a terminar() al final.
+    """
+    with _lock:
+        ahora = time.monotonic()
+        _purgar_claves(ahora)
+        fila = _filas.setdefault(pid, _Fila())
+        if clave:
+            existente = _claves.get((pid, clave))
+            if existente is not None:
+                if duplicados == 'reject':
+                    _metricas['rechazados'] += 1
+                    raise TurnoDuplicado("Ese mensaje ya se está procesando")
+                _metricas['unidos'] += 1
+                return Turno(pid, clave, fila, original=existente)
+        turno = Turno(pid, clave, fila)
+        if clave:
+            _claves[(pid, clave)] = _Resultado(turno)
+        _metricas['turnos'] += 1
+    with fila.cond:
+        fila.espera.append(turno)
+    return turno
+
+
+@contextmanager
+def turno_exclusivo(pid):
+    """Bloque que corre como un turno más de la fila del personaje (sin clave)."""
+    turno = pedir_turno(pid)
+    try:
+        turno.esperar()
+        yield turno
+    finally:
+        turno.terminar()
+
+
+def estado_turnos():
+    """Por personaje: si hay un turno en curso y cuántos esperan; más los totales del proceso."""
+    with _lock:
+        filas = dict(_filas)
+        m = dict(_metricas)
+    personajes = {}
+    for pid, fila in sorted(filas.items()):
+        with fila.cond:
+            n = len(fila.espera)
+        if n:
+            personajes[pid] = {'en_curso': True, 'en_espera': n - 1}
+    m['espera_media_s'] = round(m.pop('espera_total') / m['turnos'], 2) if m['turnos'] else 0.0
+    m['personajes'] = personajes
+    return m
@@ -6,11 +6,19 @@
 # archivo (nivel raíz del proyecto, junto a app.py)
 # ═══════════════════════════════════════════════════════════════════════════
 
-import os, json, time, uuid, sqlite3, base64, shutil
+import os, re, json, time, uuid, sqlite3, base64, shutil, unicodedata
 from datetime import datetime, timedelta, timezone
 import json
 import os
+import threading
+import importlib.util
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httpx
 from mistralai import Mistral
+import limitador
+import resiliencia
+from resiliencia import ErrorProveedor
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -24,6 +32,81 @@ ARGENTINA_TZ = timezone(timedelta(hours=-3))
 def now_argentina():
     return datetime.now(ARGENTINA_TZ)
 
+# ─────────────────────────────────────────────────────────────────────────────
+# TRANSPORTE HTTP COMPARTIDO
+# Un solo httpx.Client para todo el proceso (LLM, embeddings, búsqueda web,
+# listado de modelos): pool de conexiones por host con keep-alive, así cada
+# llamada reusa la conexión TCP+TLS abierta en vez de abrir una nueva.
+# HTTP/2 si está instalado el paquete 'h2' (pip install h2); si no, HTTP/1.1.
+# También se le pasa al SDK de Mistral (ver _cliente_mistral()).
+# ─────────────────────────────────────────────────────────────────────────────
+
+_http        = None
+_http_lock   = threading.Lock()
+_HTTP_LIMITES = httpx.Limits(max_connections=64,            # entre todos los hosts
+                             max_keepalive_connections=16,  # ociosas que se conservan
+                             keepalive_expiry=90)           # segundos
+
+def http_cliente():
+    """Devuelve el httpx.Client compartido (se crea al primer uso). Es thread-safe."""
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                http2 = importlib.util.find_spec('h2') is not None
+                _http = httpx.Client(limits=_HTTP_LIMITES, http2=http2, follow_redirects=True,
+                                     timeout=httpx.Timeout(30, connect=10))
+                print(f"🌐 Transporte HTTP compartido ({'HTTP/2' if http2 else 'HTTP/1.1'}, keep-alive)")
+    return _http
+
+
+def _limites_rpm(proveedor, modelo, config):
+    """[(clave, rpm)] del proveedor (<proveedor>.rpmLimit) y del modelo (<proveedor>.modelRpm)."""
+    cfg = config.get(proveedor) or {}
+    limites = [(proveedor, cfg.get('rpmLimit'))]
+    if modelo:
+        limites.append((f"{proveedor}:{modelo}", (cfg.get('modelRpm') or {}).get(modelo)))
+    return limites
+
+
+def esperar_turno(proveedor, modelo=None, config=None):
+    """
+    Espera cupo en el limitador (limitador.py) antes de llamar a un proveedor:
+    una ficha de la cubeta del proveedor (<proveedor>.rpmLimit) y otra de la
+    del modelo si <proveedor>.modelRpm lo limita aparte. La prioridad es la
+    del hilo: el post-proceso corre con limitador.en_segundo_plano().
+    """
+    try:
+        limites = _limites_rpm(proveedor, modelo, config or cargar_config_apis())
+    except Exception:
+        return
+    espera = limitador.adquirir(limites)
+    if espera >= 1:
+        print(f"⏳ [{proveedor}] {espera:.1f}s esperando cupo de rpmLimit")
+
+
+@contextmanager
+def _turno_llm(proveedor, modelo, config):
+    """
+    Context manager para UNA llamada a un LLM (ver limitador.turno()).
+    Con queueEnabled: cupo de concurrencia (<proveedor>.maxConcurrent) por
+    prioridad y plazos de la cola para las clases de fondo (queueDeadlines).
+    Sin queueEnabled: solo el límite de rpm.
+    Si la llamada es una de las dos de un hedge y la otra ya respondió
+    mientras esta esperaba turno, no se envía (resiliencia.LlamadaCancelada).
+    """
+    limites = _limites_rpm(proveedor, modelo, config)
+    if not config.get('queueEnabled', True):
+        turno = limitador.turno(proveedor, limites)
+    else:
+        turno = limitador.turno(proveedor, limites,
+                                (config.get(proveedor) or {}).get('maxConcurrent'),
+                                config.get('queueDeadlines'))
+    with turno:
+        resiliencia.verificar_cancelacion()
+        yield
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # CONFIGURACIÓN DE PROVEEDOR LLM
 #
@@ -50,28 +133,37 @@ def now_argentina():
 # ── Cliente Mistral (lazy — se inicializa desde api_config.json al primer uso) ─
 # El .env ya NO es necesario. Todo se configura desde el Gestor de APIs.
 # Se mantiene como fallback para instalaciones antiguas que aún lo tengan.
-mistral_client = None   # inicializado por _get_mistral_client() la primera vez
+# Se reconstruye solo cuando cambia la key; usa el transporte compartido.
+mistral_client = None   # (api_key, Mistral) del último cliente armado
+_mistral_lock  = threading.Lock()
 
-def _get_mistral_client():
-    """
-    Devuelve un cliente Mistral inicializado desde api_config.json.
-    Si ya existe uno activo lo reutiliza. Fallback a MISTRAL_API_KEY del .env.
-    Devuelve None si no hay key configurada (FAISS quedará desactivado).
-    """
+def _cliente_mistral(api_key):
+    """Cliente Mistral para esta key, reutilizado mientras la key no cambie."""
     global mistral_client
-    if mistral_client is not None:
-        return mistral_client
+    with _mistral_lock:
+        if mistral_client is None or mistral_client[0] != api_key:
+            mistral_client = (api_key, Mistral(api_key=api_key, client=http_cliente()))
+        return mistral_client[1]
+
+def _key_mistral(config=None):
+    """API key de Mistral: api_config.json y, si no hay, MISTRAL_API_KEY del .env."""
     try:
-        config = cargar_config_apis()
+        config = config or cargar_config_apis()
         api_key = (config.get('mistral', {}).get('apiKey') or '').strip()
     except Exception:
         api_key = ''
-    if not api_key:
-        api_key = os.getenv('MISTRAL_API_KEY', '').strip()
+    return api_key or os.getenv('MISTRAL_API_KEY', '').strip()
+
+def _get_mistral_client():
+    """
+    Devuelve un cliente Mistral inicializado desde api_config.json.
+    Si ya existe uno para la key actual lo reutiliza. Fallback a MISTRAL_API_KEY del .env.
+    Devuelve None si no hay key configurada (FAISS quedará desactivado).
+    """
+    api_key = _key_mistral()
     if api_key:
         try:
-            mistral_client = Mistral(api_key=api_key)
-            return mistral_client
+            return _cliente_mistral(api_key)
         except Exception as e:
             print(f"⚠️  Error inicializando cliente Mistral: {e}")
     return None
@@ -160,12 +252,16 @@ def obtener_config_predeterminada():
             "enabled": True,
             "apiKey": os.getenv('MISTRAL_API_KEY', ''),
             "endpoint": "https://api.mistral.ai/v1",
-            "rpmLimit": 30
+            "rpmLimit": 30,
+            "modelRpm": {},
+            "maxConcurrent": 4
         },
         "openrouter": {
             "enabled": False,
             "apiKey": os.getenv('OPENROUTER_API_KEY', ''),
-            "rpmLimit": 60
+            "rpmLimit": 60,
+            "modelRpm": {},
+            "maxConcurrent": 4
         },
         "models": {
             "chat": "mistral-large-latest",
@@ -186,9 +282,85 @@ def obtener_config_predeterminada():
             "primaryProvider": "mistral",
             "secondaryProvider": "openrouter",
             "retryEnabled": True,
-            "retryAttempts": 3
+            "retryAttempts": 3,
+            "backoffBaseMs": 500,
+            "backoffMaxMs": 8000,
+            "maxRetryAfterS": 20
         },
+        "circuitBreaker": {
+            "enabled": True,
+            "failureThreshold": 3,
+            "openSeconds": 30
+        },
+        "hedging": {
+            "enabled": False,
+            "percentile": 95,
+            "minSamples": 20,
+            "defaultDelayMs": 8000,
+            "minDelayMs": 1000
+        },
+        "turns": {
+            "duplicates": "merge"
+        },
+        "preReply": {
+            "parallel": True,
+            "contextTimeoutMs": 15000,
+            "searchTimeoutMs": 4000
+        },
+        "consolidatedAnalysis": True,
         "queueEnabled": True,
+        "queueDeadlines": {
+            "extraccion": 120,
+            "analisis": 600,
+            "segundo_plano": 900
+        },
+        "jobs": {
+            "workers": 2,
+            "maxAttempts": 4,
+            "retryBaseS": 10,
+            "keepDoneDays": 7
+        },
+        "embeddingCache": {
+            "enabled": True,
+            "maxEntries": 20000
+        },
+        "faiss": {
+            "indexType": "auto",
+            "ivfThreshold": 20000,
+            "pqThreshold": 500000,
+            "nprobe": 16,
+            "efSearch": 64,
+            "hnswM": 32,
+            "pqM": 64,
+            "reindexAuto": True,
+            "reindexPauseMs": 500,
+            "maxResident": 8,
+            "memoryBudgetMB": 1024,
+            "mmap": True,
+            "storage": "float",
+            "rerank": True,
+            "rerankFactor": 4,
+            "hybrid": True,
+            "embedTimeoutMs": 1500
+        },
+        "searchClassifier": {
+            "enabled": True,
+            "lowThreshold": 0.15,
+            "highThreshold": 0.9,
+            "minSamples": 30,
+            "auditRate": 0.05
+        },
+        "searchCache": {
+            "enabled": True,
+            "race": True,
+            "ttlS": {
+                "serpapi": 21600,
+                "brave": 21600,
+                "tavily": 10800
+            },
+            "staleS": 86400,
+            "maxEntries": 2000
+        },
         "search": {
             "enabled": False,
             "serpapi_key": "",
@@ -347,20 +519,19 @@ def _inferir_tarea(model, config):
 def _llamar_mistral(model, messages, max_tokens, config, detect_nsfw=True, temperature=None):
     """Llamada con la SDK nueva de Mistral (v1+). Nunca usa el .env directamente."""
     print(f"🔵 [Mistral] {model} → {_inferir_tarea(model, config)}")
-    api_key = (config.get('mistral', {}).get('apiKey') or '').strip()
-    if not api_key:
-        api_key = os.getenv('MISTRAL_API_KEY', '').strip()
+    api_key = _key_mistral(config)
     if not api_key:
         raise ValueError(
             "No hay API key de Mistral configurada. "
             "Andá al Gestor de APIs y agregá tu clave."
         )
 
-    client = Mistral(api_key=api_key)
+    client = _cliente_mistral(api_key)
     kwargs = dict(model=model, messages=messages, max_tokens=max_tokens)
     if temperature is not None:
         kwargs['temperature'] = temperature
-    response = client.chat.complete(**kwargs)
+    with _turno_llm('mistral', model, config):
+        response = client.chat.complete(**kwargs)
 
     # ── Detección NSFW opcional ───────────────────────────────────────────────
     nsfw = config.get('nsfw', {})
@@ -378,11 +549,10 @@ def _llamar_mistral(model, messages, max_tokens, config, detect_nsfw=True, tempe
     return response
 
 
-def _llamar_openrouter(model, messages, max_tokens, config, temperature=None):
-    """Llamada a OpenRouter vía requests. Devuelve objeto compatible con Mistral response."""
-    import requests as _req
-    print(f"🟠 [OpenRouter] {model} → {_inferir_tarea(model, config)}")
+_URL_OPENROUTER = "https://openrouter.ai/api/v1/chat/completions"
 
+
+def _key_openrouter(config):
     api_key = (config.get('openrouter', {}).get('apiKey') or '').strip()
     if not api_key:
         api_key = os.getenv('OPENROUTER_API_KEY', '').strip()
@@ -391,7 +561,18 @@ def _llamar_openrouter(model, messages, max_tokens, config, temperature=None):
             "No hay API key de OpenRouter configurada. "
             "Andá al Gestor de APIs y agregá tu clave."
         )
+    return api_key
+
 
+def _headers_openrouter(api_key):
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "HTTP-Referer": "http://localhost",
+        "Content-Type": "application/json",
+    }
+
+
+def _payload_openrouter(model, messages, max_tokens, temperature=None):
     payload = {"model": model, "messages": messages, "max_tokens": max_tokens}
     if temperature is not None:
         payload['temperature'] = temperature
@@ -400,19 +581,26 @@ def _llamar_openrouter(model, messages, max_tokens, config, temperature=None):
     MODELOS_REASONING = ('deepseek', 'aion-labs', 'qwen')
     if any(m in model for m in MODELOS_REASONING):
         payload['reasoning'] = {'enabled': False}
-    resp = _req.post(
-        "https://openrouter.ai/api/v1/chat/completions",
-        headers={
-            "Authorization": f"Bearer {api_key}",
-            "HTTP-Referer": "http://localhost",
-            "Content-Type": "application/json",
-        },
-        json=payload,
-        timeout=90,
-    )
+    return payload
+
+
+def _llamar_openrouter(model, messages, max_tokens, config, temperature=None):
+    """Llamada a OpenRouter vía el transporte compartido. Devuelve objeto compatible con Mistral response."""
+    print(f"🟠 [OpenRouter] {model} → {_inferir_tarea(model, config)}")
+
+    api_key = _key_openrouter(config)
+    payload = _payload_openrouter(model, messages, max_tokens, temperature)
+    with _turno_llm('openrouter', model, config):
+        resp = http_cliente().post(
+            _URL_OPENROUTER,
+            headers=_headers_openrouter(api_key),
+            json=payload,
+            timeout=90,
+        )
 
     if resp.status_code != 200:
-        raise Exception(f"OpenRouter error {resp.status_code}: {resp.text[:300]}")
+        raise ErrorProveedor(f"OpenRouter error {resp.status_code}: {resp.text[:300]}",
+                             resp.status_code, resp.headers)
 
     data    = resp.json()
     message = data['choices'][0]['message']
@@ -448,31 +636,72 @@ def _llamar_openrouter(model, messages, max_tokens, config, temperature=None):
     return _Resp(content)
 
 
-def llamada_mistral_segura(model, messages, max_tokens=600, detect_nsfw=True, temperature=None):
-    """
-    Punto único de llamada a LLM. Lee TODO desde api_config.json — ya no depende del .env.
-
-    - Detecta el provider activo (Mistral u OpenRouter) desde el config.
-    - Resuelve el modelo real según la tarea (chat vs análisis).
-    - Reintentos automáticos + fallback al proveedor secundario si está configurado.
-    - temperature=None usa el default del proveedor. Pasá 0.85-0.9 para chat/roleplay.
-
-    'model' puede ser un nombre Mistral ('mistral-large-latest') usado como
-    indicador de tarea, o directamente un ID de OpenRouter ('gryphe/mythomax-l2-13b').
+# ─────────────────────────────────────────────────────────────────────────────
+# STREAMING — la respuesta del chat fragmento a fragmento
+# Generadores de texto: el turno de la cola (_turno_llm) queda tomado mientras
+# el proveedor escribe y se libera al agotar o cerrar (.close()) el generador,
+# que además corta la conexión: el proveedor deja de generar.
+# ─────────────────────────────────────────────────────────────────────────────
 
-    IMPORTANTE: si el modelo configurado (models.chat/extraction) tiene '/' en su ID,
-    se fuerza OpenRouter independientemente de cuál sea el primaryProvider. Esto evita
-    que modelos de OpenRouter se envíen por error a la API de Mistral.
+def _stream_mistral(model, messages, max_tokens, config, temperature=None):
+    print(f"🔵 [Mistral] {model} → {_inferir_tarea(model, config)} (stream)")
+    api_key = _key_mistral(config)
+    if not api_key:
+        raise ValueError(
+            "No hay API key de Mistral configurada. "
+            "Andá al Gestor de APIs y agregá tu clave."
+        )
+    kwargs = dict(model=model, messages=messages, max_tokens=max_tokens)
+    if temperature is not None:
+        kwargs['temperature'] = temperature
+    with _turno_llm('mistral', model, config):
+        with _cliente_mistral(api_key).chat.stream(**kwargs) as eventos:
+            for evento in eventos:
+                choices = evento.data.choices
+                texto = choices[0].delta.content if choices else None
+                if isinstance(texto, list):   # bloques (ContentChunk)
+                    texto = ''.join(getattr(b, 'text', '') or '' for b in texto)
+                if isinstance(texto, str) and texto:
+                    yield texto
+
+
+def _stream_openrouter(model, messages, max_tokens, config, temperature=None):
+    print(f"🟠 [OpenRouter] {model} → {_inferir_tarea(model, config)} (stream)")
+    api_key = _key_openrouter(config)
+    payload = dict(_payload_openrouter(model, messages, max_tokens, temperature), stream=True)
+    with _turno_llm('openrouter', model, config):
+        with http_cliente().stream("POST", _URL_OPENROUTER, headers=_headers_openrouter(api_key),
+                                   json=payload, timeout=90) as resp:
+            if resp.status_code != 200:
+                resp.read()
+                raise ErrorProveedor(f"OpenRouter error {resp.status_code}: {resp.text[:300]}",
+                                     resp.status_code, resp.headers)
+            for linea in resp.iter_lines():
+                # SSE: "data: {...}"; las líneas ": OPENROUTER PROCESSING" son keep-alive
+                if not linea.startswith('data:'):
+                    continue
+                datos = linea[5:].strip()
+                if datos == '[DONE]':
+                    break
+                try:
+                    chunk = json.loads(datos)
+                except ValueError:
+                    continue
+                if chunk.get('error'):
+                    raise ErrorProveedor(f"OpenRouter error en stream: {chunk['error']}",
+                                         chunk['error'].get('code') if isinstance(chunk['error'], dict) else None)
+                choices = chunk.get('choices') or [{}]
+                texto = (choices[0].get('delta') or {}).get('content')
+                if isinstance(texto, str) and texto:
+                    yield texto
+
+
+def _proveedor_para_modelo(real_model, provider, config):
+    """
+    Proveedor que realmente corresponde al modelo resuelto: si el ID tiene '/'
+    es de OpenRouter, si no es de Mistral. Lanza ValueError si hace falta
+    redirigir y el otro proveedor no tiene key.
     """
-    config   = cargar_config_apis()
-    provider = obtener_proveedor_actual()
-
-    retry_enabled = config.get('fallback', {}).get('retryEnabled', True)
-    max_retries   = config.get('fallback', {}).get('retryAttempts', 3) if retry_enabled else 1
-
-    real_model = _resolver_modelo_para_llamada(model, provider, config)
-
-    # ── Auto-detección del proveedor real según el ID del modelo ────────────
     # Regla simple: si tiene '/' es de OpenRouter, si no es de Mistral.
     # Esto evita que modelos de un proveedor se manden al otro por error.
     if '/' in real_model and provider == 'mistral':
@@ -495,36 +724,273 @@ def llamada_mistral_segura(model, messages, max_tokens=600, detect_nsfw=True, te
             raise ValueError(
                 f"El modelo '{real_model}' requiere Mistral pero no hay API key configurada."
             )
+    return provider
+
+
+def _politica_reintentos(config):
+    """(cb_on, umbral, abierto_s, base_s, tope_s, max_retry_after_s) de fallback + circuitBreaker."""
+    fallback_cfg = config.get('fallback', {})
+    cb_cfg = config.get('circuitBreaker', {}) or {}
+    return (cb_cfg.get('enabled', True),
+            int(cb_cfg.get('failureThreshold', 3)),
+            float(cb_cfg.get('openSeconds', 30)),
+            float(fallback_cfg.get('backoffBaseMs', 500)) / 1000,
+            float(fallback_cfg.get('backoffMaxMs', 8000)) / 1000,
+            float(fallback_cfg.get('maxRetryAfterS', 20)))
+
+
+def llamada_mistral_segura(model, messages, max_tokens=600, detect_nsfw=True, temperature=None,
+                           prioridad=None, tarea=None):
+    """
+    Punto único de llamada a LLM. Lee TODO desde api_config.json — ya no depende del .env.
+
+    - Detecta el provider activo (Mistral u OpenRouter) desde el config.
+    - Resuelve el modelo real según la tarea (chat vs análisis).
+    - Reintentos con backoff exponencial + jitter (o el Retry-After del proveedor)
+      solo para errores reintentables, y fallback al proveedor secundario si está
+      configurado. Un proveedor con el circuito abierto (resiliencia.py) se
+      saltea sin esperar timeouts.
+    - temperature=None usa el default del proveedor. Pasá 0.85-0.9 para chat/roleplay.
+
+    'model' puede ser un nombre Mistral ('mistral-large-latest') usado como
+    indicador de tarea, o directamente un ID de OpenRouter ('gryphe/mythomax-l2-13b').
+
+    IMPORTANTE: si el modelo configurado (models.chat/extraction) tiene '/' en su ID,
+    se fuerza OpenRouter independientemente de cuál sea el primaryProvider. Esto evita
+    que modelos de OpenRouter se envíen por error a la API de Mistral.
+
+    prioridad: clase de la llamada en la cola (limitador.EXTRACCION, ANALISIS…).
+    None = la del hilo. Nunca baja la del hilo: desde un request de la UI
+    cualquier llamada es interactiva. Si la cola está activa (queueEnabled)
+    y una llamada de fondo vence su plazo esperando, lanza
+    limitador.LlamadaDescartada sin reintentar ni caer al secundario.
+
+    tarea='chat' marca la respuesta que el usuario está esperando: con
+    hedging.enabled, si el primario no contesta dentro del percentil
+    configurado de sus latencias recientes, se lanza la misma llamada al
+    secundario y gana la primera que responda (ver _llamar_con_hedge()).
+    """
+    if prioridad is not None:
+        with limitador.con_prioridad(prioridad):
+            return llamada_mistral_segura(model, messages, max_tokens, detect_nsfw, temperature,
+                                          tarea=tarea)
+
+    config   = cargar_config_apis()
+    provider = obtener_proveedor_actual()
+
+    retry_enabled = config.get('fallback', {}).get('retryEnabled', True)
+    max_retries   = config.get('fallback', {}).get('retryAttempts', 3) if retry_enabled else 1
+
+    real_model = _resolver_modelo_para_llamada(model, provider, config)
+
+    provider = _proveedor_para_modelo(real_model, provider, config)
+
+    # ── Reintentos con backoff + circuit breaker (resiliencia.py) ───────────
+    fallback_cfg = config.get('fallback', {})
+    cb_on, umbral, abierto, base, tope, max_ra = _politica_reintentos(config)
+
+    def _intentar(prov, modelo_real, nsfw):
+        """Una llamada al proveedor, informando el resultado a su circuito."""
+        inicio = time.monotonic()
+        try:
+            respuesta = _llamar_proveedor(prov, modelo_real, messages, max_tokens, config, nsfw, temperature)
+        except Exception as e:
+            if cb_on:
+                if resiliencia.es_reintentable(e) and not isinstance(e, limitador.LlamadaDescartada):
+                    resiliencia.registrar_fallo(prov, e, umbral)
+                else:
+                    resiliencia.liberar_prueba(prov)
+            raise
+        if cb_on:
+            resiliencia.registrar_exito(prov)
+        if tarea == 'chat':
+            resiliencia.registrar_latencia(prov, time.monotonic() - inicio)
+        return respuesta
+
+    # ── Hedging (solo chat): carrera contra el secundario si el primario tarda ─
+    hedge_cfg = config.get('hedging', {}) or {}
+    alt       = 'openrouter' if provider == 'mistral' else 'mistral'
+    alt_cfg   = config.get(alt, {})
+    alt_listo = bool(alt_cfg.get('enabled') and alt_cfg.get('apiKey', '').strip())
+    hedge_on  = tarea == 'chat' and hedge_cfg.get('enabled') and alt_listo
+
+    def _intentar_con_hedge():
+        p = resiliencia.percentil_latencia(provider, hedge_cfg.get('percentile', 95),
+                                           hedge_cfg.get('minSamples', 20))
+        retraso = p if p is not None else hedge_cfg.get('defaultDelayMs', 8000) / 1000
+        retraso = max(retraso, hedge_cfg.get('minDelayMs', 1000) / 1000)
+        alt_model = _resolver_modelo_para_llamada(model, alt, config)
+        return _llamar_con_hedge(
+            lambda: _intentar(provider, real_model, detect_nsfw),
+            lambda: _intentar(alt, alt_model, False),
+            retraso, provider, alt,
+            permitir_secundario=lambda: not cb_on or resiliencia.permitir(alt, abierto))
 
     last_error = None
 
     for attempt in range(max_retries):
+        if cb_on and not resiliencia.permitir(provider, abierto):
+            print(f"⚡ [{provider}] circuito abierto: sin reintentos, directo al secundario")
+            last_error = last_error or Exception(f"Circuito de {provider} abierto")
+            break
         try:
-            if provider == 'mistral':
-                return _llamar_mistral(real_model, messages, max_tokens, config, detect_nsfw, temperature)
-            else:
-                return _llamar_openrouter(real_model, messages, max_tokens, config, temperature)
+            if hedge_on and attempt == 0:
+                return _intentar_con_hedge()
+            return _intentar(provider, real_model, detect_nsfw)
+        except limitador.LlamadaDescartada:
+            raise   # venció su plazo en la cola: reintentar solo la demoraría más
         except Exception as e:
             last_error = e
+            if not resiliencia.es_reintentable(e):
+                print(f"⚠️ Error no reintentable en intento {attempt + 1}/{max_retries}: {e}")
+                break
             print(f"⚠️ Error intento {attempt + 1}/{max_retries}: {e}")
             if attempt < max_retries - 1:
-                time.sleep(1)
+                espera = resiliencia.espera_reintento(attempt, e, base, tope)
+                if espera > max_ra:
+                    print(f"⏳ [{provider}] pide esperar {espera:.0f}s: directo al secundario")
+                    break
+                time.sleep(espera)
 
     # ── Fallback al proveedor secundario ─────────────────────────────────────
-    fallback_cfg = config.get('fallback', {})
     if fallback_cfg.get('enabled'):
-        alt = 'openrouter' if provider == 'mistral' else 'mistral'
-        alt_cfg = config.get(alt, {})
-        if alt_cfg.get('enabled') and alt_cfg.get('apiKey', '').strip():
-            print(f"🔄 Fallback a {alt} después de {max_retries} reintentos")
-            alt_model = _resolver_modelo_para_llamada(model, alt, config)
+        if alt_listo:
+            if cb_on and not resiliencia.permitir(alt, abierto):
+                print(f"❌ Fallback imposible: el circuito de {alt} también está abierto")
+            else:
+                print(f"🔄 Fallback a {alt}")
+                alt_model = _resolver_modelo_para_llamada(model, alt, config)
+                try:
+                    return _intentar(alt, alt_model, False)
+                except limitador.LlamadaDescartada:
+                    raise
+                except Exception as e2:
+                    print(f"❌ Fallback también falló: {e2}")
+
+    raise last_error or Exception("No se pudo completar la llamada LLM")
+
+
+_hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge')
+
+
+def _llamar_con_hedge(primaria, secundaria, retraso, proveedor, alt, permitir_secundario=None):
+    """
+    Carrera para una llamada de chat: lanza `primaria()`; si en `retraso`
+    segundos no terminó, lanza también `secundaria()` y devuelve la primera
+    respuesta buena. La perdedora se cancela: si todavía esperaba turno en la
+    cola no se envía; si ya estaba en vuelo se abandona (el cliente HTTP es
+    sincrónico) y su respuesta se descarta. Si fallan las dos, lanza el error
+    del primario para que llamada_mistral_segura() siga con sus reintentos.
+    Registra tasa de hedging, ganadores y ahorro en resiliencia.stats_hedging().
+    """
+    evento = threading.Event()
+    f1 = _hedge_pool.submit(resiliencia.con_cancelacion, evento, primaria)
+    if wait([f1], timeout=retraso).done or (permitir_secundario and not permitir_secundario()):
+        resiliencia.registrar_hedge(False)
+        return f1.result()
+
+    print(f"🪁 [{proveedor}] sin respuesta en {retraso:.1f}s: misma llamada a {alt} (hedge)")
+    f2 = _hedge_pool.submit(resiliencia.con_cancelacion, evento, secundaria)
+    pendientes = {f1: True, f2: False}   # future → ¿es el primario?
+    errores = {}
+    while pendientes:
+        listos, _ = wait(pendientes, return_when=FIRST_COMPLETED)
+        for f in listos:
+            es_primario = pendientes.pop(f)
             try:
-                if alt == 'mistral':
-                    return _llamar_mistral(alt_model, messages, max_tokens, config, detect_nsfw=False, temperature=temperature)
-                else:
-                    return _llamar_openrouter(alt_model, messages, max_tokens, config, temperature=temperature)
-            except Exception as e2:
-                print(f"❌ Fallback también falló: {e2}")
+                respuesta = f.result()
+            except Exception as e:
+                errores[es_primario] = e
+                continue
+            evento.set()
+            resiliencia.registrar_hedge(True, es_primario)
+            if not es_primario and f1 in pendientes:
+                ganado = time.monotonic()
+                f1.add_done_callback(lambda fut: fut.exception() is None and
+                                     resiliencia.registrar_ahorro(time.monotonic() - ganado))
+            print(f"🏁 Hedge: ganó {proveedor if es_primario else alt}")
+            return respuesta
+
+    resiliencia.registrar_hedge(True, None)
+    raise errores.get(True) or errores[False]
+
+
+def _llamar_proveedor(proveedor, model, messages, max_tokens, config, detect_nsfw=True, temperature=None):
+    """Despacha una llamada (un solo intento) al proveedor indicado."""
+    if proveedor == 'mistral':
+        return _llamar_mistral(model, messages, max_tokens, config, detect_nsfw, temperature)
+    return _llamar_openrouter(model, messages, max_tokens, config, temperature)
+
+
+def llamada_stream_segura(model, messages, max_tokens=600, temperature=None):
+    """
+    Variante en streaming de llamada_mistral_segura(): generador de fragmentos
+    de texto a medida que el modelo escribe. Misma resolución de modelo y
+    proveedor, misma cola (siempre con la prioridad del hilo) y misma política
+    de reintentos, circuito y fallback — pero solo hasta el primer fragmento:
+    una vez que el usuario empezó a ver la respuesta, un error se propaga.
+    Sin hedging ni detección NSFW con auto-switch (no se puede retirar texto
+    ya mostrado). Cerrar el generador corta la generación en el proveedor.
+    """
+    config   = cargar_config_apis()
+    provider = obtener_proveedor_actual()
+
+    retry_enabled = config.get('fallback', {}).get('retryEnabled', True)
+    max_retries   = config.get('fallback', {}).get('retryAttempts', 3) if retry_enabled else 1
+
+    real_model = _resolver_modelo_para_llamada(model, provider, config)
+    provider   = _proveedor_para_modelo(real_model, provider, config)
+    cb_on, umbral, abierto, base, tope, max_ra = _politica_reintentos(config)
+
+    intentos = [(provider, real_model, max_retries)]
+    alt      = 'openrouter' if provider == 'mistral' else 'mistral'
+    alt_cfg  = config.get(alt, {})
+    if config.get('fallback', {}).get('enabled') and alt_cfg.get('enabled') and alt_cfg.get('apiKey', '').strip():
+        intentos.append((alt, _resolver_modelo_para_llamada(model, alt, config), 1))
+
+    last_error = None
+    for prov, modelo_real, veces in intentos:
+        if prov != provider:
+            print(f"🔄 Fallback a {alt} (stream)")
+        for attempt in range(veces):
+            if cb_on and not resiliencia.permitir(prov, abierto):
+                print(f"⚡ [{prov}] circuito abierto: se saltea")
+                last_error = last_error or Exception(f"Circuito de {prov} abierto")
+                break
+            stream = (_stream_mistral if prov == 'mistral' else _stream_openrouter)(
+                modelo_real, messages, max_tokens, config, temperature)
+            try:
+                primero = next(stream, '')
+            except limitador.LlamadaDescartada:
+                if cb_on:
+                    resiliencia.liberar_prueba(prov)
+                raise
+            except Exception as e:
+                last_error = e
+                reintentable = resiliencia.es_reintentable(e)
+                if cb_on:
+                    if reintentable:
+                        resiliencia.registrar_fallo(prov, e, umbral)
+                    else:
+                        resiliencia.liberar_prueba(prov)
+                print(f"⚠️ Error stream intento {attempt + 1}/{veces}: {e}")
+                if not reintentable:
+                    break
+                if attempt < veces - 1:
+                    espera = resiliencia.espera_reintento(attempt, e, base, tope)
+                    if espera > max_ra:
+                        break
+                    time.sleep(espera)
+                continue
+            if cb_on:
+                resiliencia.registrar_exito(prov)
+            try:
+                if primero:
+                    yield primero
+                yield from stream
+            finally:
+                stream.close()
+            return
 
     raise last_error or Exception("No se pudo completar la llamada LLM")
 
@@ -553,103 +1019,271 @@ def embeddings_disponibles():
         pass
     return bool(os.getenv('MISTRAL_API_KEY', '').strip())
 
+# ─────────────────────────────────────────────────────────────────────────────
+# BÚSQUEDA WEB
+# buscar_en_internet(): caché en disco por query normalizada (mayúsculas,
+# tildes, puntuación y palabras vacías plegados; orden y repeticiones se
+# respetan) con TTL por proveedor y
+# stale-while-revalidate: pasado el TTL, durante searchCache.staleS se
+# devuelve lo guardado al instante y se refresca de fondo. En un miss, los
+# proveedores configurados corren EN CARRERA y gana el primero con
+# resultados (searchCache.race: false → el orden de siempre, uno tras otro).
+# ─────────────────────────────────────────────────────────────────────────────
+
+BUSQUEDA_CACHE_PATH = './data/busqueda_cache.db'
+
+_VACIAS_BUSQUEDA = {
+    'el', 'la', 'los', 'las', 'un', 'una', 'unos', 'unas', 'de', 'del', 'al', 'a', 'en', 'y',
+    'o', 'que', 'es', 'son', 'se', 'lo', 'por', 'para', 'con', 'sobre', 'the', 'of',
+}
+_pool_busqueda   = ThreadPoolExecutor(max_workers=6, thread_name_prefix='busqueda')
+_refrescando     = set()   # claves con un refresco de fondo en curso
+_busqueda_lock   = threading.Lock()
+_busqueda_tabla  = False
+_busqueda_stats  = {'hits': 0, 'hits_viejos': 0, 'misses': 0, 'refrescos': 0, 'sin_resultado': 0,
+                    'ganadas': {}}
+
+
+def _normalizar_query(query):
+    """
+    Clave de caché: minúsculas, sin tildes ni puntuación ni palabras vacías.
+    La ñ se conserva ("año" no es "ano"). El orden y las repeticiones se
+    respetan: "perro muerde hombre" y "hombre muerde perro" son búsquedas distintas.
+    """
+    plano = unicodedata.normalize('NFD', (query or '').lower())
+    plano = ''.join(c for i, c in enumerate(plano)
+                    if unicodedata.category(c) != 'Mn' or (c == '\u0303' and i and plano[i - 1] == 'n'))
+    plano = unicodedata.normalize('NFC', plano)
+    return ' '.join(p for p in re.findall(r'[a-z0-9ñ]+', plano) if p not in _VACIAS_BUSQUEDA)
+
+
+def _config_cache_busqueda():
+    cfg = cargar_config_apis()
+    return cfg.get('search', {}) or {}, cfg.get('searchCache', {}) or {}
+
+
+def _conn_busquedas():
+    """Abre la caché de búsquedas (una por instalación). La primera vez crea la tabla."""
+    global _busqueda_tabla
+    conn = _get_conn(BUSQUEDA_CACHE_PATH)
+    if not _busqueda_tabla:
+        conn.execute('''CREATE TABLE IF NOT EXISTS busquedas (
+            clave TEXT PRIMARY KEY,
+            query TEXT,
+            proveedor TEXT NOT NULL,
+            resultado TEXT NOT NULL,
+            creado REAL NOT NULL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_busquedas_creado ON busquedas(creado)')
+        conn.commit()
+        _busqueda_tabla = True
+    return conn
+
+
+def _buscar_serpapi(http, query, key):
+    resp = http.get(
+        'https://serpapi.com/search',
+        params={'q': query, 'api_key': key, 'num': 3, 'hl': 'es'},
+        timeout=8
+    )
+    resp.raise_for_status()
+    data = resp.json()
+    resultados = []
+    # Answer box (respuesta directa)
+    ab = data.get('answer_box', {})
+    if ab.get('answer'):   resultados.append(ab['answer'])
+    elif ab.get('snippet'): resultados.append(ab['snippet'])
+    # Resultados orgánicos
+    for r in data.get('organic_results', [])[:3]:
+        if r.get('snippet'):
+            resultados.append(r['snippet'])
+    return resultados[:4]
+
+
+def _buscar_brave(http, query, key):
+    resp = http.get(
+        'https://api.search.brave.com/res/v1/web/search',
+        params={'q': query, 'count': 3},
+        headers={
+            'Accept': 'application/json',
+            'X-Subscription-Token': key
+        },
+        timeout=8
+    )
+    resp.raise_for_status()
+    data = resp.json()
+    return [
+        r['description']
+        for r in data.get('web', {}).get('results', [])[:3]
+        if r.get('description')
+    ]
+
+
+def _buscar_tavily(http, query, key):
+    resp = http.post(
+        'https://api.tavily.com/search',
+        json={
+            'api_key': key,
+            'query': query,
+            'max_results': 3,
+            'search_depth': 'basic'
+        },
+        timeout=10
+    )
+    resp.raise_for_status()
+    data = resp.json()
+    resultados = []
+    if data.get('answer'):
+        resultados.append(data['answer'])
+    for r in data.get('results', [])[:2]:
+        if r.get('content'):
+            resultados.append(r['content'][:400])
+    return resultados
+
+
+# Orden de preferencia (el de la cadena secuencial): proveedor → (nombre, función, campo de la key)
+_PROVEEDORES_BUSQUEDA = (
+    ('serpapi', 'SerpAPI', _buscar_serpapi, 'serpapi_key'),
+    ('brave',   'Brave',   _buscar_brave,   'brave_key'),
+    ('tavily',  'Tavily',  _buscar_tavily,  'tavily_key'),
+)
+
+
+def _buscar_en(proveedor, nombre, fn, http, query, key):
+    """Un proveedor: devuelve el texto de resultados o None (los errores se loguean, no suben)."""
+    try:
+        resultados = fn(http, query, key)
+        if resultados:
+            print(f"🌐 {nombre}: '{query}' → {len(resultados)} resultado(s)")
+            return '\n'.join(resultados)
+    except Exception as e:
+        print(f"⚠️ {nombre} error: {e}")
+    return None
+
+
+def _buscar_en_proveedores(query, search, carrera=True):
+    """
+    Busca en los proveedores con key. En carrera: todos a la vez y gana el
+    primero con resultados (los demás terminan de fondo y se ignoran). Sin
+    carrera: SerpAPI → Brave → Tavily, el primero que devuelva algo.
+    Devuelve (proveedor, texto) o (None, None).
+    """
+    http = http_cliente()
+    activos = [(p, n, fn, (search.get(campo) or '').strip())
+               for p, n, fn, campo in _PROVEEDORES_BUSQUEDA if (search.get(campo) or '').strip()]
+    if not carrera or len(activos) < 2:
+        for p, n, fn, key in activos:
+            texto = _buscar_en(p, n, fn, http, query, key)
+            if texto:
+                return p, texto
+        return None, None
+
+    pendientes = {_pool_busqueda.submit(_buscar_en, p, n, fn, http, query, key): p
+                  for p, n, fn, key in activos}
+    while pendientes:
+        listos, _ = wait(pendientes, return_when=FIRST_COMPLETED)
+        for futuro in listos:
+            proveedor = pendientes.pop(futuro)
+            texto = futuro.result()
+            if texto:
+                return proveedor, texto
+    return None, None
+
+
+def _guardar_busqueda(clave, query, proveedor, texto, max_entradas):
+    try:
+        with _conn_busquedas() as conn:
+            conn.execute('INSERT OR REPLACE INTO busquedas (clave, query, proveedor, resultado, creado) '
+                         'VALUES (?, ?, ?, ?, ?)', (clave, query, proveedor, texto, time.time()))
+            conn.execute('DELETE FROM busquedas WHERE clave NOT IN '
+                         '(SELECT clave FROM busquedas ORDER BY creado DESC LIMIT ?)', (max_entradas,))
+    except sqlite3.Error as e:
+        print(f"⚠️ No se pudo guardar la búsqueda en caché: {e}")
+
+
+def _buscar_y_guardar(clave, query, search, cache_cfg):
+    proveedor, texto = _buscar_en_proveedores(query, search, cache_cfg.get('race', True))
+    with _busqueda_lock:
+        if proveedor:
+            ganadas = _busqueda_stats['ganadas']
+            ganadas[proveedor] = ganadas.get(proveedor, 0) + 1
+        else:
+            _busqueda_stats['sin_resultado'] += 1
+    if texto and cache_cfg.get('enabled', True) and clave:
+        _guardar_busqueda(clave, query, proveedor, texto, int(cache_cfg.get('maxEntries', 2000)))
+    return texto
+
+
+def _refrescar_busqueda(clave, query, search, cache_cfg):
+    try:
+        _buscar_y_guardar(clave, query, search, cache_cfg)
+    finally:
+        with _busqueda_lock:
+            _refrescando.discard(clave)
+
+
 def buscar_en_internet(query):
     """
-    Busca en internet usando el primer proveedor configurado disponible.
-    Orden: SerpAPI → Brave Search → Tavily
+    Busca en internet con los proveedores configurados (SerpAPI, Brave
+    Search, Tavily), pasando primero por la caché de búsquedas.
     Devuelve un string con los snippets relevantes, o None si no hay nada configurado.
     Solo se llama desde chat_engine cuando el detector de intención lo decide.
     """
-    import requests as _req
-
-    cfg    = cargar_config_apis()
-    search = cfg.get('search', {})
+    search, cache_cfg = _config_cache_busqueda()
 
     if not search.get('enabled', False):
         return None
 
-    # ── SerpAPI ──────────────────────────────────────────────────────────────
-    serpapi_key = (search.get('serpapi_key') or '').strip()
-    if serpapi_key:
-        try:
-            resp = _req.get(
-                'https://serpapi.com/search',
-                params={'q': query, 'api_key': serpapi_key, 'num': 3, 'hl': 'es'},
-                timeout=8
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            resultados = []
-            # Answer box (respuesta directa)
-            ab = data.get('answer_box', {})
-            if ab.get('answer'):   resultados.append(ab['answer'])
-            elif ab.get('snippet'): resultados.append(ab['snippet'])
-            # Resultados orgánicos
-            for r in data.get('organic_results', [])[:3]:
-                if r.get('snippet'):
-                    resultados.append(r['snippet'])
-            if resultados:
-                print(f"🌐 SerpAPI: '{query}' → {len(resultados)} resultado(s)")
-                return '\n'.join(resultados[:4])
-        except Exception as e:
-            print(f"⚠️ SerpAPI error: {e}")
-
-    # ── Brave Search ─────────────────────────────────────────────────────────
-    brave_key = (search.get('brave_key') or '').strip()
-    if brave_key:
+    clave = _normalizar_query(query)
+    if cache_cfg.get('enabled', True) and clave:
+        fila = None
         try:
-            resp = _req.get(
-                'https://api.search.brave.com/res/v1/web/search',
-                params={'q': query, 'count': 3},
-                headers={
-                    'Accept': 'application/json',
-                    'X-Subscription-Token': brave_key
-                },
-                timeout=8
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            resultados = [
-                r['description']
-                for r in data.get('web', {}).get('results', [])[:3]
-                if r.get('description')
-            ]
-            if resultados:
-                print(f"🌐 Brave: '{query}' → {len(resultados)} resultado(s)")
-                return '\n'.join(resultados)
-        except Exception as e:
-            print(f"⚠️ Brave error: {e}")
-
-    # ── Tavily ───────────────────────────────────────────────────────────────
-    tavily_key = (search.get('tavily_key') or '').strip()
-    if tavily_key:
-        try:
-            resp = _req.post(
-                'https://api.tavily.com/search',
-                json={
-                    'api_key': tavily_key,
-                    'query': query,
-                    'max_results': 3,
-                    'search_depth': 'basic'
-                },
-                timeout=10
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            resultados = []
-            if data.get('answer'):
-                resultados.append(data['answer'])
-            for r in data.get('results', [])[:2]:
-                if r.get('content'):
-                    resultados.append(r['content'][:400])
-            if resultados:
-                print(f"🌐 Tavily: '{query}' → {len(resultados)} resultado(s)")
-                return '\n'.join(resultados)
-        except Exception as e:
-            print(f"⚠️ Tavily error: {e}")
-
-    print(f"⚠️ Búsqueda '{query}': ningún proveedor disponible")
-    return None
+            with _conn_busquedas() as conn:
+                fila = conn.execute('SELECT proveedor, resultado, creado FROM busquedas WHERE clave = ?',
+                                    (clave,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"⚠️ Caché de búsquedas no disponible: {e}")
+        if fila:
+            proveedor, texto, creado = fila
+            edad = time.time() - creado
+            ttl  = float((cache_cfg.get('ttlS') or {}).get(proveedor, 21600))
+            if edad < ttl:
+                with _busqueda_lock:
+                    _busqueda_stats['hits'] += 1
+                print(f"🌐 Caché: '{query}' ({proveedor}, hace {edad / 60:.0f} min)")
+                return texto
+            if edad < ttl + float(cache_cfg.get('staleS', 86400)):
+                # Vencida pero usable: se responde ya y se refresca de fondo (una vez por clave)
+                with _busqueda_lock:
+                    _busqueda_stats['hits_viejos'] += 1
+                    refrescar = clave not in _refrescando
+                    if refrescar:
+                        _refrescando.add(clave)
+                        _busqueda_stats['refrescos'] += 1
+                if refrescar:
+                    _pool_busqueda.submit(_refrescar_busqueda, clave, query, search, cache_cfg)
+                print(f"🌐 Caché (vencida, refrescando): '{query}'")
+                return texto
+
+    with _busqueda_lock:
+        _busqueda_stats['misses'] += 1
+    texto = _buscar_y_guardar(clave, query, search, cache_cfg)
+    if not texto:
+        print(f"⚠️ Búsqueda '{query}': ningún proveedor disponible")
+    return texto
+
+
+def stats_busqueda():
+    """Caché de búsquedas: hits (frescos y vencidos), misses, refrescos, entradas y victorias por proveedor."""
+    with _busqueda_lock:
+        s = json.loads(json.dumps(_busqueda_stats))
+    consultas = s['hits'] + s['hits_viejos'] + s['misses']
+    s['tasa_hit'] = round((s['hits'] + s['hits_viejos']) / consultas, 3) if consultas else 0.0
+    try:
+        with _conn_busquedas() as conn:
+            s['entradas'] = conn.execute('SELECT COUNT(*) FROM busquedas').fetchone()[0]
+    except sqlite3.Error:
+        s['entradas'] = None
+    return s
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -659,8 +1293,13 @@ def buscar_en_internet(query):
 PERSONAJES_DIR = './data/personajes'
 ACTIVO_PATH    = './data/personaje_activo.json'
 
+_personaje_hilo = threading.local()   # personaje fijado para un hilo (ver personaje_del_hilo)
+
 def get_personaje_activo_id():
     """Devuelve el ID del personaje activo (default: 'hiro')"""
+    pid = getattr(_personaje_hilo, 'pid', None)
+    if pid:
+        return pid
     if os.path.exists(ACTIVO_PATH):
         try:
             with open(ACTIVO_PATH, 'r') as f:
@@ -674,6 +1313,21 @@ def set_personaje_activo_id(pid):
     with open(ACTIVO_PATH, 'w') as f:
         json.dump({'id': pid}, f)
 
+@contextmanager
+def personaje_del_hilo(pid):
+    """
+    Dentro del bloque, get_personaje_activo_id() / paths() de ESTE hilo
+    devuelven `pid` aunque el usuario cambie de personaje mientras tanto.
+    Lo usan los trabajos en segundo plano (trabajos.py): el post-proceso de
+    un turno escribe siempre en la memoria del personaje de ese turno.
+    """
+    anterior = getattr(_personaje_hilo, 'pid', None)
+    _personaje_hilo.pid = pid
+    try:
+        yield pid
+    finally:
+        _personaje_hilo.pid = anterior
+
 def paths(pid=None):
     """Devuelve todos los paths de un personaje. Si pid=None usa el activo."""
     pid = pid or get_personaje_activo_id()
@@ -684,6 +1338,10 @@ def paths(pid=None):
         'db'    : os.path.join(base, 'memoria.db'),
         'emb'   : os.path.join(base, 'embeddings.index'),
         'emb_m' : os.path.join(base, 'embeddings_metadata.msgpack'),
+        'emb_wal': os.path.join(base, 'embeddings.wal'),
+        'emb_header': os.path.join(base, 'embeddings.header.json'),
+        'emb_reindex': os.path.join(base, 'reindex'),
+        'emb_cache': os.path.join(base, 'embeddings_cache.db'),
         'json'  : os.path.join(base, 'personaje.json'),
         'avatar': os.path.join(base, 'avatar.jpg'),
     }
@@ -692,6 +1350,12 @@ def paths(pid=None):
 # BASE DE DATOS POR PERSONAJE
 # ─────────────────────────────────────────────────────────────────────────────
 
+# (tabla FTS5, tabla de contenido, columnas indexadas)
+_TABLAS_FTS = (
+    ('episodios_fts', 'memoria_episodica',  ('contenido_usuario', 'contenido_hiro', 'resumen', 'temas')),
+    ('hechos_fts',    'memoria_permanente', ('categoria', 'clave', 'valor', 'contexto')),
+)
+
 def init_database_personaje(pid):
     """Crea las tablas SQLite del personaje si no existen. Migra columnas si ya existe."""
     p = paths(pid)
@@ -700,11 +1364,14 @@ def init_database_personaje(pid):
     with sqlite3.connect(p['db']) as conn:
         cursor = conn.cursor()
 
+        # embedding_id: vector FAISS del episodio del turno (compartido por el
+        # mensaje del usuario y la respuesta). Al borrar el mensaje se borra el vector.
         cursor.execute('''CREATE TABLE IF NOT EXISTS mensajes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             rol TEXT NOT NULL,
             contenido TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            embedding_id INTEGER DEFAULT NULL)''')
 
         cursor.execute('''CREATE TABLE IF NOT EXISTS memoria_permanente (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -715,6 +1382,7 @@ def init_database_personaje(pid):
             contexto TEXT,
             fecha_aprendido DATETIME DEFAULT CURRENT_TIMESTAMP,
             ultima_actualizacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+            embedding_id INTEGER DEFAULT NULL,
             UNIQUE(categoria, clave))''')
 
         cursor.execute('''CREATE TABLE IF NOT EXISTS memoria_episodica (
@@ -855,6 +1523,66 @@ def init_database_personaje(pid):
             id INTEGER PRIMARY KEY,
             contenido TEXT NOT NULL,
             fecha_actualizacion DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+        # Metadata de los vectores FAISS (id = embedding_id estable).
+        # memoria/faiss_store.py la escribe al aplicar cada registro del WAL.
+        cursor.execute('''CREATE TABLE IF NOT EXISTS vectores (
+            id INTEGER PRIMARY KEY,
+            tipo TEXT NOT NULL,
+            texto TEXT,
+            metadata TEXT,
+            timestamp DATETIME,
+            vector BLOB DEFAULT NULL)''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_vectores_tipo ON vectores(tipo, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_vectores_timestamp ON vectores(timestamp)')
+
+        # Cola durable de trabajos en segundo plano (trabajos.py). clave es la
+        # clave de idempotencia ("<id mensaje>:<etapa>"): encolar dos veces lo
+        # mismo no duplica. pasos guarda el resultado de cada paso ya hecho para
+        # que un reintento (o la reanudación al arrancar) no los repita.
+        cursor.execute('''CREATE TABLE IF NOT EXISTS trabajos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            clave TEXT UNIQUE,
+            tipo TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            intentos INTEGER DEFAULT 0,
+            max_intentos INTEGER DEFAULT 4,
+            pasos TEXT NOT NULL DEFAULT '{}',
+            error TEXT,
+            creado REAL,
+            disponible_desde REAL,
+            iniciado REAL,
+            terminado REAL)''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_trabajos_estado ON trabajos(estado, disponible_desde)')
+
+        # Índice léxico FTS5 (BM25) sobre episodios y hechos, para la búsqueda
+        # híbrida de memoria/busqueda_lexica.py. Tablas de contenido externo:
+        # no duplican el texto y los triggers las mantienen al día en cada
+        # INSERT / UPDATE / DELETE, venga de donde venga.
+        for fts, tabla, columnas in _TABLAS_FTS:
+            try:
+                existia = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts,)).fetchone()
+                cols  = ', '.join(columnas)
+                nuevo = ', '.join(f'new.{c}' for c in columnas)
+                viejo = ', '.join(f'old.{c}' for c in columnas)
+                cursor.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                    {cols}, content='{tabla}', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2')''')
+                cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {tabla} BEGIN
+                    INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {nuevo}); END''')
+                cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {tabla} BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {viejo}); END''')
+                cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {tabla} BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {viejo});
+                    INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {nuevo}); END''')
+                if not existia:
+                    # DB existente: indexar lo que ya había
+                    cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+                    print(f"✅ Índice léxico '{fts}' creado")
+            except sqlite3.OperationalError as e:
+                print(f"⚠️ FTS5 no disponible ({e}): la búsqueda queda solo vectorial")
+                break
         # ── Migraciones para DBs existentes ───────────────────────────────────
         migraciones_text = [
             ('escenarios', 'historia'),
@@ -921,6 +1649,20 @@ def init_database_personaje(pid):
         except Exception:
             pass
 
+        # Ids estables de FAISS (NULL = sin vector; 0 es un id válido)
+        for _t in ('mensajes', 'memoria_permanente'):
+            try:
+                cursor.execute(f"ALTER TABLE {_t} ADD COLUMN embedding_id INTEGER DEFAULT NULL")
+                print(f"✅ Migración: 'embedding_id' → '{_t}'")
+            except sqlite3.OperationalError:
+                pass
+        # Vector completo para re-puntuar con faiss.storage = sq8 / pq
+        try:
+            cursor.execute("ALTER TABLE vectores ADD COLUMN vector BLOB DEFAULT NULL")
+            print("✅ Migración: 'vector' → 'vectores'")
+        except sqlite3.OperationalError:
+            pass
+
         # Garantizar que siempre exista la fila de relación.
         # INSERT OR REPLACE (en vez de OR IGNORE) para forzar la inserción
         # incluso si la tabla existe pero está vacía (caso de DBs legacy migradas).